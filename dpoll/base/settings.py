@@ -156,9 +156,66 @@ PROMOTION_ACCOUNT_ACTIVE_KEY = ""
 SPONSORS_ACCOUNT = "dpoll.sponsors"
 DISCORD_CURATION_CHANNEL_ID = "508951346901286922"
 BROADCAST_TO_BLOCKCHAIN = True
+# RPC nodes used to read the blocks.
+BLOCKCHAIN_NODES = ["https://api.hivekings.com"]
 
 TEAM_MEMBERS = ["emrebeyler", "bluerobo", "isnochys", "tolgahanuzun"]
 
+# Filtered results of the polls with at least that many voters are
+# calculated with numpy (if installed). None disables it.
+VECTORIZED_TALLY_THRESHOLD = 5000
+
+# The cache versions, the poll results, the pages and the homepage stats
+# are shared by the web workers and the management commands. Set
+# DPOLL_CACHE_BACKEND and DPOLL_CACHE_LOCATION in production, e.g.
+# django.core.cache.backends.memcached.MemcachedCache and 127.0.0.1:11211.
+# The default process-local cache (LocMemCache) is for the development
+# and the tests, it disables the caching of the results and the pages.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'DPOLL_CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('DPOLL_CACHE_LOCATION', ''),
+    }
+}
+
+# Cache timeouts (in seconds) of the poll results.
+VOTES_SUMMARY_CACHE_TIMEOUT = 300
+EXPIRED_VOTES_SUMMARY_CACHE_TIMEOUT = 604800
+# Rendered pages of the anonymous users and the page fragments.
+PAGE_CACHE_TIMEOUT = 60
+# Polls by vote count report, per date range.
+POLLS_BY_VOTE_COUNT_CACHE_TIMEOUT = 600
+
+# Homepage stats older than that many seconds are recomputed. With
+# stale-while-revalidate, the stale stats are served meanwhile and the
+# recompute runs in the background.
+STATS_REFRESH_INTERVAL = 300
+STATS_STALE_WHILE_REVALIDATE = True
+
+# Trending scores of the polls lose half of their value in that many hours.
+TRENDING_HALF_LIFE_HOURS = 24
+
+# Blockchain operations of the users are queued and broadcasted by the
+# broadcast_outbox command with the signer class below. A stand-in signer
+# is used if BROADCAST_TO_BLOCKCHAIN is False. Failed attempts are retried
+# after BROADCAST_RETRY_DELAY seconds, doubled on every attempt. Workers
+# lease the broadcasts they pick for BROADCAST_LEASE seconds.
+BROADCAST_SIGNER = "polls.broadcasts.HiveSignerSigner"
+BROADCAST_MAX_ATTEMPTS = 5
+BROADCAST_RETRY_DELAY = 30
+BROADCAST_LEASE = 300
+# The access tokens of the users are kept in the outbox for
+# BROADCAST_TOKEN_TTL seconds at most, the broadcasts not sent by then
+# fail.
+BROADCAST_TOKEN_TTL = 1800
+
+# Irreversible blocks fetched from the RPC nodes are cached in a local
+# SQLite file, up to BLOCK_CACHE_SIZE blocks. None disables the cache.
+BLOCK_CACHE_PATH = os.path.join(BASE_DIR, 'block_cache.sqlite3')
+BLOCK_CACHE_SIZE = 50000
+
 
 try:
     from .local_settings import *
@@ -1,10 +1,20 @@
 from django.contrib import admin
+from django.db.models import Count
 
 from .models import Community
 
 
 class CommunityAdmin(admin.ModelAdmin):
-    pass
+    # members are bulk-pasted into the text field, and synced into the
+    # memberships on save.
+    list_display = ('name', 'member_count')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            member_count=Count('memberships'))
+
+    def member_count(self, obj):
+        return obj.member_count
 
 
 admin.site.register(Community, CommunityAdmin)
\ No newline at end of file
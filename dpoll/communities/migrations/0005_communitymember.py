@@ -0,0 +1,39 @@
+# Generated by Django 2.1.1 on 2026-10-18 08:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_memberships(apps, schema_editor):
+    Community = apps.get_model("communities", "Community")
+    CommunityMember = apps.get_model("communities", "CommunityMember")
+    for community in Community.objects.all():
+        usernames = set(
+            username.strip() for username in (community.members or "").split("\n"))
+        usernames.discard("")
+        CommunityMember.objects.bulk_create([
+            CommunityMember(community=community, username=username)
+            for username in usernames
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0004_auto_20190408_1251'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommunityMember',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(db_index=True, max_length=255)),
+                ('community', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='communities.Community')),
+            ],
+            options={
+                'unique_together': {('community', 'username')},
+            },
+        ),
+        migrations.RunPython(build_memberships, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,13 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils.functional import cached_property
+
+
+def parse_members(members):
+    """Split a newline separated member list into unique usernames."""
+    # dict keys keep the order.
+    return list(dict.fromkeys(
+        username.strip() for username in (members or "").split("\n")
+        if username.strip()))
 
 
 class Community(models.Model):
@@ -9,16 +18,49 @@ class Community(models.Model):
     @property
     def member_list(self):
         """Split the member_list with newline char. and return a Python list."""
+        return parse_members(self.members)
+
+    @cached_property
+    def member_set(self):
+        """Usernames of the members, read from the indexed memberships."""
+        return frozenset(
+            self.memberships.values_list("username", flat=True))
 
-        if self.members:
-            members = self.members.split("\n")
-            members = map(lambda x: x.strip(), members)
-            return list(members)
-        else:
-            return []
+    def member_usernames(self):
+        """Usernames of the members as a subquery, to filter on joins."""
+        return CommunityMember.objects.filter(
+            community=self).values("username")
+
+    def sync_members(self):
+        """Sync the memberships with the bulk-pasted members field."""
+        usernames = set(self.member_list)
+        existing = set(self.memberships.values_list("username", flat=True))
+        self.memberships.exclude(username__in=usernames).delete()
+        CommunityMember.objects.bulk_create([
+            CommunityMember(community=self, username=username)
+            for username in usernames - existing
+        ])
+        self.__dict__.pop("member_set", None)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.sync_members()
 
     def __str__(self):
         return self.name
 
     class Meta:
         verbose_name_plural = "Communities"
+
+
+class CommunityMember(models.Model):
+    community = models.ForeignKey(Community, on_delete=models.CASCADE,
+                                  related_name="memberships")
+    username = models.CharField(max_length=255, db_index=True)
+
+    def __str__(self):
+        return f"{self.community}: {self.username}"
+
+    class Meta:
+        unique_together = ("community", "username")
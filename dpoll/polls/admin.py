@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import User, Question, Choice, PromotionTransaction, VoteAudit
+from .models import (
+    Broadcast, User, Question, Choice, PromotionTransaction, VoteAudit)
 from django.contrib.auth.admin import UserAdmin
 
 
@@ -20,8 +21,16 @@ class VoteAuditAdmin(admin.ModelAdmin):
     exclude = ('choices', )
 
 
+class BroadcastAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'username', 'question', 'status', 'attempts',
+                    'next_attempt_at')
+    list_filter = ('kind', 'status')
+    exclude = ('access_token', )
+
+
 admin.site.register(User, MyUserAdmin)
 admin.site.register(Question)
 admin.site.register(Choice)
 admin.site.register(PromotionTransaction)
 admin.site.register(VoteAudit, VoteAuditAdmin)
+admin.site.register(Broadcast, BroadcastAdmin)
@@ -0,0 +1,279 @@
+"""
+Analytics on the voters of a poll.
+
+The voters are loaded once with the regular filters of the detail page,
+then sliced in Python. See Choice.filtered_vote_count for the semantics
+of the thresholds: a voter passes with a value greater than or equal to
+the threshold, unknown (NULL) values never pass, and a falsy threshold
+means "no filter".
+"""
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+from django.db.models import Count, Q
+
+from communities.models import Community
+
+from .tally import Tally, Vote, voter_filter, voters_by_choice
+
+# filter parameter -> voter attribute
+FILTER_DIMENSIONS = {
+    "rep": "reputation",
+    "sp": "sp",
+    "age": "account_age",
+    "post_count": "post_count",
+}
+
+MAX_THRESHOLDS = 100
+
+# default bucket edges of the voter distributions
+DISTRIBUTION_EDGES = {
+    "rep": [25, 40, 50, 60, 70],
+    "sp": [100, 1000, 10000, 100000, 1000000],
+    "age": [30, 180, 365, 730, 1825],
+    "post_count": [10, 100, 1000, 10000],
+}
+
+MAX_EDGES = 50
+
+
+def poll_voters(question, rep=None, age=None, post_count=None, sp=None,
+                community=None):
+    """
+    Load the voters of a poll passing the filters.
+
+    :return (tuple): (list of (choice id, text) pairs, Choice id -> list of
+        VoterResults)
+    """
+    from . import snapshots
+
+    community_obj = None
+    if community:
+        try:
+            community_obj = Community.objects.get(name=community)
+        except Community.DoesNotExist:
+            pass
+
+    snapshot = question.get_snapshot()
+    if snapshot:
+        choices, _, voters = snapshots.tally_votes(
+            snapshot, rep, age, post_count, sp,
+            community_members=community_obj and community_obj.member_set,
+            filter_exists=bool(rep or age or post_count or sp or
+                               community_obj))
+        return choices, voters
+
+    voter_q = voter_filter(
+        rep, age, post_count, sp,
+        community_members=community_obj and community_obj.member_usernames())
+    choices = list(question.choices.order_by("id").values_list("id", "text"))
+    return choices, voters_by_choice(question, voter_q)
+
+
+class _RankedVoters:
+    """Voters of a choice sorted by an attribute, with the prefix sums of
+    their stakes."""
+
+    def __init__(self, voters, attr):
+        ranked = sorted(
+            (voter for voter in voters if getattr(voter, attr) is not None),
+            key=lambda voter: getattr(voter, attr))
+        self.voter_count = len(voters)
+        self.values = [float(getattr(voter, attr)) for voter in ranked]
+        self.sp = [0] + list(accumulate(
+            float(voter.sp or 0) for voter in ranked))
+        self.sa_vests = [0] + list(accumulate(
+            voter.sa_effective_vests if voter.vests is not None else 0
+            for voter in ranked))
+        self.all_sp = sum(float(voter.sp or 0) for voter in voters)
+        self.all_sa_vests = sum(
+            voter.sa_effective_vests for voter in voters
+            if voter.vests is not None)
+
+    def tally(self, threshold):
+        if not threshold:
+            return Tally(
+                voter_count=self.voter_count,
+                filtered_voter_count=self.voter_count,
+                sp=self.all_sp,
+                sa_vests=self.all_sa_vests,
+            )
+        # voters at and after the index pass the threshold.
+        i = bisect_left(self.values, threshold)
+        return Tally(
+            voter_count=self.voter_count,
+            filtered_voter_count=len(self.values) - i,
+            sp=self.sp[-1] - self.sp[i],
+            sa_vests=self.sa_vests[-1] - self.sa_vests[i],
+        )
+
+
+def threshold_sweep(question, dimension, thresholds, stake_based=False,
+                    sa_stake_based=False, **filters):
+    """
+    Calculate the results of a poll for a list of thresholds on one
+    filter dimension.
+
+    The voters of every choice are sorted once, and the totals of a
+    threshold are read from the prefix sums.
+
+    :param question (Question): The poll
+    :param dimension (str): One of the FILTER_DIMENSIONS
+    :param thresholds (list): Threshold values
+    :param filters: Other filters of the detail page, applied to every
+        threshold.
+    :return (list): A result per threshold, in the given order.
+    """
+    attr = FILTER_DIMENSIONS[dimension]
+    filters.pop(dimension, None)
+    choices, voters = poll_voters(question, **filters)
+    ranked = {
+        choice_id: _RankedVoters(voters[choice_id], attr)
+        for choice_id, _ in choices
+    }
+
+    results = []
+    for threshold in thresholds:
+        tallies = {
+            choice_id: ranked[choice_id].tally(threshold)
+            for choice_id, _ in choices
+        }
+        vote_counts = {
+            choice_id: int(tally.value(
+                stake_based=stake_based, sa_stake_based=sa_stake_based))
+            for choice_id, tally in tallies.items()
+        }
+        all_votes = sum(vote_counts.values())
+        results.append({
+            "threshold": threshold,
+            "total_votes": all_votes,
+            "choices": [{
+                "id": choice_id,
+                "text": text,
+                "voter_count": tallies[choice_id].filtered_voter_count,
+                "vote_count": vote_counts[choice_id],
+                "percent": round(
+                    100 * vote_counts[choice_id] / all_votes, 2)
+                if vote_counts[choice_id] else 0,
+            } for choice_id, text in choices],
+        })
+    return results
+
+
+def _buckets(edges, counts):
+    bounds = [None] + list(edges) + [None]
+    return [{
+        "min": bounds[i],
+        "max": bounds[i + 1],
+        "voter_count": count,
+    } for i, count in enumerate(counts)]
+
+
+def _count_voters(voters, attrs):
+    """Bucket counts of the voters, for the snapshots."""
+    counts = {
+        dimension: [0] * (len(dimension_edges) + 2)
+        for dimension, _, dimension_edges in attrs
+    }
+    for voter in voters:
+        for dimension, attr, dimension_edges in attrs:
+            value = getattr(voter, attr)
+            # the last slot counts the unknown values.
+            counts[dimension][
+                -1 if value is None else
+                bisect_right(dimension_edges, value)] += 1
+    return len(voters), counts
+
+
+def _count_votes(question, attrs, **filters):
+    """
+    Bucket counts of the voters of every choice, in one aggregated query
+    with a filtered count per bucket.
+
+    :return (dict): Choice id -> (voter count, dimension -> counts)
+    """
+    community = filters.pop("community", None)
+    community_obj = Community.objects.filter(name=community).first() \
+        if community else None
+    voter_q = voter_filter(
+        **filters,
+        community_members=community_obj and community_obj.member_usernames())
+
+    aggregates = {}
+    for dimension, attr, dimension_edges in attrs:
+        field = f"user__{attr}"
+        bounds = [None] + list(dimension_edges) + [None]
+        for i in range(len(bounds) - 1):
+            q = Q(**{f"{field}__isnull": False})
+            if bounds[i] is not None:
+                q &= Q(**{f"{field}__gte": bounds[i]})
+            if bounds[i + 1] is not None:
+                q &= Q(**{f"{field}__lt": bounds[i + 1]})
+            aggregates[f"{dimension}_{i}"] = Count("id", filter=q)
+        aggregates[f"{dimension}_unknown"] = Count(
+            "id", filter=Q(**{f"{field}__isnull": True}))
+
+    votes = Vote.objects.filter(choice__question=question)
+    if voter_q:
+        votes = votes.filter(voter_q)
+    rows = votes.values("choice_id").annotate(
+        voter_count=Count("id"), **aggregates).order_by()
+    return {
+        row["choice_id"]: (row["voter_count"], {
+            dimension: [
+                row[f"{dimension}_{i}"]
+                for i in range(len(dimension_edges) + 1)
+            ] + [row[f"{dimension}_unknown"]]
+            for dimension, _, dimension_edges in attrs
+        }) for row in rows
+    }
+
+
+def voter_distributions(question, edges=None, **filters):
+    """
+    Bucket the voters of every choice by their attributes.
+
+    The buckets are counted in the database, with one aggregated query
+    over the (filtered) votes. The finalized polls are counted from their
+    snapshots. A voter falls into the bucket [edge[i], edge[i + 1]).
+    Voters with an unknown value are counted separately.
+
+    :param question (Question): The poll
+    :param edges (dict): Dimension -> ascending bucket edges. Defaults to
+        DISTRIBUTION_EDGES.
+    :param filters: Filters of the detail page.
+    :return (list): Distributions per choice.
+    """
+    if edges is None:
+        edges = DISTRIBUTION_EDGES
+    attrs = [(dimension, FILTER_DIMENSIONS[dimension], dimension_edges)
+             for dimension, dimension_edges in edges.items()]
+
+    if question.get_snapshot():
+        choices, voters = poll_voters(question, **filters)
+        counts = {
+            choice_id: _count_voters(voters[choice_id], attrs)
+            for choice_id, _ in choices
+        }
+    else:
+        choices = list(
+            question.choices.order_by("id").values_list("id", "text"))
+        counts = _count_votes(question, attrs, **filters)
+
+    no_votes = _count_voters([], attrs)
+    results = []
+    for choice_id, text in choices:
+        voter_count, choice_counts = counts.get(choice_id, no_votes)
+        results.append({
+            "id": choice_id,
+            "text": text,
+            "voter_count": voter_count,
+            "distributions": {
+                dimension: {
+                    "buckets": _buckets(
+                        dimension_edges, choice_counts[dimension][:-1]),
+                    "unknown": choice_counts[dimension][-1],
+                } for dimension, _, dimension_edges in attrs
+            },
+        })
+    return results
@@ -1,31 +1,69 @@
+from django.db.models import Prefetch
 from django.http import Http404
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet, ViewSet
 from rest_framework.views import APIView
 from rest_framework.mixins import RetrieveModelMixin, ListModelMixin
 
-from .models import Question, User, VoteAudit
+from .models import Broadcast, Choice, Question, User, VoteAudit
 from sponsors.models import Sponsor
 from .serializers import (
-    QuestionSerializer, SponsorSerializer, UserSerializer,
-    UserDetailSerializer,
+    BroadcastSerializer, QuestionSerializer, SponsorSerializer,
+    UserSerializer, UserDetailSerializer,
 )
-from .views import TEAM_MEMBERS
+from .blocks import cache_stats
+from .analytics import (
+    DISTRIBUTION_EDGES, FILTER_DIMENSIONS, MAX_EDGES, MAX_THRESHOLDS,
+    threshold_sweep, voter_distributions,
+)
+from .leaderboards import MAX_LIMIT, WINDOWS, top_pollers, top_voters
+from .pagination import KeysetPagination
+from .utils import sanitize_filter_value
+from .views import POLL_ORDERINGS, TEAM_MEMBERS
+
+
+def get_filters(query_params):
+    """Read the filters of the detail page from the query parameters."""
+    return {
+        "rep": sanitize_filter_value(query_params.get("rep")),
+        "sp": sanitize_filter_value(query_params.get("sp")),
+        "age": sanitize_filter_value(query_params.get("age")),
+        "post_count": sanitize_filter_value(query_params.get("post_count")),
+        "community": query_params.get("community"),
+    }
 
 
 class QuestionViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet):
     serializer_class = QuestionSerializer
-    queryset = Question.objects.all().order_by("-id")
+    # choices of the expired polls are served from their snapshots.
+    queryset = Question.objects.all().select_related(
+        "snapshot").prefetch_related(
+        Prefetch("choices", queryset=Choice.objects.filter(
+            question__snapshot__isnull=True)),
+        "choices__tally", "choices__voted_users").order_by("-id")
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        """?order=new|trending|promoted, see views.POLL_ORDERINGS."""
+        queryset = super().get_queryset()
+        order = self.request.query_params.get("order")
+        if self.action != "list" or order not in POLL_ORDERINGS:
+            return queryset
+        if order == "promoted":
+            queryset = queryset.filter(promotion_amount__gt=0)
+        return queryset.order_by(*POLL_ORDERINGS[order])
 
     def retrieve(self, request, *args, **kwargs):
 
         try:
             try:
                 pk = int(kwargs.get("pk"))
-                account = Question.objects.get(pk=pk)
+                account = self.get_queryset().get(pk=pk)
             except ValueError as e:
                 # fallback to {uuid}
-                account = Question.objects.get(
+                account = self.get_queryset().get(
                     username=kwargs.get("pk"),
                     permlink=self.request.query_params.get("permlink"),
                 )
@@ -34,11 +72,118 @@ class QuestionViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet):
 
         return Response(QuestionSerializer(account).data)
 
+    @action(detail=True)
+    def sweep(self, request, pk=None):
+        """
+        Results of the poll for a list of thresholds on one filter.
+
+        ?dimension=rep&thresholds=25,40,50 with the optional filters and
+        stake_based parameters of the detail page.
+        """
+        dimension = request.query_params.get("dimension")
+        if dimension not in FILTER_DIMENSIONS:
+            raise ValidationError({"dimension": "Must be one of {}.".format(
+                ", ".join(FILTER_DIMENSIONS))})
+
+        thresholds = [
+            sanitize_filter_value(threshold) for threshold in
+            request.query_params.get("thresholds", "").split(",")
+        ]
+        if None in thresholds or len(thresholds) > MAX_THRESHOLDS:
+            raise ValidationError({"thresholds": "A comma separated list of "
+                                   f"up to {MAX_THRESHOLDS} integers."})
+
+        try:
+            question = Question.objects.get(pk=pk)
+        except (Question.DoesNotExist, ValueError):
+            raise Http404
+
+        return Response({
+            "id": question.id,
+            "dimension": dimension,
+            "results": threshold_sweep(
+                question, dimension, thresholds,
+                stake_based=request.query_params.get("stake_based") == "1",
+                sa_stake_based=request.query_params.get("stake_based") == "2",
+                **get_filters(request.query_params)),
+        })
+
+    @action(detail=True)
+    def distribution(self, request, pk=None):
+        """
+        Distributions of the voter attributes per choice.
+
+        ?dimensions=rep,sp selects the attributes (defaults to all of
+        them), ?rep_edges=25,50,75 overrides the bucket edges of an
+        attribute. Filters of the detail page are supported.
+        """
+        dimensions = request.query_params.get("dimensions")
+        dimensions = dimensions.split(",") if dimensions \
+            else list(DISTRIBUTION_EDGES)
+        if not set(dimensions) <= set(FILTER_DIMENSIONS):
+            raise ValidationError({"dimensions": "Must be a subset of {}.".format(
+                ", ".join(FILTER_DIMENSIONS))})
+
+        edges = {}
+        for dimension in dimensions:
+            edges[dimension] = DISTRIBUTION_EDGES[dimension]
+            param = f"{dimension}_edges"
+            if request.query_params.get(param):
+                edges[dimension] = [
+                    sanitize_filter_value(edge) for edge in
+                    request.query_params[param].split(",")
+                ]
+                if None in edges[dimension] or \
+                        len(edges[dimension]) > MAX_EDGES or \
+                        edges[dimension] != sorted(set(edges[dimension])):
+                    raise ValidationError({param: (
+                        f"An ascending, comma separated list of up to "
+                        f"{MAX_EDGES} integers.")})
+
+        try:
+            question = Question.objects.get(pk=pk)
+        except (Question.DoesNotExist, ValueError):
+            raise Http404
+
+        return Response({
+            "id": question.id,
+            "edges": edges,
+            "choices": voter_distributions(
+                question, edges, **get_filters(request.query_params)),
+        })
+
 
 class TeamView(ViewSet):
     def list(self, request, format=None):
         return Response(TEAM_MEMBERS)
 
+
+class LeaderboardView(ViewSet):
+    def list(self, request, format=None):
+        """Top pollers and voters. ?window=7d|30d|all and ?limit=N"""
+        window = request.query_params.get("window", "all")
+        if window not in WINDOWS:
+            raise ValidationError({"window": "Must be one of {}.".format(
+                ", ".join(WINDOWS))})
+        limit = sanitize_filter_value(request.query_params.get("limit")) or 5
+        limit = max(1, min(limit, MAX_LIMIT))
+
+        return Response({
+            "window": window,
+            "top_pollers": top_pollers(limit, window),
+            "top_voters": top_voters(limit, window),
+        })
+
+
+class BlockCacheView(ViewSet):
+    def list(self, request, format=None):
+        """Hits, misses and the hit ratio of the block cache."""
+        stats = cache_stats()
+        if stats is None:
+            raise Http404("The block cache is disabled.")
+        return Response(stats)
+
+
 class SponsorViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet):
     serializer_class = SponsorSerializer
     queryset = Sponsor.objects.all().order_by("-delegation_amount")
@@ -47,6 +192,7 @@ class SponsorViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet):
 class UserViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet):
     serializer_class = UserSerializer
     queryset = User.objects.all().exclude(is_superuser=True).order_by("-id")
+    pagination_class = KeysetPagination
     lookup_field = "username"
 
     def retrieve(self, request, *args, **kwargs):
@@ -58,6 +204,28 @@ class UserViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet):
 
         return Response(UserDetailSerializer(user).data)
 
+
+class BroadcastViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet):
+    """Confirmation status of the queued blockchain broadcasts."""
+    serializer_class = BroadcastSerializer
+    queryset = Broadcast.objects.all().order_by("-id")
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        """?username= and ?question= (id) filters."""
+        queryset = super().get_queryset()
+        if self.action != "list":
+            return queryset
+        if self.request.query_params.get("username"):
+            queryset = queryset.filter(
+                username=self.request.query_params["username"])
+        question_id = sanitize_filter_value(
+            self.request.query_params.get("question"))
+        if question_id:
+            queryset = queryset.filter(question_id=question_id)
+        return queryset
+
+
 class AuditView(APIView):
 
     queryset = VoteAudit.objects.all()
@@ -69,7 +237,9 @@ class AuditView(APIView):
                 username=request.query_params.get("username"),
                 permlink=request.query_params.get("permlink")
             )
-            vote_logs = VoteAudit.objects.filter(question=question)
+            vote_logs = VoteAudit.objects.filter(
+                question=question).select_related(
+                "voter").prefetch_related("choices")
         except (Question.DoesNotExist, VoteAudit.DoesNotExist):
             raise Http404
 
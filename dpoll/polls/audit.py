@@ -0,0 +1,161 @@
+"""
+Streaming audit exports of the polls.
+
+Every vote of a poll is listed with its blockchain reference (VoteAudit)
+and the stake attributes of the voter. Votes are read in keyset chunks and
+the audits of every chunk are fetched with a single query, so the exports
+run in constant memory regardless of the poll size.
+"""
+import csv
+import json
+
+from django.http import StreamingHttpResponse
+from django.utils.html import escape
+
+from .models import VoteAudit
+from .tally import Vote
+
+AUDIT_CHUNK_SIZE = 500
+
+AUDIT_FIELDS = (
+    "choice", "voter", "trx_id", "block_num", "reputation", "sp",
+    "post_count", "account_age")
+
+MISSING = "missing"
+
+
+def _audits_by_voter(question, usernames):
+    """Return username -> (trx_id, block_num) of the voters."""
+    audits = VoteAudit.objects.filter(
+        question=question, voter__username__in=usernames).order_by(
+        "id").values_list("voter__username", "trx_id", "block_id")
+    # the latest audit wins if a voter has more than one.
+    return {
+        username: (trx_id, block_num)
+        for username, trx_id, block_num in audits
+    }
+
+
+def audit_rows(question, voter_q=None, choice_ids=None, chunk_size=None):
+    """
+    Generate the audit rows of a poll, choice by choice.
+
+    :param question (Question): The poll
+    :param voter_q (Q): Voter filters, see tally.voter_filter.
+    :param choice_ids (iterable): Choices to include, in order. Defaults
+        to every choice of the poll.
+    :param chunk_size (int): Number of votes read in every query.
+        Defaults to AUDIT_CHUNK_SIZE.
+    :return (generator): dicts with the keys of AUDIT_FIELDS.
+    """
+    chunk_size = chunk_size or AUDIT_CHUNK_SIZE
+    votes = Vote.objects.filter(choice__question=question)
+    if voter_q:
+        votes = votes.filter(voter_q)
+    if choice_ids is None:
+        choice_ids = list(question.choices.order_by("id").values_list(
+            "id", flat=True))
+
+    for choice_id in choice_ids:
+        last_id = 0
+        while True:
+            chunk = list(votes.filter(
+                choice_id=choice_id, id__gt=last_id).order_by(
+                "id").values_list(
+                "id", "choice__text", "user__username", "user__reputation",
+                "user__sp", "user__post_count", "user__account_age",
+            )[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+
+            audits = _audits_by_voter(question, [row[2] for row in chunk])
+            for _, text, username, rep, sp, post_count, account_age in chunk:
+                trx_id, block_num = audits.get(username, (MISSING, MISSING))
+                yield {
+                    "choice": text,
+                    "voter": username,
+                    "trx_id": trx_id,
+                    "block_num": block_num,
+                    "reputation": round(float(rep), 2)
+                    if rep is not None else None,
+                    "sp": int(sp) if sp is not None else None,
+                    "post_count": post_count,
+                    "account_age": account_age,
+                }
+
+
+class Echo:
+    """A file-like object for csv.writer, returns the written line."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(AUDIT_FIELDS)
+    for row in rows:
+        yield writer.writerow([row[field] for field in AUDIT_FIELDS])
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+
+# column widths of the text table, the choice text is the last column.
+TEXT_COLUMNS = (
+    ("voter", "Voter", 16),
+    ("trx_id", "Transaction ID", 40),
+    ("block_num", "Block num", 10),
+    ("reputation", "Rep", 6),
+    ("sp", "SP", 12),
+    ("post_count", "Post Count", 10),
+    ("account_age", "Account Age", 11),
+    ("choice", "Choice", 0),
+)
+
+
+def _text_line(values):
+    return " | ".join(
+        str(value).ljust(width)
+        for value, (_, _, width) in zip(values, TEXT_COLUMNS)).rstrip()
+
+
+def text_lines(rows):
+    header = _text_line([title for _, title, _ in TEXT_COLUMNS])
+    yield "<pre>" + escape(header) + "\n"
+    yield "-" * len(header) + "\n"
+    for row in rows:
+        yield escape(_text_line([
+            "" if row[field] is None else row[field]
+            for field, _, _ in TEXT_COLUMNS
+        ])) + "\n"
+    yield "</pre>"
+
+
+EXPORT_FORMATS = {
+    "csv": (csv_lines, "text/csv", "csv"),
+    "ndjson": (ndjson_lines, "application/x-ndjson", "ndjson"),
+}
+
+
+def audit_response(question, export_format=None, voter_q=None,
+                   choice_ids=None):
+    """
+    Stream the audit of a poll.
+
+    :param export_format (str): "csv", "ndjson" or anything else for the
+        plain text table.
+    :return (StreamingHttpResponse)
+    """
+    rows = audit_rows(question, voter_q=voter_q, choice_ids=choice_ids)
+    if export_format not in EXPORT_FORMATS:
+        return StreamingHttpResponse(text_lines(rows))
+
+    lines, content_type, extension = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(lines(rows), content_type=content_type)
+    response["Content-Disposition"] = \
+        f'attachment; filename="{question.permlink}-audit.{extension}"'
+    return response
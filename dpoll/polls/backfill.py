@@ -0,0 +1,302 @@
+"""
+Parallel backfill of the polls and the votes from a range of blocks.
+
+The range is split into partitions, and a pool of workers fetches and
+parses them concurrently (see ingest.py). The partitions are merged into
+the database in block order with bulk inserts, after filtering out the
+invalid polls and the polls, users and votes which already exist, so a
+vote casted first on the chain wins like it does with the live ingester.
+A partition rejected by the database is applied operation by operation
+instead, skipping the bad ones.
+
+Every partition is merged in one transaction with its BlockCheckpoint,
+then its polls get their tallies, voter counts and caches refreshed. A
+restarted backfill skips the merged partitions.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import DatabaseError, IntegrityError, transaction
+from lightsteem.client import Client as LightsteemClient
+
+from .caching import bump_poll_version, bump_site_version
+from .blocks import get_blocks
+from .ingest import (
+    POLL, POLL_VOTE, apply_operation, parse_poll_op, poll_operations,
+)
+from .models import (
+    BlockCheckpoint, Choice, PollSnapshot, Question, User, VoteAudit,
+)
+from .tally import Vote, refresh_tallies
+from .voter_counts import refresh_voter_counts
+
+
+def partitions(start, end, size):
+    """Split the block range (inclusive) into (start, end) partitions."""
+    return [
+        (first, min(first + size - 1, end))
+        for first in range(start, end + 1, size)
+    ]
+
+
+def checkpoint_name(start, end):
+    return f"backfill:{start}-{end}"
+
+
+def merged_partitions(parts):
+    """:return (set): Partitions already merged by a previous run."""
+    names = {checkpoint_name(*part): part for part in parts}
+    return {
+        names[name] for name, block_num in BlockCheckpoint.objects.filter(
+            name__in=names).values_list("name", "block_num")
+        if block_num == names[name][1]
+    }
+
+
+def fetch_partition(nodes, start, end, batch_size):
+    """
+    Fetch and parse the poll operations of a partition. Runs in the
+    worker threads, with a client per partition since the clients are not
+    thread-safe.
+
+    :return (tuple): (polls, votes) as lists of (block number, trx id,
+        operation, json_metadata), in block order.
+    """
+    client = LightsteemClient(nodes=nodes)
+    polls, votes = [], []
+    for batch_start in range(start, end + 1, batch_size):
+        block_nums = range(batch_start, min(batch_start + batch_size, end + 1))
+        blocks = get_blocks(client, block_nums)
+        for block_num in block_nums:
+            for trx_id, content_type, op_value, json_metadata in \
+                    poll_operations(blocks[block_num]):
+                operation = (block_num, trx_id, op_value, json_metadata)
+                if content_type == POLL:
+                    polls.append(operation)
+                else:
+                    votes.append(operation)
+    return polls, votes
+
+
+def _question_ids(keys):
+    """(username, permlink) -> id of the polls."""
+    keys = set(keys)
+    rows = Question.objects.filter(
+        username__in={username for username, _ in keys},
+        permlink__in={permlink for _, permlink in keys}).values_list(
+        "id", "username", "permlink")
+    return {
+        (username, permlink): question_id
+        for question_id, username, permlink in rows
+        if (username, permlink) in keys
+    }
+
+
+def create_polls(polls):
+    """
+    Bulk insert the new valid polls and their choices.
+
+    :param polls (list): (block number, trx id, operation, json_metadata)
+    :return (set): Ids of the new polls.
+    """
+    parsed = {}
+    for _, _, op_value, json_metadata in polls:
+        poll = parse_poll_op(op_value, json_metadata)
+        if poll is not None:
+            fields, choices = poll
+            parsed.setdefault((fields["username"], fields["permlink"]), poll)
+
+    existing = _question_ids(list(parsed))
+    new = [key for key in parsed if key not in existing]
+    if not new:
+        return set()
+
+    Question.objects.bulk_create(
+        [Question(**parsed[key][0]) for key in new], batch_size=500)
+    question_ids = _question_ids(new)
+    Choice.objects.bulk_create([
+        Choice(question_id=question_ids[key], text=text)
+        for key in new for text in parsed[key][1]
+    ], batch_size=500)
+    return set(question_ids.values())
+
+
+def _user_ids(usernames):
+    """username -> id of the users, the missing ones are created."""
+    user_ids = dict(User.objects.filter(username__in=usernames).values_list(
+        "username", "id"))
+    new_users = []
+    for username in usernames:
+        if username not in user_ids:
+            user = User(username=username)
+            user.set_unusable_password()
+            new_users.append(user)
+    if new_users:
+        User.objects.bulk_create(new_users, batch_size=500)
+        user_ids.update(User.objects.filter(
+            username__in=[user.username for user in new_users]).values_list(
+            "username", "id"))
+    return user_ids
+
+
+def register_votes(votes):
+    """
+    Bulk insert the valid votes which are not registered yet, with the
+    validation of utils.register_vote_op. The first vote of a user on a
+    poll wins.
+
+    :param votes (list): (block number, trx id, operation, json_metadata)
+    :return (list): (question id, user id) of the new votes.
+    """
+    question_ids = _question_ids({
+        (op_value.get("parent_author"), op_value.get("parent_permlink"))
+        for _, _, op_value, _ in votes
+    })
+    choice_ids = {}
+    for choice_id, question_id, text in Choice.objects.filter(
+            question_id__in=question_ids.values()).values_list(
+            "id", "question_id", "text"):
+        choice_ids.setdefault(question_id, {})[text] = choice_id
+
+    valid = []
+    for block_num, trx_id, op_value, json_metadata in votes:
+        question_id = question_ids.get(
+            (op_value.get("parent_author"), op_value.get("parent_permlink")))
+        texts = json_metadata.get("votes")
+        if question_id is None or not isinstance(texts, list):
+            continue
+        selected = {
+            choice_ids[question_id][text] for text in texts
+            if isinstance(text, str) and text in choice_ids.get(question_id, {})
+        }
+        if selected and op_value.get("author"):
+            valid.append(
+                (question_id, op_value["author"], selected, block_num, trx_id))
+    if not valid:
+        return []
+
+    user_ids = _user_ids({username for _, username, _, _, _ in valid})
+    voted = set(VoteAudit.objects.filter(
+        question_id__in={question_id for question_id, *_ in valid},
+        voter_id__in=user_ids.values()).values_list("question_id", "voter_id"))
+    # votes registered before the audit log don't have a VoteAudit.
+    voted.update(Vote.objects.filter(
+        choice__question_id__in={question_id for question_id, *_ in valid},
+        user_id__in=user_ids.values()).values_list(
+        "choice__question_id", "user_id"))
+
+    new_votes = {}
+    for question_id, username, selected, block_num, trx_id in valid:
+        key = (question_id, user_ids[username])
+        if key not in voted and key not in new_votes:
+            new_votes[key] = (selected, block_num, trx_id)
+    if not new_votes:
+        return []
+
+    VoteAudit.objects.bulk_create([
+        VoteAudit(question_id=question_id, voter_id=user_id,
+                  block_id=block_num, trx_id=trx_id)
+        for (question_id, user_id), (_, block_num, trx_id)
+        in new_votes.items()
+    ], batch_size=500)
+    audit_ids = {
+        (question_id, user_id): audit_id
+        for audit_id, question_id, user_id in VoteAudit.objects.filter(
+            question_id__in={question_id for question_id, _ in new_votes},
+            voter_id__in={user_id for _, user_id in new_votes}).values_list(
+            "id", "question_id", "voter_id")
+        if (question_id, user_id) in new_votes
+    }
+    Vote.objects.bulk_create([
+        Vote(choice_id=choice_id, user_id=user_id)
+        for (_, user_id), (selected, _, _) in new_votes.items()
+        for choice_id in selected
+    ], batch_size=500)
+    VoteAudit.choices.through.objects.bulk_create([
+        VoteAudit.choices.through(
+            voteaudit_id=audit_ids[key], choice_id=choice_id)
+        for key, (selected, _, _) in new_votes.items()
+        for choice_id in selected
+    ], batch_size=500)
+    return list(new_votes)
+
+
+def refresh_polls(question_ids):
+    """Bulk inserts skip the signals, rebuild the derived data of the
+    polls instead."""
+    refresh_tallies(Choice.objects.filter(question_id__in=question_ids))
+    refresh_voter_counts(Question.objects.filter(pk__in=question_ids))
+    PollSnapshot.objects.filter(question_id__in=question_ids).delete()
+    for question_id in question_ids:
+        bump_poll_version(question_id)
+    bump_site_version()
+
+
+def _merge_partition(start, end, polls, votes):
+    with transaction.atomic():
+        new_polls = create_polls(polls)
+        new_votes = register_votes(votes)
+        question_ids = new_polls | {question_id for question_id, _ in new_votes}
+        if question_ids:
+            refresh_polls(question_ids)
+        BlockCheckpoint.objects.update_or_create(
+            name=checkpoint_name(start, end), defaults={"block_num": end})
+    return len(new_polls), len(new_votes)
+
+
+def _apply_partition(start, end, polls, votes):
+    counts = dict.fromkeys(["polls", "votes", "skipped"], 0)
+    with transaction.atomic():
+        for operations, content_type in ((polls, POLL), (votes, POLL_VOTE)):
+            for block_num, trx_id, op_value, json_metadata in operations:
+                apply_operation(block_num, trx_id, content_type, op_value,
+                                json_metadata, counts)
+        BlockCheckpoint.objects.update_or_create(
+            name=checkpoint_name(start, end), defaults={"block_num": end})
+    return counts["polls"], counts["votes"]
+
+
+def merge_partition(start, end, polls, votes):
+    """
+    Merge the parsed operations of a partition, and mark it as merged.
+
+    :return (tuple): (number of new polls, number of new votes)
+    """
+    try:
+        try:
+            return _merge_partition(start, end, polls, votes)
+        except IntegrityError:
+            # inserted meanwhile (e.g. by the live ingester), the second
+            # try filters them out.
+            return _merge_partition(start, end, polls, votes)
+    except DatabaseError:
+        # a value rejected by the database (e.g. a DataError), apply the
+        # operations one by one to skip the bad ones.
+        return _apply_partition(start, end, polls, votes)
+
+
+def backfill(nodes, start, end, partition_size=10000, workers=8,
+             batch_size=100):
+    """
+    Backfill the polls and the votes of the block range (inclusive).
+
+    :param nodes (list): RPC nodes
+    :return (generator): (partition, number of new polls, number of new
+        votes) after every merged partition.
+    """
+    parts = partitions(start, end, partition_size)
+    merged = merged_partitions(parts)
+    parts = [part for part in parts if part not in merged]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            (part, executor.submit(fetch_partition, nodes, *part, batch_size))
+            for part in parts
+        ]
+        try:
+            # merged in order, the workers keep fetching the next ones.
+            for part, future in futures:
+                polls, votes = future.result()
+                yield (part, *merge_partition(*part, polls, votes))
+        finally:
+            for _, future in futures:
+                future.cancel()
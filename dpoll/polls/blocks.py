@@ -0,0 +1,238 @@
+"""
+Block fetching with a local on-disk cache.
+
+Irreversible blocks never change, so every block read from the RPC nodes
+(the vote syncs, the ingester and the backfills) goes through a block
+cache stored in a SQLite file (BLOCK_CACHE_PATH). The cache keeps up to
+BLOCK_CACHE_SIZE blocks and evicts the least recently used ones. Blocks
+above the last irreversible block are never cached.
+
+Hits and misses are counted in memory by each process, see cache_stats.
+"""
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+from django.conf import settings
+
+
+class MissingBlock(Exception):
+    pass
+
+
+def block_number(block):
+    """The block number is encoded in the first 4 bytes of the block id."""
+    return int(block["block_id"][:8], 16)
+
+
+def irreversible_head(client):
+    return client.get_dynamic_global_properties()[
+        "last_irreversible_block_num"]
+
+
+class BlockCache:
+    """
+    LRU cache of the blocks in a SQLite file. Connections are per thread,
+    so a cache can be shared by the worker threads.
+
+    Reads never write to the file, so they don't wait for the write lock.
+    The hits and misses are counted in memory, per process. The LRU
+    touches of the reads are kept in memory and written in batches, with
+    the next write or every TOUCH_BATCH touches.
+
+    :param path (str): Path of the SQLite file
+    :param max_blocks (int): Number of blocks to keep
+    """
+    TOUCH_BATCH = 1000
+
+    def __init__(self, path, max_blocks):
+        self.path = path
+        self.max_blocks = max_blocks
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # block number -> last used, not written yet.
+        self.touches = {}
+        # number of the cached blocks, counted once and tracked by the
+        # inserts and the evictions of this process.
+        self.block_count = None
+
+    @property
+    def connection(self):
+        if not hasattr(self.local, "connection"):
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS blocks (block_num INTEGER "
+                "PRIMARY KEY, data BLOB NOT NULL, last_used REAL NOT NULL)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS blocks_last_used "
+                "ON blocks (last_used)")
+            connection.commit()
+            self.local.connection = connection
+        return self.local.connection
+
+    def _count(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM blocks").fetchone()[0]
+
+    def get_many(self, block_nums):
+        """
+        :param block_nums (list): Block numbers
+        :return (dict): Block number -> block, of the cached blocks.
+        """
+        if not block_nums:
+            return {}
+        placeholders = ",".join("?" * len(block_nums))
+        blocks = {
+            block_num: json.loads(zlib.decompress(data))
+            for block_num, data in self.connection.execute(
+                f"SELECT block_num, data FROM blocks "
+                f"WHERE block_num IN ({placeholders})", block_nums)
+        }
+        now = time.time()
+        with self.lock:
+            self.hits += len(blocks)
+            self.misses += len(block_nums) - len(blocks)
+            self.touches.update(dict.fromkeys(blocks, now))
+            flush = len(self.touches) >= self.TOUCH_BATCH
+        if flush:
+            with self.connection as connection:
+                self._write_touches(connection)
+        return blocks
+
+    def _write_touches(self, connection):
+        with self.lock:
+            touches, self.touches = self.touches, {}
+        connection.executemany(
+            "UPDATE blocks SET last_used = ? WHERE block_num = ?",
+            [(last_used, block_num)
+             for block_num, last_used in touches.items()])
+
+    def set_many(self, blocks):
+        """
+        Store the blocks, then evict the least recently used ones over the
+        limit, down to 90% of it. Blocks are irreversible, the cached ones
+        are kept as they are.
+
+        :param blocks (dict): Block number -> block
+        """
+        if not blocks:
+            return
+        now = time.time()
+        with self.connection as connection:
+            self._write_touches(connection)
+            inserted = connection.executemany(
+                "INSERT OR IGNORE INTO blocks VALUES (?, ?, ?)", [
+                    (block_num, zlib.compress(json.dumps(block).encode()),
+                     now)
+                    for block_num, block in blocks.items()
+                ]).rowcount
+            with self.lock:
+                if self.block_count is None:
+                    self.block_count = self._count()
+                else:
+                    self.block_count += inserted
+                over_limit = self.block_count > self.max_blocks
+            if over_limit:
+                # the other processes write to the same file, recount.
+                block_count = self._count()
+                keep = self.max_blocks - self.max_blocks // 10
+                excess = block_count - keep
+                if excess > 0:
+                    block_count -= connection.execute(
+                        "DELETE FROM blocks WHERE block_num IN (SELECT "
+                        "block_num FROM blocks ORDER BY last_used LIMIT ?)",
+                        [excess]).rowcount
+                with self.lock:
+                    self.block_count = block_count
+
+    def stats(self):
+        """Hits and misses are of this process."""
+        with self.lock:
+            stats = {"hits": self.hits, "misses": self.misses}
+        stats["blocks"] = self._count()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else None
+        stats["max_blocks"] = self.max_blocks
+        return stats
+
+
+_block_cache = None
+_block_cache_lock = threading.Lock()
+
+# the last irreversible block seen, blocks up to it can be cached.
+_irreversible_block = 0
+
+
+def get_block_cache():
+    """:return (BlockCache): The shared cache, None if it's disabled."""
+    global _block_cache
+    if not settings.BLOCK_CACHE_PATH:
+        return None
+    with _block_cache_lock:
+        if _block_cache is None or \
+                _block_cache.path != settings.BLOCK_CACHE_PATH:
+            _block_cache = BlockCache(
+                settings.BLOCK_CACHE_PATH, settings.BLOCK_CACHE_SIZE)
+    return _block_cache
+
+
+def _cacheable(client, blocks):
+    global _irreversible_block
+    if any(block_num > _irreversible_block for block_num in blocks):
+        _irreversible_block = irreversible_head(client)
+    return {
+        block_num: block for block_num, block in blocks.items()
+        if block_num <= _irreversible_block
+    }
+
+
+def get_blocks(client, block_nums, missing_ok=False):
+    """
+    Fetch the blocks through the block cache, the missing ones are
+    fetched with one batched RPC call.
+
+    :param client (lightsteem.client.Client)
+    :param block_nums (iterable): Block numbers
+    :param missing_ok (bool): Leave out the blocks not returned by the
+        node (e.g. invalid block numbers), instead of raising.
+    :raises MissingBlock: A block is not returned by the node.
+    :return (dict): Block number -> block
+    """
+    block_nums = list(dict.fromkeys(block_nums))
+    cache = get_block_cache()
+    blocks = cache.get_many(block_nums) if cache else {}
+
+    missing = [block_num for block_num in block_nums if block_num not in blocks]
+    if missing:
+        for block_num in missing:
+            client.get_block(block_num, batch=True)
+        # the responses of a batch are not necessarily in order.
+        fetched = {
+            block_number(block): block
+            for block in client.process_batch() if block
+        }
+        if cache and fetched:
+            cache.set_many(_cacheable(client, fetched))
+        blocks.update(fetched)
+
+    for block_num in block_nums:
+        if block_num not in blocks and not missing_ok:
+            raise MissingBlock(block_num)
+    return blocks
+
+
+def get_block(client, block_num):
+    """:return (dict): The block, None if the node doesn't return it."""
+    return get_blocks(client, [block_num], missing_ok=True).get(block_num)
+
+
+def cache_stats():
+    """:return (dict): Hits, misses and the hit ratio of the block cache in
+    this process, None if it's disabled."""
+    cache = get_block_cache()
+    return cache.stats() if cache else None
@@ -0,0 +1,300 @@
+"""
+Asynchronous broadcasting of the blockchain operations.
+
+The views record the operations of the new polls, poll edits and votes in
+the Broadcast outbox and return without waiting for the signer. The
+broadcast_outbox command sends the due broadcasts with the signer class of
+BROADCAST_SIGNER, and retries the failed attempts with an exponential
+backoff. Once a vote is broadcasted, its VoteAudit gets the block number
+and the transaction id.
+
+Votes and edits of a poll wait for the earlier pending poll and edit
+broadcasts of it, the chain would reject them.
+
+A broadcast rejected by the signer (or out of attempts) fails for good,
+and its local side is reverted: the vote is removed, the new poll is
+deleted, or the edited poll is restored with its choices and votes. The
+access tokens are kept until the broadcast is finished, for
+BROADCAST_TOKEN_TTL seconds at most. Broadcasts not sent by then fail.
+"""
+import json
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+from hivesigner.client import Client
+
+from .models import Broadcast, Choice, VoteAudit
+from .tally import Vote
+from .voter_counts import recount_voters
+
+
+class BroadcastRejected(Exception):
+    """The signer rejected the operations, retrying won't help."""
+
+
+class HiveSignerSigner:
+    """Signs and broadcasts the operations with HiveSigner, on behalf of
+    the user of the access token."""
+
+    def __init__(self, access_token):
+        self.client = Client(
+            access_token=access_token,
+            oauth_base_url="https://hivesigner.com/oauth2/",
+            sc2_api_base_url="https://hivesigner.com/api/")
+
+    def broadcast(self, operations):
+        """
+        :param operations (list): Operation structures
+        :raises BroadcastRejected: The signer rejected the operations.
+        :return (dict): The transaction, with block_num and id keys.
+        """
+        resp = self.client.broadcast(operations)
+        # HiveSigner sometimes returns 503.
+        # https://github.com/steemscript/steemconnect/issues/356
+        if not isinstance(resp, dict):
+            raise ValueError(f"Unexpected response from HiveSigner: {resp}")
+        if "error" in resp:
+            raise BroadcastRejected(
+                resp.get("error_description", resp["error"]))
+        return resp.get("result", {})
+
+
+class LocalSigner:
+    """A stand-in signer for the development and the tests. Nothing is
+    broadcasted, the transactions get made-up ids."""
+
+    def __init__(self, access_token):
+        self.access_token = access_token
+
+    def broadcast(self, operations):
+        return {"block_num": None, "id": uuid.uuid4().hex}
+
+
+def get_signer_class():
+    if not settings.BROADCAST_TO_BLOCKCHAIN:
+        return LocalSigner
+    return import_string(settings.BROADCAST_SIGNER)
+
+
+def enqueue(kind, question, username, access_token, operations,
+            vote_audit=None, previous=None):
+    """
+    Record the operations of a user to be broadcasted.
+
+    :param kind (str): One of Broadcast.KIND_CHOICES
+    :param question (Question): The poll created, edited or voted.
+    :param username (str): The user signing the operations
+    :param access_token (str): The HiveSigner token of the user
+    :param operations (list): Operation structures
+    :param vote_audit (VoteAudit): The audit of the vote, for votes.
+    :param previous (dict): The poll before the edit (see poll_state), for
+        edits.
+    :return (Broadcast)
+    """
+    return Broadcast.objects.create(
+        kind=kind,
+        question=question,
+        username=username,
+        access_token=access_token,
+        operations=json.dumps(operations),
+        vote_audit=vote_audit,
+        previous=json.dumps(previous) if previous is not None else None,
+    )
+
+
+def poll_state(question):
+    """
+    The local state of a poll, to restore it if its edit fails. Edits
+    replace the choices, and the votes on them with them.
+
+    :return (dict)
+    """
+    choices = {}
+    for choice_id, text in question.choices.order_by("id").values_list(
+            "id", "text"):
+        choices[choice_id] = {"text": text, "voters": [], "audits": []}
+    for choice_id, user_id in Vote.objects.filter(
+            choice_id__in=choices).values_list("choice_id", "user_id"):
+        choices[choice_id]["voters"].append(user_id)
+    for choice_id, audit_id in VoteAudit.choices.through.objects.filter(
+            choice_id__in=choices).values_list("choice_id", "voteaudit_id"):
+        choices[choice_id]["audits"].append(audit_id)
+    return {
+        "text": question.text,
+        "description": question.description,
+        "expire_at": question.expire_at.isoformat(),
+        "allow_multiple_choices": question.allow_multiple_choices,
+        "choices": list(choices.values()),
+    }
+
+
+def restore_poll_state(question, state):
+    """Restore a poll to a state returned by poll_state."""
+    question.text = state["text"]
+    question.description = state["description"]
+    question.expire_at = parse_datetime(state["expire_at"])
+    question.allow_multiple_choices = state["allow_multiple_choices"]
+    question.save()
+
+    question.choices.all().delete()
+    # votes removed meanwhile (e.g. failed to broadcast) stay removed.
+    audit_ids = set(VoteAudit.objects.filter(question=question).values_list(
+        "id", flat=True))
+    for choice_state in state["choices"]:
+        choice = Choice.objects.create(
+            question=question, text=choice_state["text"])
+        voters = set(choice_state["voters"])
+        audits = audit_ids & set(choice_state["audits"])
+        if voters:
+            # through the m2m signals, to update the tallies and the counts.
+            choice.voted_users.add(*voters)
+        if audits:
+            choice.voteaudit_set.add(*audits)
+    # the votes deleted with the choices didn't go through the signals.
+    recount_voters([question.id])
+
+
+def retry_delay(attempts):
+    """Exponential backoff, in seconds, after the number of attempts."""
+    return settings.BROADCAST_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+def claim_due_broadcasts(limit):
+    """
+    Pick the due broadcasts and lease them, so the other workers skip
+    them until the lease expires. Broadcasts queued after a pending poll
+    or edit broadcast of the same poll are not due yet.
+
+    :return (list): Broadcasts
+    """
+    now = timezone.now()
+    blocking = Broadcast.objects.filter(
+        question_id=OuterRef("question_id"),
+        kind__in=[Broadcast.POLL, Broadcast.EDIT],
+        status=Broadcast.PENDING,
+        id__lt=OuterRef("id"),
+    )
+    with transaction.atomic():
+        ids = list(Broadcast.objects.select_for_update(
+            skip_locked=True).annotate(blocked=Exists(blocking)).filter(
+            status=Broadcast.PENDING, next_attempt_at__lte=now,
+            blocked=False).order_by(
+            "next_attempt_at", "id").values_list("id", flat=True)[:limit])
+        Broadcast.objects.filter(pk__in=ids).update(
+            next_attempt_at=now + timedelta(
+                seconds=settings.BROADCAST_LEASE))
+    return list(Broadcast.objects.filter(pk__in=ids).order_by("id"))
+
+
+def _revert(broadcast):
+    """Undo the local side of a failed broadcast."""
+    if broadcast.kind == Broadcast.VOTE and broadcast.vote_audit_id:
+        vote_audit = VoteAudit.objects.select_related("voter").get(
+            pk=broadcast.vote_audit_id)
+        vote_audit.voter.choice_set.remove(*vote_audit.choices.all())
+        vote_audit.delete()
+    elif broadcast.kind == Broadcast.POLL and broadcast.question_id:
+        question = broadcast.question
+        # the poll is not on the chain, neither are the votes on it.
+        Broadcast.objects.filter(
+            question=question, status=Broadcast.PENDING).update(
+            status=Broadcast.FAILED, access_token=None,
+            last_error="The poll failed to broadcast.")
+        question_id = question.pk
+        # the audits date the votes deleted with the poll, see
+        # leaderboards.vote_activity.
+        question.delete()
+        VoteAudit.objects.filter(question_id=question_id).delete()
+    elif broadcast.kind == Broadcast.EDIT and broadcast.previous and \
+            broadcast.question_id:
+        # a later edit overrides this one on the chain.
+        if not Broadcast.objects.filter(
+                question_id=broadcast.question_id, kind=Broadcast.EDIT,
+                id__gt=broadcast.id).exclude(
+                status=Broadcast.FAILED).exists():
+            restore_poll_state(
+                broadcast.question, json.loads(broadcast.previous))
+
+
+def _fail(broadcast, error):
+    with transaction.atomic():
+        broadcast.status = Broadcast.FAILED
+        broadcast.access_token = None
+        broadcast.last_error = error
+        broadcast.save()
+        _revert(broadcast)
+    return broadcast.status
+
+
+def token_expiry():
+    """Broadcasts created before that can't use their tokens anymore."""
+    return timezone.now() - timedelta(seconds=settings.BROADCAST_TOKEN_TTL)
+
+
+def send(broadcast, signer_class=None):
+    """
+    Broadcast the operations once.
+
+    :param broadcast (Broadcast): A pending broadcast
+    :param signer_class: Defaults to get_signer_class().
+    :return (str): The new status of the broadcast.
+    """
+    if broadcast.created_at < token_expiry():
+        return _fail(broadcast, "The access token expired.")
+
+    signer = (signer_class or get_signer_class())(broadcast.access_token)
+    broadcast.attempts += 1
+    try:
+        result = signer.broadcast(json.loads(broadcast.operations))
+    except BroadcastRejected as e:
+        error = str(e)
+        retry = False
+    except Exception as e:
+        # connection errors, timeouts and unexpected responses.
+        error = f"{type(e).__name__}: {e}"
+        retry = broadcast.attempts < settings.BROADCAST_MAX_ATTEMPTS
+    else:
+        with transaction.atomic():
+            broadcast.status = Broadcast.SENT
+            broadcast.block_num = result.get("block_num")
+            broadcast.trx_id = result.get("id")
+            broadcast.access_token = None
+            broadcast.last_error = None
+            broadcast.save()
+            if broadcast.vote_audit_id:
+                VoteAudit.objects.filter(pk=broadcast.vote_audit_id).update(
+                    block_id=broadcast.block_num, trx_id=broadcast.trx_id)
+        return broadcast.status
+
+    if retry:
+        broadcast.last_error = error
+        broadcast.next_attempt_at = timezone.now() + timedelta(
+            seconds=retry_delay(broadcast.attempts))
+        broadcast.save()
+        return broadcast.status
+
+    return _fail(broadcast, error)
+
+
+def process_outbox(limit=100, signer_class=None):
+    """
+    Send the due broadcasts.
+
+    :return (dict): Status -> number of broadcasts, after the attempt.
+    """
+    # the expired ones fail once they are due.
+    Broadcast.objects.filter(
+        status=Broadcast.PENDING, created_at__lt=token_expiry()).exclude(
+        access_token=None).update(access_token=None)
+
+    counts = dict.fromkeys(
+        [Broadcast.PENDING, Broadcast.SENT, Broadcast.FAILED], 0)
+    for broadcast in claim_due_broadcasts(limit):
+        counts[send(broadcast, signer_class=signer_class)] += 1
+    return counts
@@ -0,0 +1,219 @@
+"""
+Version based caching helpers.
+
+Cached values are keyed with version counters instead of being deleted
+explicitly. Writes bump the related counters, so the stale entries are
+never read again and expire on their own.
+
+The counters are bumped by the web workers and the management commands
+alike, so they need a cache shared by the processes (see CACHES). With a
+process-local cache, the results and the pages are not cached at all.
+Neither are they while the cache server is unavailable, a warning is
+logged instead.
+"""
+import hashlib
+import logging
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+# stakes, reputations and community memberships of the voters.
+ACCOUNTS_VERSION = "accounts"
+# polls, votes and promotions of the whole site.
+SITE_VERSION = "site"
+
+# query parameters changing the rendered pages.
+INDEX_PARAMS = ("order", "cursor")
+DETAIL_PARAMS = ("rep", "sp", "age", "post_count", "stake_based", "community")
+
+
+def is_shared_cache():
+    """:return (bool): The cache is shared by the processes."""
+    return not isinstance(caches["default"], LocMemCache)
+
+
+def fragment_timeout(cache_key):
+    """Timeout of the cached page fragments, 0 if they can't be cached.
+
+    :param cache_key (str): Key of the page, see index_cache_key.
+    """
+    if cache_key is None or not is_shared_cache():
+        return 0
+    return settings.PAGE_CACHE_TIMEOUT
+
+
+def _hashed(value):
+    # memcached keys can't have spaces or control characters.
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+def _version_key(name):
+    return f"dpoll:version:{name}"
+
+
+def get_version(name):
+    """:return (int): The version counter, None if the cache server is
+    unavailable."""
+    version = cache.get(_version_key(name))
+    if version is None:
+        # Start from the current time, instead of 1. A counter evicted
+        # from the cache shouldn't match the keys of its older values.
+        cache.add(_version_key(name), int(time.time() * 1000), None)
+        version = cache.get(_version_key(name))
+        if version is None:
+            logger.warning(
+                "The cache is unavailable, the %s version can't be read. "
+                "The results and the pages are not cached.", name)
+    return version
+
+
+def _versions(*names):
+    # None if any of them is unavailable.
+    versions = [get_version(name) for name in names]
+    return None if None in versions else ":".join(map(str, versions))
+
+
+def bump_version(name):
+    try:
+        cache.incr(_version_key(name))
+    except ValueError:
+        # the counter is not in the cache
+        get_version(name)
+
+
+def bump_version_on_commit(name):
+    """Bump the version after the current transaction is committed, so
+    the readers can't cache the old data with the new version."""
+    transaction.on_commit(lambda: bump_version(name))
+
+
+def poll_version_name(poll_id):
+    return f"poll:{poll_id}"
+
+
+def bump_poll_version(poll_id):
+    bump_version_on_commit(poll_version_name(poll_id))
+
+
+def bump_accounts_version():
+    bump_version_on_commit(ACCOUNTS_VERSION)
+
+
+def bump_site_version():
+    bump_version_on_commit(SITE_VERSION)
+
+
+def votes_summary_key(poll, filters):
+    """:return (str): The key, None if the cache is unavailable."""
+    versions = _versions(poll_version_name(poll.id), ACCOUNTS_VERSION)
+    if versions is None:
+        return None
+    return "dpoll:votes_summary:{}:{}:{}".format(
+        poll.id,
+        versions,
+        _hashed(":".join(f"{k}={filters[k]}" for k in sorted(filters))),
+    )
+
+
+def cached_votes_summary(poll, age=None, rep=None, post_count=None, sp=None,
+                         stake_based=False, sa_stake_based=False,
+                         community=None):
+    """
+    A cache layer on the top of Question.votes_summary.
+
+    Filter values are expected to be sanitized (see
+    utils.sanitize_filter_value) and falsy values mean "no filter", so
+    they are normalized to None in the cache key.
+    """
+    filters = {
+        "age": age or None,
+        "rep": rep or None,
+        "post_count": post_count or None,
+        "sp": sp or None,
+        "stake_based": bool(stake_based),
+        "sa_stake_based": bool(sa_stake_based),
+        "community": community or None,
+    }
+    key = is_shared_cache() and votes_summary_key(poll, filters)
+    if not key:
+        return poll.votes_summary(**filters)
+
+    summary = cache.get(key)
+    if summary is None:
+        summary = poll.votes_summary(**filters)
+        if poll.is_votable():
+            timeout = settings.VOTES_SUMMARY_CACHE_TIMEOUT
+        else:
+            # the voter set of the expired polls can't change anymore.
+            timeout = settings.EXPIRED_VOTES_SUMMARY_CACHE_TIMEOUT
+        cache.set(key, summary, timeout)
+    return summary
+
+
+def _canonical_params(query_params, names):
+    return "&".join(
+        f"{name}={query_params[name]}" for name in sorted(names)
+        if query_params.get(name))
+
+
+def index_cache_key(request):
+    """Key of the index page, also used as the key of its fragments.
+    None if the cache is unavailable."""
+    versions = _versions(SITE_VERSION, ACCOUNTS_VERSION)
+    if versions is None:
+        return None
+    return "index:{}:{}".format(
+        versions, _canonical_params(request.GET, INDEX_PARAMS))
+
+
+def detail_cache_key(request, poll_id):
+    """Key of the poll detail page, also used as the key of its
+    fragments. None if the cache is unavailable."""
+    versions = _versions(poll_version_name(poll_id), ACCOUNTS_VERSION)
+    if versions is None:
+        return None
+    return "detail:{}:{}:{}".format(
+        poll_id, versions, _canonical_params(request.GET, DETAIL_PARAMS))
+
+
+def cache_anonymous_page(key_func):
+    """
+    Cache the rendered pages of the anonymous users.
+
+    :param key_func: Called with the arguments of the view, returns the
+        cache key of the page or None to skip the cache.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            # pending messages are a part of the page.
+            if request.method != "GET" or request.user.is_authenticated or \
+                    len(get_messages(request)) or not is_shared_cache():
+                return view(request, *args, **kwargs)
+
+            key = key_func(request, *args, **kwargs)
+            if key is None:
+                return view(request, *args, **kwargs)
+            key = f"dpoll:page:{_hashed(key)}"
+
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                return HttpResponse(content, content_type=content_type)
+
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming \
+                    and not response.cookies:
+                cache.set(key, (response.content, response["Content-Type"]),
+                          settings.PAGE_CACHE_TIMEOUT)
+            return response
+        return wrapper
+    return decorator
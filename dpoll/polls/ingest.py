@@ -0,0 +1,191 @@
+"""
+Block stream ingester.
+
+Reads the blocks of the chain in order, and registers the polls and the
+votes casted outside of dPoll: comment operations with the poll and
+poll_vote content types. Votes are validated like the votes synced with
+web-api/sync/ (see utils.register_vote_op).
+
+Blocks are fetched through the block cache (see blocks.py), and every
+batch is applied in one transaction together with its BlockCheckpoint, so
+a restarted reader resumes right after the last applied block.
+"""
+import json
+import logging
+
+from dateutil.parser import parse
+from django.db import DatabaseError, transaction
+
+from base.utils import add_tz_info
+from .blocks import get_blocks
+from .models import BlockCheckpoint, Question
+from .utils import (
+    AlreadyVoted, InvalidVote, add_choices, poll_errors, register_vote_op,
+    remove_duplicates,
+)
+
+logger = logging.getLogger(__name__)
+
+POLL = "poll"
+POLL_VOTE = "poll_vote"
+
+INGESTER_CHECKPOINT = "ingester"
+
+
+def poll_operations(block):
+    """
+    Generate the comment operations of the polls and the votes in a block.
+
+    :return (generator): (trx_id, content type, operation, json_metadata)
+    """
+    for block_tx in block.get("transactions", []):
+        for op_type, op_value in block_tx.get("operations", []):
+            if op_type != "comment" or not op_value.get("json_metadata"):
+                continue
+            try:
+                json_metadata = json.loads(op_value["json_metadata"])
+            except ValueError:
+                continue
+            if not isinstance(json_metadata, dict):
+                continue
+            content_type = json_metadata.get("content_type")
+            if content_type in (POLL, POLL_VOTE):
+                yield (block_tx.get("transaction_id"), content_type, op_value,
+                       json_metadata)
+
+
+def parse_poll_op(poll_op, json_metadata):
+    """
+    Validate the comment operation of a poll, with the rules of the poll
+    form (see utils.poll_errors).
+
+    :param poll_op (dict): Value of the comment operation
+    :param json_metadata (dict): Parsed json_metadata of the comment
+    :return (tuple): (Question fields, choice texts), or None if it's not
+        a valid poll.
+    """
+    # polls are root posts, created with dPoll.
+    if poll_op.get("parent_author"):
+        return None
+    if not str(json_metadata.get("app", "")).startswith("dpoll/"):
+        return None
+
+    username, permlink = poll_op.get("author"), poll_op.get("permlink")
+    if not isinstance(username, str) or not isinstance(permlink, str) or \
+            not username or len(username) > 255 or len(permlink) > 255:
+        return None
+
+    question = json_metadata.get("question")
+    choices = json_metadata.get("choices")
+    description = json_metadata.get("description") or None
+    if not question or not isinstance(question, str) or \
+            not isinstance(choices, list) or \
+            not all(isinstance(choice, str) for choice in choices) or \
+            not isinstance(description, (str, type(None))):
+        return None
+    choices = [choice for choice in remove_duplicates(choices) if choice]
+    if poll_errors(question, choices):
+        return None
+
+    try:
+        expire_at = add_tz_info(parse(json_metadata.get("expire_at")))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+    fields = {
+        "text": question,
+        "description": description,
+        "username": username,
+        "permlink": permlink,
+        "expire_at": expire_at,
+        "allow_multiple_choices": str(
+            json_metadata.get("allow_multiple_choices")) == "True",
+    }
+    return fields, choices
+
+
+def register_poll_op(poll_op, json_metadata):
+    """
+    Register a poll created outside of dPoll. Polls already in the
+    database (including the ones created on dPoll) are skipped.
+
+    :return (Question): The new poll or None.
+    """
+    poll = parse_poll_op(poll_op, json_metadata)
+    if poll is None:
+        return None
+    fields, choices = poll
+    if Question.objects.filter(
+            username=fields["username"],
+            permlink=fields["permlink"]).exists():
+        return None
+
+    question = Question.objects.create(**fields)
+    add_choices(question, choices)
+    return question
+
+
+def apply_operation(block_num, trx_id, content_type, op_value,
+                    json_metadata, counts):
+    """
+    Register a poll or a vote in a savepoint, so a bad operation doesn't
+    break the transaction of its batch.
+
+    :param counts (dict): Incremented per polls, votes and skipped votes.
+    """
+    try:
+        with transaction.atomic():
+            if content_type == POLL:
+                registered = "polls" if register_poll_op(
+                    op_value, json_metadata) else None
+            else:
+                register_vote_op(op_value, block_num, trx_id)
+                registered = "votes"
+    except (InvalidVote, AlreadyVoted):
+        counts["skipped"] += 1
+    except DatabaseError:
+        logger.exception(
+            "Skipped the %s operation of %s in block %s.",
+            content_type, trx_id, block_num)
+        counts["skipped"] += 1
+    else:
+        if registered:
+            counts[registered] += 1
+
+
+def apply_block(block_num, block, counts):
+    """
+    Register the polls and the votes of a block.
+
+    :param counts (dict): Incremented per polls, votes and skipped votes.
+    """
+    for operation in poll_operations(block):
+        apply_operation(block_num, *operation, counts)
+
+
+def get_checkpoint(name=INGESTER_CHECKPOINT):
+    """:return (int): The last applied block, None if there is not any."""
+    return BlockCheckpoint.objects.filter(name=name).values_list(
+        "block_num", flat=True).first()
+
+
+def ingest_blocks(client, start, end, batch_size=50,
+                  checkpoint=INGESTER_CHECKPOINT):
+    """
+    Apply the blocks from start to end (inclusive), in batches.
+
+    :param client (lightsteem.client.Client)
+    :param checkpoint (str): Name of the BlockCheckpoint, updated with
+        every batch.
+    :return (generator): (last applied block, counts) after every batch.
+    """
+    for batch_start in range(start, end + 1, batch_size):
+        block_nums = range(batch_start, min(batch_start + batch_size, end + 1))
+        blocks = get_blocks(client, block_nums)
+        counts = dict.fromkeys(["polls", "votes", "skipped"], 0)
+        with transaction.atomic():
+            for block_num in block_nums:
+                apply_block(block_num, blocks[block_num], counts)
+            BlockCheckpoint.objects.update_or_create(
+                name=checkpoint, defaults={"block_num": block_nums[-1]})
+        yield block_nums[-1], counts
@@ -0,0 +1,159 @@
+"""
+Leaderboards of the poll creators and the voters.
+
+Counts are read from the DailyActivity rollup, so a windowed leaderboard
+only scans the rollup rows of the window, and the user attributes come
+from the same query. The rollup is kept in sync by the signals, and
+rebuild_activity recomputes the same rows from scratch.
+"""
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import (
+    Count, DateTimeField, F, OuterRef, Subquery, Sum,
+)
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import DailyActivity, Question, User, VoteAudit
+from .tally import Vote
+
+# window name -> number of days, None for all time.
+WINDOWS = {
+    "7d": 7,
+    "30d": 30,
+    "all": None,
+}
+
+MAX_LIMIT = 100
+
+
+def _leaderboard(field, limit=5, window="all"):
+    activity = DailyActivity.objects.all()
+    if WINDOWS[window]:
+        activity = activity.filter(
+            day__gt=timezone.localdate() - timedelta(days=WINDOWS[window]))
+
+    return list(activity.values(
+        username=F("user__username"),
+        reputation=F("user__reputation"),
+        sp=F("user__sp"),
+    ).annotate(count=Sum(field)).filter(count__gt=0).order_by(
+        "-count", "username")[:limit])
+
+
+def top_pollers(limit=5, window="all"):
+    """
+    :param limit (int): Number of users
+    :param window (str): One of the WINDOWS
+    :return (list): dicts of username, reputation, sp and count.
+    """
+    return _leaderboard("poll_count", limit, window)
+
+
+def top_voters(limit=5, window="all"):
+    """See top_pollers."""
+    return _leaderboard("vote_count", limit, window)
+
+
+def _increment(user_id, field, count, day):
+    updated = DailyActivity.objects.filter(user_id=user_id, day=day).update(
+        **{field: F(field) + count})
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            DailyActivity.objects.create(
+                user_id=user_id, day=day, **{field: count})
+    except IntegrityError:
+        # created by a concurrent request
+        DailyActivity.objects.filter(user_id=user_id, day=day).update(
+            **{field: F(field) + count})
+
+
+def _record(field, activity, removed):
+    for (user_id, day), count in activity.items():
+        _increment(user_id, field, -count if removed else count, day)
+    if removed:
+        # rebuild_activity doesn't create the empty rows either.
+        for user_id, day in activity:
+            DailyActivity.objects.filter(
+                user_id=user_id, day=day, poll_count=0, vote_count=0,
+            ).delete()
+
+
+def poll_activity(polls):
+    """
+    Count the polls by their authors and creation days.
+
+    :param polls (QuerySet): Questions
+    :return (dict): (user id, day) -> number of polls
+    """
+    rows = polls.annotate(
+        author_id=Subquery(User.objects.filter(
+            username=OuterRef("username")).values("pk")[:1]),
+    ).filter(author_id__isnull=False).values(
+        "author_id", day=TruncDate("created_at")).annotate(
+        count=Count("id")).order_by()
+    return {(row["author_id"], row["day"]): row["count"] for row in rows}
+
+
+def vote_activity(votes):
+    """
+    Count the votes by their voters and days. Votes are dated by their
+    VoteAudit, the votes without one by the creation day of their polls.
+
+    :param votes (QuerySet): Vote rows
+    :return (dict): (user id, day) -> number of votes
+    """
+    audited_at = VoteAudit.objects.filter(
+        question_id=OuterRef("choice__question_id"),
+        voter_id=OuterRef("user_id")).values("created_at")[:1]
+    rows = votes.annotate(day=TruncDate(Coalesce(
+        Subquery(audited_at, output_field=DateTimeField()),
+        "choice__question__created_at",
+    ))).values("user_id", "day").annotate(count=Count("id")).order_by()
+    return {(row["user_id"], row["day"]): row["count"] for row in rows}
+
+
+def record_polls(activity, removed=False):
+    """
+    Count the polls in the rollups of their authors.
+
+    :param activity (dict): See poll_activity
+    :param removed (bool): Discount the polls, they are deleted.
+    """
+    _record("poll_count", activity, removed)
+
+
+def record_votes(activity, removed=False):
+    """
+    Count the votes in the rollups of the voters.
+
+    :param activity (dict): See vote_activity
+    :param removed (bool): Discount the votes, they are removed.
+    """
+    _record("vote_count", activity, removed)
+
+
+def rebuild_activity(batch_size=500):
+    """
+    Rebuild the rollup from the polls and the votes, dated the same way
+    the live updates date them.
+
+    :return (int): Number of rollup rows.
+    """
+    activity = {}
+    for key, count in poll_activity(Question.objects.all()).items():
+        activity.setdefault(key, [0, 0])[0] += count
+    for key, count in vote_activity(Vote.objects.all()).items():
+        activity.setdefault(key, [0, 0])[1] += count
+
+    with transaction.atomic():
+        DailyActivity.objects.all().delete()
+        DailyActivity.objects.bulk_create([
+            DailyActivity(user_id=user_id, day=day, poll_count=poll_count,
+                          vote_count=vote_count)
+            for (user_id, day), (poll_count, vote_count) in activity.items()
+        ], batch_size=batch_size)
+    return len(activity)
@@ -0,0 +1,53 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from polls.backfill import backfill
+from polls.leaderboards import rebuild_activity
+
+
+class Command(BaseCommand):
+    """A management command to backfill the polls and the votes of a
+    block range, e.g. to build a new replica. Partitions of the range are
+    fetched in parallel, and the merged ones are skipped on a rerun.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("start", type=int, help="First block")
+        parser.add_argument("end", type=int, help="Last block")
+        parser.add_argument(
+            "--partition-size", type=int, default=10000,
+            help="Blocks per partition. (default: 10000)")
+        parser.add_argument(
+            "--workers", type=int, default=8,
+            help="Number of partitions fetched in parallel. (default: 8)")
+        parser.add_argument(
+            "--batch-size", type=int, default=100,
+            help="Blocks per RPC batch. (default: 100)")
+        parser.add_argument(
+            "--nodes", nargs="+", default=settings.BLOCKCHAIN_NODES,
+            help="RPC nodes, a local node is recommended.")
+
+    def handle(self, *args, **options):
+        if options["end"] < options["start"]:
+            raise CommandError("end must be greater than or equal to start.")
+
+        started_at = time.time()
+        blocks = polls = votes = 0
+        for (first, last), new_polls, new_votes in backfill(
+                options["nodes"], options["start"], options["end"],
+                partition_size=options["partition_size"],
+                workers=options["workers"],
+                batch_size=options["batch_size"]):
+            blocks += last - first + 1
+            polls += new_polls
+            votes += new_votes
+            elapsed = time.time() - started_at
+            print(f"Blocks {first}-{last}: {new_polls} polls, "
+                  f"{new_votes} votes. ({blocks / elapsed:.0f} blocks/s)")
+
+        if polls or votes:
+            # bulk inserts skip the leaderboard rollup.
+            rebuild_activity()
+        print(f"{blocks} blocks backfilled, {polls} polls and {votes} votes "
+              f"registered.")
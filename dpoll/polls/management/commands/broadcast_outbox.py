@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+from polls.broadcasts import process_outbox
+
+
+class Command(BaseCommand):
+    """A management command to broadcast the queued blockchain operations
+    of the polls and the votes. Runs once, or forever with --loop.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit", type=int, default=100,
+            help="Maximum number of broadcasts per run. (default: 100)")
+        parser.add_argument(
+            "--loop", action="store_true",
+            help="Keep running, check the outbox every --interval seconds.")
+        parser.add_argument(
+            "--interval", type=float, default=1,
+            help="Seconds between the runs with --loop. (default: 1)")
+
+    def handle(self, *args, **options):
+        while True:
+            counts = process_outbox(limit=options["limit"])
+            if any(counts.values()):
+                print(f"{counts['sent']} sent, {counts['pending']} to retry, "
+                      f"{counts['failed']} failed.")
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
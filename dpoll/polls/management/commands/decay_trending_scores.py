@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from polls.trending import decay_scores
+
+
+class Command(BaseCommand):
+    """A management command to decay the trending scores of the polls.
+    Meant to run periodically, every --hours hours.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hours", type=float, default=1,
+            help="Hours elapsed since the last run. (default: 1)")
+
+    def handle(self, *args, **options):
+        decayed, reset = decay_scores(options["hours"])
+        print(f"{decayed} trending scores decayed, {reset} reset.")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from polls.models import Question
+from polls.snapshots import finalize_poll
+
+
+class Command(BaseCommand):
+    """A management command to write the result snapshots of the
+    expired polls.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild", action="store_true",
+            help="Rebuild the existing snapshots, too.")
+
+    def handle(self, *args, **options):
+        questions = Question.objects.filter(expire_at__lte=now())
+        if not options["rebuild"]:
+            questions = questions.filter(snapshot__isnull=True)
+        for question in questions.iterator():
+            snapshot = finalize_poll(question)
+            print(f"{question} finalized with "
+                  f"{snapshot.voter_count} voters.")
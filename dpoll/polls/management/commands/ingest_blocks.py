@@ -0,0 +1,56 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from lightsteem.client import Client as LightsteemClient
+from polls.blocks import irreversible_head
+from polls.ingest import get_checkpoint, ingest_blocks
+
+
+class Command(BaseCommand):
+    """A management command to follow the irreversible blocks and register
+    the polls and the votes casted on the blockchain. Resumes from the
+    last applied block.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--start", type=int,
+            help="First block to read, overrides the checkpoint. Defaults "
+                 "to the current irreversible block on the first run.")
+        parser.add_argument(
+            "--until", type=int,
+            help="Stop after the block, instead of following the chain.")
+        parser.add_argument(
+            "--batch-size", type=int, default=50,
+            help="Blocks per RPC batch and transaction. (default: 50)")
+        parser.add_argument(
+            "--interval", type=float, default=3,
+            help="Seconds to wait for the new blocks. (default: 3)")
+
+    def handle(self, *args, **options):
+        client = LightsteemClient(nodes=settings.BLOCKCHAIN_NODES)
+        next_block = options["start"]
+        if next_block is None:
+            checkpoint = get_checkpoint()
+            if checkpoint is None:
+                next_block = irreversible_head(client)
+            else:
+                next_block = checkpoint + 1
+        until = options["until"]
+
+        while until is None or next_block <= until:
+            head = irreversible_head(client)
+            if until is not None:
+                head = min(head, until)
+            if next_block > head:
+                time.sleep(options["interval"])
+                continue
+
+            for last_block, counts in ingest_blocks(
+                    client, next_block, head,
+                    batch_size=options["batch_size"]):
+                print(f"Block {last_block}: {counts['polls']} polls, "
+                      f"{counts['votes']} votes registered, "
+                      f"{counts['skipped']} votes skipped.")
+                next_block = last_block + 1
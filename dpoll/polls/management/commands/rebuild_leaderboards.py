@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from polls.leaderboards import rebuild_activity
+
+
+class Command(BaseCommand):
+    """A management command to rebuild the daily activity rollup of the
+    leaderboards (DailyActivity) from the polls and the votes.
+    """
+
+    def handle(self, *args, **options):
+        print(f"{rebuild_activity()} daily activity rows rebuilt.")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from polls.models import Choice
+from polls.tally import refresh_tallies
+
+
+class Command(BaseCommand):
+    """A management command to rebuild the materialized vote tallies
+    (ChoiceTally) from the votes.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--question", type=int, help="Only rebuild the tallies of a poll.")
+
+    def handle(self, *args, **options):
+        choices = Choice.objects.all()
+        if options["question"]:
+            choices = choices.filter(question_id=options["question"])
+        print(f"{refresh_tallies(choices)} choice tallies rebuilt.")
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from polls.caching import is_shared_cache
+from polls.stats import refresh_stats
+
+
+class Command(BaseCommand):
+    """A management command to recompute the homepage stats. Meant to run
+    periodically, more often than STATS_REFRESH_INTERVAL.
+    """
+
+    def handle(self, *args, **options):
+        if not is_shared_cache():
+            raise CommandError(
+                "The cache is process-local, the web processes can't see "
+                "the refreshed stats. Configure a shared cache in CACHES.")
+        stats = refresh_stats()
+        print(f"Stats refreshed. {stats['poll_count']} polls, "
+              f"{stats['vote_count']} votes, {stats['user_count']} users.")
@@ -4,7 +4,9 @@ from django.utils.timezone import now
 from lightsteem.client import Client as LightsteemClient
 from lightsteem.helpers.account import Account
 from lightsteem.helpers.amount import Amount
+from polls.caching import bump_accounts_version
 from polls.models import User
+from polls.tally import refresh_tallies
 
 from .utils import addTzInfo
 
@@ -45,3 +47,7 @@ class Command(BaseCommand):
                     steem_per_mvest=steem_per_mvest,
                     account_detail=account_detail,
                 )
+
+        # stakes are changed, rebuild the materialized tallies.
+        print(f"{refresh_tallies()} choice tallies refreshed.")
+        bump_accounts_version()
@@ -1,11 +1,45 @@
-from django.core.management.base import BaseCommand
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
 from polls.models import Question
+from polls.voter_counts import refresh_voter_counts
 
 
 class Command(BaseCommand):
+    """A management command to recalculate the voter counts of the polls
+    and fix the drifted ones.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            help="Only the polls created since the date. (YYYY-MM-DD)")
+        parser.add_argument(
+            "--active-only", action="store_true",
+            help="Only the open polls.")
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Report the drift without updating the counts.")
+
     def handle(self, *args, **options):
         questions = Question.objects.all()
-        for question in Question.objects.all():
-            question.update_voter_count()
-            question.save()
-            print(f"{question} updated.")
\ No newline at end of file
+        if options["since"]:
+            try:
+                since = datetime.strptime(options["since"], "%Y-%m-%d")
+            except ValueError:
+                raise CommandError("--since must be in YYYY-MM-DD format.")
+            questions = questions.filter(
+                created_at__gte=timezone.make_aware(since))
+        if options["active_only"]:
+            questions = questions.filter(
+                is_deleted=False, expire_at__gt=timezone.now())
+
+        drifted = refresh_voter_counts(
+            questions, dry_run=options["dry_run"])
+        for question_id, stored, actual in drifted:
+            print(f"Question {question_id}: {stored} -> {actual}")
+        if options["dry_run"]:
+            print(f"{len(drifted)} voter counts drifted.")
+        else:
+            print(f"{len(drifted)} voter counts updated.")
@@ -0,0 +1,65 @@
+# Generated by Django 2.1.1 on 2026-10-18 08:44
+
+import math
+from collections import defaultdict
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+SA_STAKE_LIMIT = 500000000
+
+
+def build_tallies(apps, schema_editor):
+    Choice = apps.get_model('polls', 'Choice')
+    ChoiceTally = apps.get_model('polls', 'ChoiceTally')
+    Vote = Choice.voted_users.through
+
+    totals = {
+        row['choice_id']: row for row in Vote.objects.values(
+            'choice_id').annotate(
+                voter_count=models.Count('user_id'),
+                sp=models.Sum('user__sp'),
+                sa_vests=models.Sum('user__vests', filter=models.Q(
+                    user__vests__lte=SA_STAKE_LIMIT))).order_by()
+    }
+    # stakes above the limit are capped, see models.sa_stake_based_voting_point
+    capped = defaultdict(float)
+    for choice_id, vests in Vote.objects.filter(
+            user__vests__gt=SA_STAKE_LIMIT).values_list(
+            'choice_id', 'user__vests'):
+        capped[choice_id] += SA_STAKE_LIMIT * (
+            math.log10(vests) - math.log10(SA_STAKE_LIMIT) + 1)
+
+    tallies = []
+    for choice_id, question_id in Choice.objects.values_list(
+            'id', 'question_id'):
+        total = totals.get(choice_id, {})
+        tallies.append(ChoiceTally(
+            choice_id=choice_id,
+            question_id=question_id,
+            voter_count=total.get('voter_count') or 0,
+            sp=total.get('sp') or 0,
+            sa_vests=float(total.get('sa_vests') or 0) + capped[choice_id],
+        ))
+    ChoiceTally.objects.bulk_create(tallies, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0018_user_vests'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChoiceTally',
+            fields=[
+                ('choice', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='tally', serialize=False, to='polls.Choice')),
+                ('voter_count', models.IntegerField(default=0)),
+                ('sp', models.DecimalField(decimal_places=4, default=0, max_digits=64)),
+                ('sa_vests', models.FloatField(default=0)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tallies', to='polls.Question')),
+            ],
+        ),
+        migrations.RunPython(build_tallies, migrations.RunPython.noop),
+    ]
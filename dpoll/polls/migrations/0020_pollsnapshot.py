@@ -0,0 +1,23 @@
+# Generated by Django 2.1.1 on 2026-10-18 08:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0019_choicetally'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PollSnapshot',
+            fields=[
+                ('question', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='polls.Question')),
+                ('voter_count', models.IntegerField(default=0)),
+                ('data', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 2.1.1 on 2026-10-18 08:55
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models.functions import TruncDate
+
+
+def build_activity(apps, schema_editor):
+    Question = apps.get_model('polls', 'Question')
+    Choice = apps.get_model('polls', 'Choice')
+    User = apps.get_model('polls', 'User')
+    DailyActivity = apps.get_model('polls', 'DailyActivity')
+    Vote = Choice.voted_users.through
+
+    user_ids = dict(User.objects.values_list('username', 'id'))
+    activity = {}
+    for row in Question.objects.values(
+            'username', day=TruncDate('created_at')).annotate(
+            count=models.Count('id')).order_by():
+        if row['username'] in user_ids:
+            key = (user_ids[row['username']], row['day'])
+            activity.setdefault(key, [0, 0])[0] += row['count']
+    # votes casted before the rollup are dated by their polls.
+    for row in Vote.objects.values(
+            'user_id', day=TruncDate('choice__question__created_at')).annotate(
+            count=models.Count('id')).order_by():
+        key = (row['user_id'], row['day'])
+        activity.setdefault(key, [0, 0])[1] += row['count']
+
+    DailyActivity.objects.bulk_create([
+        DailyActivity(user_id=user_id, day=day, poll_count=poll_count,
+                      vote_count=vote_count)
+        for (user_id, day), (poll_count, vote_count) in activity.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0020_pollsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_index=True)),
+                ('poll_count', models.IntegerField(default=0)),
+                ('vote_count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_activity', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'day')},
+            },
+        ),
+        migrations.RunPython(build_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.1.1 on 2026-10-18 08:58
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def build_trending_scores(apps, schema_editor):
+    """Start the open polls from their voter count, decayed by their age."""
+    Question = apps.get_model('polls', 'Question')
+    now = timezone.now()
+    for question in Question.objects.filter(
+            expire_at__gt=now, is_deleted=False, voter_count__gt=0):
+        hours = (now - question.created_at).total_seconds() / 3600
+        Question.objects.filter(pk=question.pk).update(
+            trending_score=question.voter_count * 0.5 ** (
+                hours / settings.TRENDING_HALF_LIFE_HOURS))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0021_dailyactivity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='trending_score',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['is_deleted', '-trending_score', '-id', 'expire_at'], name='polls_question_trending_idx'),
+        ),
+        migrations.RunPython(build_trending_scores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.1.1 on 2026-10-18 08:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0022_question_trending_score'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['is_deleted', '-id', 'expire_at'], name='polls_question_new_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['created_at'], name='polls_question_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['username', '-id'], name='polls_question_user_idx'),
+        ),
+        # Only a small part of the polls are promoted. Partial indexes are
+        # not supported by the Index class of Django 2.1.
+        # Statements are passed as lists, so Django 2.1 doesn't need sqlparse
+        # to split them.
+        migrations.RunSQL(
+            ['CREATE INDEX polls_question_promoted_idx ON polls_question '
+             '(is_deleted, promotion_amount DESC, id DESC) WHERE promotion_amount > 0'],
+            ['DROP INDEX polls_question_promoted_idx'],
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.1.1 on 2026-10-18 09:05
+
+from django.db import migrations, models
+
+
+def check_duplicate_audits(apps, schema_editor):
+    """
+    The audits are the blockchain references of the votes, so the
+    duplicates are not deleted here. They have to be resolved by hand
+    before the unique constraint can be added.
+    """
+    VoteAudit = apps.get_model('polls', 'VoteAudit')
+    duplicates = VoteAudit.objects.values('question_id', 'voter_id').annotate(
+        count=models.Count('id')).filter(count__gt=1).order_by()
+    duplicates = {
+        (row['question_id'], row['voter_id']): [] for row in duplicates}
+    if not duplicates:
+        return
+
+    for audit_id, question_id, voter_id in VoteAudit.objects.filter(
+            question_id__in={key[0] for key in duplicates},
+            voter_id__in={key[1] for key in duplicates}).order_by(
+            'id').values_list('id', 'question_id', 'voter_id'):
+        if (question_id, voter_id) in duplicates:
+            duplicates[(question_id, voter_id)].append(audit_id)
+    raise RuntimeError(
+        'A user can vote once per poll, but these votes have multiple '
+        'VoteAudit rows. Resolve them and run the migration again.\n' +
+        '\n'.join(
+            f'question {question_id}, voter {voter_id}: audits {audit_ids}'
+            for (question_id, voter_id), audit_ids in duplicates.items()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0023_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicate_audits, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='voteaudit',
+            unique_together={('question', 'voter')},
+        ),
+    ]
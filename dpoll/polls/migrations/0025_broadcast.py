@@ -0,0 +1,39 @@
+# Generated by Django 2.1.1 on 2026-10-18 09:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0024_voteaudit_unique_vote'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('poll', 'Poll'), ('edit', 'Poll edit'), ('vote', 'Vote')], max_length=8)),
+                ('username', models.CharField(max_length=255)),
+                ('operations', models.TextField()),
+                ('access_token', models.TextField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=8)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('block_num', models.BigIntegerField(blank=True, null=True)),
+                ('trx_id', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='broadcasts', to='polls.Question')),
+                ('vote_audit', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='polls.VoteAudit')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='broadcast',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='polls_broadcast_due_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.1.1 on 2026-10-18 09:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0026_blockcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcast',
+            name='previous',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='broadcast',
+            name='question',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='broadcasts', to='polls.Question'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.1 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0027_broadcast_previous'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='voteaudit',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+    ]
@@ -1,17 +1,15 @@
 import threading
-import copy
+import json
 import pytz
 import math
 from dateutil.parser import parse
 from django.contrib.auth.models import AbstractUser
 from django.db import models
-from django.http import HttpResponse
 from django.urls import reverse
 from django.utils import timezone
 from lightsteem.client import Client
 from lightsteem.helpers.account import Account
 from lightsteem.helpers.amount import Amount
-from prettytable import PrettyTable
 from communities.models import Community
 
 
@@ -129,6 +127,8 @@ class Question(models.Model):
                                 db_index=True)
     allow_multiple_choices = models.BooleanField(default=False)
     voter_count = models.IntegerField(default=0)
+    # voters weighted by recency, see trending.py
+    trending_score = models.FloatField(default=0)
     promotion_amount = models.FloatField(
         blank=True,
         null=True,
@@ -148,6 +148,23 @@ class Question(models.Model):
 
     class Meta:
         unique_together = ('username', 'permlink')
+        # ?order=promoted on the index page is served by the partial index
+        # polls_question_promoted_idx, see migration 0023.
+        indexes = [
+            # open polls on the index page, by new and by trending.
+            models.Index(
+                fields=['is_deleted', '-id', 'expire_at'],
+                name='polls_question_new_idx'),
+            models.Index(
+                fields=['is_deleted', '-trending_score', '-id', 'expire_at'],
+                name='polls_question_trending_idx'),
+            # polls_by_vote_count
+            models.Index(fields=['created_at'],
+                         name='polls_question_created_idx'),
+            # polls of a user on the profile page.
+            models.Index(fields=['username', '-id'],
+                         name='polls_question_user_idx'),
+        ]
 
     def is_votable(self):
         return self.expire_at > timezone.now()
@@ -158,129 +175,119 @@ class Question(models.Model):
             - Poll must be open.
             - Poll must not have any votes casted from other users.
         """
-        if not self.is_votable:
+        if not self.is_votable():
             return False
         votes = Choice.objects.filter(
             question=self).aggregate(votes=models.Count('voted_users'))
         return votes["votes"] == 0
 
+    def get_snapshot(self):
+        """
+        Return the result snapshot of an expired poll. Read only, the
+        snapshots are written by the finalize_polls command.
+        :return (PollSnapshot): The snapshot or None if the poll is open
+            or not finalized yet.
+        """
+        if self.is_votable():
+            return None
+        try:
+            return self.snapshot
+        except PollSnapshot.DoesNotExist:
+            return None
+
     def update_voter_count(self):
         """
         Update a Question object's voter count with the registered voters.
         Discards multiple votes from the same vote caster.
         :return (Question): self
         """
-        voters = []
-        for choice in self.choices.all():
-            voters += choice.voted_users.values_list('username', flat=True)
-        self.voter_count = len(list(set(voters)))
+        from .voter_counts import count_voters
+        self.voter_count = count_voters([self.pk]).get(self.pk, 0)
         return self
 
     def votes_summary(self, age=None, rep=None, post_count=None, sp=None,
                       stake_based=False, sa_stake_based=False, community=None):
+        from . import snapshots, vectorized_tally
+        from .results import ChoiceResult
+        from .tally import voter_filter, tally_votes, voters_by_choice
+
         filter_exists = bool(rep or sp or age or post_count or community)
-        choices = list(self.choices.all())
 
-        community_members = []
-        community_filter_active = community or False
+        community_obj = None
         if community:
             try:
                 # Check if the community really exists
-                # In case it doesn't return an empty list for the community
-                # members.
-                community_members = Community.objects.get(
-                    name=community).member_list
+                # In case it doesn't, community filter is not applied.
+                community_obj = Community.objects.get(name=community)
             except Community.DoesNotExist:
-                community_filter_active = False
+                pass
+
+        snapshot = self.get_snapshot()
+        if snapshot:
+            # expired polls are served from their snapshots.
+            choices, tallies, voters = snapshots.tally_votes(
+                snapshot, rep, age, post_count, sp,
+                community_members=community_obj and community_obj.member_set,
+                filter_exists=filter_exists)
+        elif filter_exists and vectorized_tally.should_vectorize(self):
+            # large polls, load the voters once and filter them in numpy.
+            tallies, voters = vectorized_tally.tally_votes(
+                self, rep, age, post_count, sp,
+                community_members=community_obj and community_obj.member_set)
+        else:
+            voter_q = None
+            if filter_exists:
+                # memberships are joined with a subquery on the index.
+                voter_q = voter_filter(
+                    rep, age, post_count, sp,
+                    community_members=community_obj and
+                    community_obj.member_usernames())
+
+            # per-choice totals and voters, one query each.
+            tallies = tally_votes(self, voter_q)
+            voters = voters_by_choice(self, voter_q)
+
+        if not snapshot:
+            choices = list(self.choices.values_list("id", "text"))
 
         # Calculate vote count
         # if the query includes filters, then exclude the non-eligible votes.
-        if filter_exists:
-            all_votes = int(sum(
-                [c.filtered_vote_count(
-                    rep, age, post_count, sp,
-                    stake_based=stake_based,
-                    sa_stake_based=sa_stake_based,
-                    community=community_members,
-                    community_filter_active=community_filter_active) for c in
-                 choices]))
-        else:
-            if stake_based:
-                # @todo: fetch this from SQL query, directly.
-                all_votes = 0
-                for c in choices:
-                    for u in c.voted_users.all():
-                        all_votes += sa_stake_based_voting_point(u.vests)
-            elif sa_stake_based:
-                all_votes = 0
-                for c in choices:
-                    for u in c.voted_users.all():
-                        all_votes += sa_stake_based_voting_point(u.vests)
-            else:
-                all_votes = sum([c.votes for c in choices])
-        choice_list = []
+        vote_counts = {}
+        for choice_id, tally in tallies.items():
+            vote_counts[choice_id] = tally.value(
+                stake_based=stake_based, sa_stake_based=sa_stake_based)
+            if filter_exists:
+                vote_counts[choice_id] = int(vote_counts[choice_id])
+        all_votes = sum(vote_counts.values())
+
+        choice_list_ordered = []
         choices_selected = 0
-        for choice in choices:
-            choice_data = choice
-            if choice.votes:
-                choice_data = choice_data.inject_stats(
-                    filter_exists, rep, age, post_count, sp, all_votes,
-                    stake_based=stake_based, sa_stake_based=sa_stake_based,
-                    community=community_members,
-                    community_filter_active=community_filter_active
-                )
+        for choice_id, text in choices:
+            result = ChoiceResult(choice_id, text)
+            if choice_id in tallies:
+                result.vote_count = vote_counts[choice_id]
+                result.voters = voters[choice_id]
+                result.voter_count = len(result.voters)
+                if result.vote_count:
+                    result.percent = round(
+                        100 * result.vote_count / all_votes, 2)
                 choices_selected += 1
-            else:
-                choice_data.percent = 0
-            choice_list.append(choice_data)
-        choice_list_ordered = copy.deepcopy(choice_list)
-        choice_list.sort(key=lambda x: x.percent, reverse=True)
+            choice_list_ordered.append(result)
+        choice_list = sorted(
+            choice_list_ordered, key=lambda x: x.percent, reverse=True)
         return choice_list, choice_list_ordered, choices_selected,\
                filter_exists, all_votes
 
-    def audit_response(self, choice_list):
-        data = PrettyTable()
-        data.field_names = [
-            "Choice", "Voter", "Transaction ID", "Block num",
-            "Rep", "SP", "Post Count", "Account Age"]
-        for choice in choice_list:
-            if hasattr(choice, 'voters'):
-                for user in choice.voters:
-                    rep = round(user.reputation, 2)
-                    sp = int(user.sp)
-
-                    try:
-                        audit = VoteAudit.objects.get(
-                            question=self,
-                            voter=user,
-                        )
-                        data.add_row(
-                            [
-                                choice.text,
-                                user.username,
-                                audit.trx_id,
-                                audit.block_id,
-                                rep,
-                                sp,
-                                user.post_count,
-                                user.account_age
-                            ]
-                        )
-                    except VoteAudit.DoesNotExist:
-                        data.add_row(
-                            [
-                                choice.text,
-                                user.username,
-                                'missing',
-                                'missing',
-                                rep,
-                                sp,
-                                user.post_count,
-                                user.account_age
-                            ]
-                        )
-
-        return HttpResponse(f"<pre>{data}</pre>")
+    def audit_response(self, export_format=None, voter_q=None):
+        """
+        Stream the votes of the poll with their blockchain references.
+
+        :param export_format (str): "csv", "ndjson" or None for a text table
+        :param voter_q (Q): Voter filters, see tally.voter_filter.
+        :return (StreamingHttpResponse)
+        """
+        from .audit import audit_response
+        return audit_response(self, export_format, voter_q=voter_q)
 
 
 class Choice(models.Model):
@@ -296,90 +303,85 @@ class Choice(models.Model):
     def filtered_vote_count(self, rep, account_age, post_count, sp,
                             return_users=False, stake_based=False, sa_stake_based=False,
                             community=None, community_filter_active=False):
+        from .tally import voter_filter, tally_votes, voters_by_choice
 
-        filtered_user_count = 0
-        filtered_users = []
-        total_stake_in_sp = 0
-        total_sa_stake_in_vests = 0
-        for user in self.voted_users.all().order_by("-sp"):
-            if community_filter_active:
-                if user.username not in community:
-                    continue
-
-            if rep:
-                try:
-                    rep = int(rep)
-                    if user.reputation < rep:
-                        continue
-                except ValueError:
-                    pass
-
-            if account_age:
-                try:
-                    account_age = int(account_age)
-                    if user.account_age < account_age:
-                        continue
-                except ValueError:
-                    pass
-            if post_count:
-                if isinstance(post_count, int):
-                    if user.post_count < post_count:
-                        continue
-            if sp:
-                try:
-                    if user.sp < int(sp):
-                        continue
-                except ValueError:
-                    pass
-            filtered_user_count += 1
-            total_stake_in_sp += user.sp
-            total_sa_stake_in_vests += sa_stake_based_voting_point(user.vests)
-            filtered_users.append(user)
-
-        if sa_stake_based:
-            returned_data = int(total_sa_stake_in_vests)
-        elif stake_based:
-            returned_data = int(total_stake_in_sp)
-        else:
-            returned_data = filtered_user_count
+        voter_q = voter_filter(
+            rep, account_age, post_count, sp,
+            community_members=community if community_filter_active else None)
+        tally = tally_votes(self.question, voter_q, choice=self).get(self.id)
+        returned_data = 0
+        if tally:
+            returned_data = int(tally.value(
+                stake_based=stake_based, sa_stake_based=sa_stake_based))
 
         if return_users:
+            filtered_users = voters_by_choice(
+                self.question, voter_q, choice=self)[self.id]
             return returned_data, filtered_users
         return returned_data
 
-    def inject_stats(self, filter_exists, rep, age, post_count, sp, all_votes,
-                     stake_based=False, sa_stake_based=False, community=None,
-                     community_filter_active=False):
-        if filter_exists:
-            self.vote_count, self.voters = self. \
-                filtered_vote_count(
-                    rep, age, post_count, sp, return_users=True,
-                    stake_based=stake_based, sa_stake_based=sa_stake_based, community=community,
-                    community_filter_active=community_filter_active
-            )
-            if self.vote_count == 0:
-                self.percent = 0
-            else:
-                self.percent = round(
-                    100 * self.vote_count / all_votes, 2)
-            self.voter_count = len(self.voters)
-        else:
-            self.voter_count = self.voted_users.count()
-            if stake_based:
-                self.vote_count = sum([u.sp for u in self.voted_users.all()])
-            elif sa_stake_based:
-                self.vote_count = sum(
-                    [sa_stake_based_voting_point(u.vests) for u in self.voted_users.all()])
-            else:
-                self.vote_count = self.votes
-            self.percent = round(
-                100 * self.vote_count / all_votes, 2)
-            self.voters = self.voted_users.all().order_by("-sp")
+    def __str__(self):
+        return self.text
 
-        return self
+
+class ChoiceTally(models.Model):
+    """Materialized vote totals of a Choice.
+
+    Kept up to date by the m2m_changed signal of Choice.voted_users and
+    rebuilt with the rebuild_tallies management command.
+    """
+    choice = models.OneToOneField(Choice, on_delete=models.CASCADE,
+                                  primary_key=True, related_name="tally")
+    question = models.ForeignKey(Question, on_delete=models.CASCADE,
+                                 related_name="tallies")
+    voter_count = models.IntegerField(default=0)
+    sp = models.DecimalField(max_digits=64, decimal_places=4, default=0)
+    sa_vests = models.FloatField(default=0)
 
     def __str__(self):
-        return self.text
+        return f"{self.choice}: {self.voter_count}"
+
+
+class PollSnapshot(models.Model):
+    """Frozen results of an expired poll.
+
+    Holds the choices, the voters of every choice and their stake
+    attributes as a JSON document, see snapshots.build_snapshot_data.
+    """
+    question = models.OneToOneField(Question, on_delete=models.CASCADE,
+                                    primary_key=True, related_name="snapshot")
+    voter_count = models.IntegerField(default=0)
+    data = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def payload(self):
+        if not hasattr(self, "_payload"):
+            self._payload = json.loads(self.data)
+        return self._payload
+
+    def __str__(self):
+        return str(self.question)
+
+
+class DailyActivity(models.Model):
+    """Daily rollup of the polls created and the votes casted by a user.
+
+    Backs the windowed leaderboards, see leaderboards.py. Votes are dated
+    by the day of their VoteAudit, the votes without one by the creation
+    day of their polls.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name="daily_activity")
+    day = models.DateField(db_index=True)
+    poll_count = models.IntegerField(default=0)
+    vote_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'day')
+
+    def __str__(self):
+        return f"{self.user} - {self.day}"
 
 
 class PromotionTransaction(models.Model):
@@ -400,3 +402,77 @@ class VoteAudit(models.Model):
     voter = models.ForeignKey(User, on_delete=models.DO_NOTHING)
     block_id = models.BigIntegerField(blank=True, null=True)
     trx_id = models.TextField(blank=True, null=True)
+    # empty for the audits created before it existed.
+    created_at = models.DateTimeField(auto_now_add=True, null=True)
+
+    class Meta:
+        # a user can vote once per poll.
+        unique_together = ("question", "voter")
+
+
+class Broadcast(models.Model):
+    """Outbox of the blockchain operations signed on behalf of the users.
+
+    The views record the operations and return, the broadcast_outbox
+    command sends them with retries, see broadcasts.py.
+    """
+    POLL = "poll"
+    EDIT = "edit"
+    VOTE = "vote"
+    KIND_CHOICES = (
+        (POLL, "Poll"),
+        (EDIT, "Poll edit"),
+        (VOTE, "Vote"),
+    )
+
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (SENT, "Sent"),
+        (FAILED, "Failed"),
+    )
+
+    kind = models.CharField(max_length=8, choices=KIND_CHOICES)
+    username = models.CharField(max_length=255)
+    # kept when a poll failed to broadcast is deleted.
+    question = models.ForeignKey(Question, on_delete=models.SET_NULL,
+                                 blank=True, null=True,
+                                 related_name="broadcasts")
+    vote_audit = models.ForeignKey(VoteAudit, on_delete=models.SET_NULL,
+                                   blank=True, null=True)
+    operations = models.TextField()
+    # the poll before the edit (json), restored if the edit fails.
+    previous = models.TextField(blank=True, null=True)
+    # cleared once the broadcast is finished, see BROADCAST_TOKEN_TTL.
+    access_token = models.TextField(blank=True, null=True)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES,
+                              default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+    block_num = models.BigIntegerField(blank=True, null=True)
+    trx_id = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.kind} by {self.username} ({self.status})"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'],
+                         name='polls_broadcast_due_idx'),
+        ]
+
+
+class BlockCheckpoint(models.Model):
+    """The last block processed by a block stream reader, see ingest.py.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    block_num = models.BigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.block_num}"
@@ -0,0 +1,185 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are selected with a WHERE clause on the ordering columns of the
+last (or first) row of the current page, instead of an OFFSET, and the
+total count is not calculated. The last ordering field must be unique
+(e.g. -id) and none of them can be NULL.
+"""
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(values, reverse=False):
+    data = json.dumps({"v": values, "r": reverse}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """:return (tuple): (ordering values, reverse)"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return list(data["v"]), bool(data["r"])
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise InvalidCursor(cursor)
+
+
+def keyset_filter(ordering, values, reverse=False):
+    """
+    Build the Q object selecting the rows after the values, in the
+    ordering. e.g. ("-voter_count", "-id") and (5, 42) selects
+    voter_count < 5 OR (voter_count = 5 AND id < 42).
+
+    :param reverse (bool): Select the rows before the values, instead.
+    """
+    q = Q()
+    for i, field in enumerate(ordering):
+        name = field.lstrip("-")
+        descending = field.startswith("-") != reverse
+        condition = Q(**{f"{name}__{'lt' if descending else 'gt'}": values[i]})
+        for previous_field, value in zip(ordering[:i], values[:i]):
+            condition &= Q(**{previous_field.lstrip("-"): value})
+        q |= condition
+    return q
+
+
+def _reversed_ordering(ordering):
+    return [
+        field[1:] if field.startswith("-") else f"-{field}"
+        for field in ordering
+    ]
+
+
+class KeysetPage:
+    """A page of objects with the cursors of its neighbours."""
+
+    def __init__(self, object_list, ordering, has_next, has_previous):
+        self.object_list = object_list
+        self.ordering = ordering
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def _cursor(self, obj, reverse):
+        return encode_cursor([
+            getattr(obj, field.lstrip("-")) for field in self.ordering
+        ], reverse)
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            return self._cursor(self.object_list[-1], reverse=False)
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return self._cursor(self.object_list[0], reverse=True)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    :param queryset (QuerySet): An ordered queryset
+    :param page_size (int): Number of objects per page
+    """
+
+    def __init__(self, queryset, page_size):
+        self.queryset = queryset
+        self.ordering = list(queryset.query.order_by)
+        self.page_size = page_size
+
+    def get_page(self, cursor=None):
+        """
+        :param cursor (str): Cursor of the page, None for the first page.
+        :raises InvalidCursor: The cursor is not one of this ordering.
+        :return (KeysetPage)
+        """
+        queryset, reverse = self.queryset, False
+        if cursor:
+            values, reverse = decode_cursor(cursor)
+            if len(values) != len(self.ordering):
+                raise InvalidCursor(cursor)
+            try:
+                queryset = queryset.filter(
+                    keyset_filter(self.ordering, values, reverse))
+            except (TypeError, ValueError, ValidationError):
+                # values of the wrong type for the ordering fields.
+                raise InvalidCursor(cursor)
+        if reverse:
+            queryset = queryset.order_by(*_reversed_ordering(self.ordering))
+
+        # fetch one more object to see if there are more pages.
+        object_list = list(queryset[:self.page_size + 1])
+        has_more = len(object_list) > self.page_size
+        object_list = object_list[:self.page_size]
+        if reverse:
+            object_list.reverse()
+            return KeysetPage(object_list, self.ordering, has_next=True,
+                              has_previous=has_more)
+        return KeysetPage(object_list, self.ordering, has_next=has_more,
+                          has_previous=bool(cursor))
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination for the REST API, follows the ordering of the view's
+    queryset. ?cursor= selects the page, ?page_size= overrides the page
+    size and ?with_count=1 adds the total count to the response.
+    """
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return api_settings.PAGE_SIZE
+        return max(1, min(page_size, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.count = None
+        if request.query_params.get("with_count") == "1":
+            self.count = queryset.count()
+        paginator = KeysetPaginator(queryset, self.get_page_size(request))
+        try:
+            self.page = paginator.get_page(
+                request.query_params.get(self.cursor_query_param))
+        except InvalidCursor:
+            raise NotFound("Invalid cursor.")
+        return list(self.page)
+
+    def _link(self, cursor):
+        if cursor is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param,
+            cursor)
+
+    def get_paginated_response(self, data):
+        response = {
+            "next": self._link(self.page.next_cursor),
+            "previous": self._link(self.page.previous_cursor),
+            "results": data,
+        }
+        if self.count is not None:
+            response["count"] = self.count
+        return Response(response)
@@ -0,0 +1,65 @@
+"""
+Lightweight result records of the polls.
+
+Question.votes_summary returns these instead of the model instances, so
+the results are cheap to build, cache and order.
+"""
+from .models import sa_stake_based_voting_point
+
+VOTER_FIELDS = (
+    "username", "reputation", "sp", "vests", "post_count", "account_age")
+
+
+class VoterResult:
+    """Stake attributes of a voter."""
+
+    __slots__ = VOTER_FIELDS
+
+    def __init__(self, username, reputation, sp, vests, post_count,
+                 account_age):
+        self.username = username
+        self.reputation = reputation
+        self.sp = sp
+        self.vests = vests
+        self.post_count = post_count
+        self.account_age = account_age
+
+    @property
+    def sa_effective_vests(self):
+        return sa_stake_based_voting_point(self.vests)
+
+    def passes(self, rep=None, age=None, post_count=None, sp=None,
+               community_members=None):
+        """Python counterpart of tally.voter_filter, NULL values never
+        pass an active filter."""
+        filters = [
+            (rep, self.reputation),
+            (age, self.account_age),
+            (sp, self.sp),
+        ]
+        if isinstance(post_count, int):
+            filters.append((post_count, self.post_count))
+        for threshold, value in filters:
+            if threshold and (value is None or value < threshold):
+                return False
+        if community_members is not None:
+            return self.username in community_members
+        return True
+
+
+class ChoiceResult:
+    """Result of a choice on the poll detail page."""
+
+    __slots__ = (
+        "id", "text", "vote_count", "percent", "voter_count", "voters")
+
+    def __init__(self, id, text, vote_count=0, percent=0, voters=None):
+        self.id = id
+        self.text = text
+        self.vote_count = vote_count
+        self.percent = percent
+        self.voters = voters or []
+        self.voter_count = len(self.voters)
+
+    def __str__(self):
+        return self.text
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from .models import Question, Choice, User
+from .models import Broadcast, Question, Choice, ChoiceTally, User
 from sponsors.models import Sponsor
 
 
@@ -10,8 +10,15 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ['username']
 
 
+class ChoiceTallySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChoiceTally
+        fields = ['voter_count', 'sp', 'sa_vests']
+
+
 class ChoiceSerializer(serializers.ModelSerializer):
     voted_users = UserSerializer(many=True)
+    tally = ChoiceTallySerializer(read_only=True)
 
     class Meta:
         model = Choice
@@ -27,6 +34,15 @@ class QuestionSerializer(serializers.ModelSerializer):
         model = Question
         fields = '__all__'
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        snapshot = instance.get_snapshot()
+        if snapshot:
+            # expired polls are served from their snapshots.
+            from .snapshots import api_choices
+            data["choices"] = api_choices(snapshot)
+        return data
+
 
 class SponsorSerializer(serializers.ModelSerializer):
     class Meta:
@@ -70,3 +86,11 @@ class UserDetailSerializer(UserSerializer):
             'question_count',
             'choice_count',
         ]
+
+
+class BroadcastSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Broadcast
+        fields = ['id', 'kind', 'username', 'question', 'status', 'attempts',
+                  'next_attempt_at', 'last_error', 'block_num', 'trx_id',
+                  'created_at', 'updated_at']
@@ -1,15 +1,180 @@
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete,
+)
 
-from .models import Choice
+from communities.models import Community
+from .caching import (
+    bump_accounts_version, bump_poll_version, bump_site_version,
+)
+from .leaderboards import (
+    poll_activity, record_polls, record_votes, vote_activity,
+)
+from .models import Choice, ChoiceTally, PollSnapshot, Question
+from .tally import Vote, apply_votes, refresh_tallies
+from .voter_counts import recount_voters, record_votes as record_voters
 
-def update_voter_count(sender, instance, **kwargs):
-    """Whenever a new vote is added, recalculate the Question.voter_count
-    and update the total.
 
-    :param sender: Signal sendera
-    :param instance: Choice instance
+def update_voter_count(sender, instance, action, reverse, pk_set,
+                       **kwargs):
+    """Keep Question.voter_count (and the trending scores) in sync with the
+    votes. The changes are applied once per transaction, on commit.
+
+    :param sender: Signal sender
+    :param instance: Choice instance, or User instance if it's a reverse
+        relation change.
     """
-    instance.question.update_voter_count()
-    instance.question.save()
+    if action == "post_clear":
+        if reverse:
+            choice_ids = getattr(instance, "_cleared_choice_ids", [])
+            recount_voters(set(Choice.objects.filter(
+                pk__in=choice_ids).values_list("question_id", flat=True)))
+        else:
+            recount_voters([instance.question_id])
+    elif action in ["post_add", "post_remove"] and pk_set:
+        if reverse:
+            choice_ids, user_ids = pk_set, [instance.pk]
+        else:
+            choice_ids, user_ids = [instance.pk], pk_set
+        record_voters(choice_ids, user_ids, removed=action == "post_remove")
+
+
+def update_choice_tallies(sender, instance, action, reverse, pk_set,
+                          **kwargs):
+    """Keep the materialized ChoiceTally rows in sync with the votes.
+
+    Runs in the same transaction with the voted_users change.
+
+    :param sender: Signal sender
+    :param instance: Choice instance, or User instance if it's a reverse
+        relation change.
+    """
+    if action == "pre_clear" and reverse:
+        # pk_set is not available on clear, remember the choices.
+        instance._cleared_choice_ids = list(
+            instance.choice_set.values_list("pk", flat=True))
+    elif action == "post_clear":
+        if reverse:
+            choice_ids = getattr(instance, "_cleared_choice_ids", [])
+        else:
+            choice_ids = [instance.pk]
+        refresh_tallies(Choice.objects.filter(pk__in=choice_ids))
+    elif action in ["post_add", "post_remove"] and pk_set:
+        if reverse:
+            choice_ids, user_ids = pk_set, [instance.pk]
+        else:
+            choice_ids, user_ids = [instance.pk], pk_set
+        apply_votes(choice_ids, user_ids, removed=action == "post_remove")
+
+
+def create_choice_tally(sender, instance, created, **kwargs):
+    """Every choice starts with an empty tally."""
+    if created:
+        ChoiceTally.objects.get_or_create(
+            choice=instance, defaults={"question_id": instance.question_id})
+
+
+def invalidate_vote_caches(sender, instance, action, reverse, pk_set,
+                           **kwargs):
+    """Bump the cache version and discard the result snapshot of the polls
+    whenever their votes change."""
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        question_ids = {instance.question_id}
+    else:
+        choices = Choice.objects.all()
+        if action != "post_clear":
+            choices = choices.filter(pk__in=pk_set or [])
+        else:
+            choices = choices.filter(pk__in=getattr(
+                instance, "_cleared_choice_ids", []))
+        question_ids = set(choices.values_list("question_id", flat=True))
+
+    PollSnapshot.objects.filter(question_id__in=question_ids).delete()
+    for question_id in question_ids:
+        bump_poll_version(question_id)
+    bump_site_version()
+
+
+def invalidate_poll_caches(sender, instance, **kwargs):
+    """Question and Choice edits (including the promotions) change the
+    results of the poll, and the listings."""
+    if isinstance(instance, Question):
+        bump_poll_version(instance.pk)
+    else:
+        bump_poll_version(instance.question_id)
+    bump_site_version()
+
+
+def record_vote_activity(sender, instance, action, reverse, pk_set,
+                         **kwargs):
+    """Keep the daily leaderboard rollup in sync with the votes. The
+    removed votes are counted before they are removed, to discount them
+    from the days they are counted in.
+
+    :param sender: Signal sender
+    :param instance: Choice instance, or User instance if it's a reverse
+        relation change.
+    """
+    if reverse:
+        votes = Vote.objects.filter(user_id=instance.pk)
+        if action != "pre_clear":
+            votes = votes.filter(choice_id__in=pk_set or [])
+    else:
+        votes = Vote.objects.filter(choice_id=instance.pk)
+        if action != "pre_clear":
+            votes = votes.filter(user_id__in=pk_set or [])
+
+    if action == "post_add":
+        record_votes(vote_activity(votes))
+    elif action in ["pre_remove", "pre_clear"]:
+        instance._removed_vote_activity = vote_activity(votes)
+    elif action in ["post_remove", "post_clear"]:
+        record_votes(instance.__dict__.pop("_removed_vote_activity", {}),
+                     removed=True)
+
+
+def record_poll_activity(sender, instance, created, **kwargs):
+    if created:
+        record_polls(poll_activity(Question.objects.filter(pk=instance.pk)))
+
+
+def count_deleted_activity(sender, instance, **kwargs):
+    """The votes on the deleted choices are deleted without the m2m
+    signals, count them (and the deleted polls) before the deletion."""
+    if isinstance(instance, Question):
+        instance._deleted_activity = poll_activity(
+            Question.objects.filter(pk=instance.pk))
+    else:
+        instance._deleted_activity = vote_activity(
+            Vote.objects.filter(choice_id=instance.pk))
+
+
+def discount_deleted_activity(sender, instance, **kwargs):
+    activity = instance.__dict__.pop("_deleted_activity", {})
+    if isinstance(instance, Question):
+        record_polls(activity, removed=True)
+    else:
+        record_votes(activity, removed=True)
+
+
+def invalidate_community_caches(sender, instance, **kwargs):
+    bump_accounts_version()
+
 
-m2m_changed.connect(update_voter_count, sender=Choice.voted_users.through)
\ No newline at end of file
+m2m_changed.connect(update_voter_count, sender=Choice.voted_users.through)
+m2m_changed.connect(update_choice_tallies, sender=Choice.voted_users.through)
+m2m_changed.connect(invalidate_vote_caches,
+                    sender=Choice.voted_users.through)
+m2m_changed.connect(record_vote_activity,
+                    sender=Choice.voted_users.through)
+post_save.connect(create_choice_tally, sender=Choice)
+post_save.connect(record_poll_activity, sender=Question)
+post_save.connect(invalidate_poll_caches, sender=Question)
+post_save.connect(invalidate_poll_caches, sender=Choice)
+post_delete.connect(invalidate_poll_caches, sender=Choice)
+pre_delete.connect(count_deleted_activity, sender=Question)
+pre_delete.connect(count_deleted_activity, sender=Choice)
+post_delete.connect(discount_deleted_activity, sender=Question)
+post_delete.connect(discount_deleted_activity, sender=Choice)
+post_save.connect(invalidate_community_caches, sender=Community)
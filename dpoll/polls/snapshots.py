@@ -0,0 +1,150 @@
+"""
+Result snapshots of the expired polls.
+
+Once a poll is expired, its voter set is fixed. The choices, the voters
+of every choice and their stake attributes are written into a compact
+JSON document (PollSnapshot) by the finalize_polls command, and the read
+paths serve the poll from it instead of joining the votes again. Until
+then, the expired polls are served from the votes like the open ones.
+"""
+import json
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+
+from .models import ChoiceTally, PollSnapshot
+from .results import VOTER_FIELDS, VoterResult
+from .serializers import ChoiceTallySerializer
+from .tally import Tally, Vote
+
+SNAPSHOT_VERSION = 1
+
+
+def _number(value):
+    return float(value) if value is not None else None
+
+
+def build_snapshot_data(question):
+    """Serialize the results of a poll into a JSON compatible dict."""
+    choices = list(question.choices.select_related("tally").order_by("id"))
+    votes = Vote.objects.filter(choice__question=question).select_related(
+        "user").order_by("-user__sp", "user_id")
+
+    voters, voter_index = [], {}
+    choice_voters = defaultdict(list)
+    for vote in votes:
+        user = vote.user
+        if user.pk not in voter_index:
+            voter_index[user.pk] = len(voters)
+            voters.append([
+                user.username,
+                _number(user.reputation),
+                _number(user.sp),
+                _number(user.vests),
+                user.post_count,
+                user.account_age,
+            ])
+        choice_voters[vote.choice_id].append(voter_index[user.pk])
+
+    return {
+        "version": SNAPSHOT_VERSION,
+        "voter_fields": VOTER_FIELDS,
+        "voters": voters,
+        "choices": [{
+            "id": choice.id,
+            "text": choice.text,
+            "voters": choice_voters[choice.id],
+            "tally": ChoiceTallySerializer(
+                getattr(choice, "tally", None) or ChoiceTally()).data,
+        } for choice in choices],
+    }
+
+
+def finalize_poll(question):
+    """
+    Write the result snapshot of an expired poll.
+
+    :return (PollSnapshot): The snapshot, or None if the poll is still
+        open.
+    """
+    if question.is_votable():
+        return None
+
+    data = build_snapshot_data(question)
+    snapshot = PollSnapshot(
+        question=question,
+        voter_count=len(data["voters"]),
+        data=json.dumps(data, separators=(",", ":")),
+    )
+    try:
+        with transaction.atomic():
+            PollSnapshot.objects.filter(question=question).delete()
+            snapshot.save()
+    except IntegrityError:
+        # finalized by a concurrent request
+        snapshot = PollSnapshot.objects.get(question=question)
+    question.snapshot = snapshot
+    return snapshot
+
+
+def get_voters(snapshot):
+    return [VoterResult(*voter) for voter in snapshot.payload["voters"]]
+
+
+def tally_votes(snapshot, rep=None, age=None, post_count=None, sp=None,
+                community_members=None, filter_exists=False):
+    """
+    Calculate the per-choice totals from a snapshot.
+
+    :return (tuple): (list of (choice id, text) pairs, Choice id -> Tally,
+        Choice id -> list of VoterResults)
+    """
+    if community_members is not None:
+        community_members = frozenset(community_members)
+    all_voters = get_voters(snapshot)
+    eligible = [
+        not filter_exists or voter.passes(
+            rep, age, post_count, sp, community_members=community_members)
+        for voter in all_voters
+    ]
+
+    choices, tallies, voters = [], {}, defaultdict(list)
+    for choice in snapshot.payload["choices"]:
+        choices.append((choice["id"], choice["text"]))
+        if not choice["voters"]:
+            continue
+
+        tally = Tally(voter_count=len(choice["voters"]))
+        for i in choice["voters"]:
+            if not eligible[i]:
+                continue
+            voter = all_voters[i]
+            tally.filtered_voter_count += 1
+            tally.sp += voter.sp or 0
+            if voter.vests is not None:
+                tally.sa_vests += voter.sa_effective_vests
+            voters[choice["id"]].append(voter)
+        tallies[choice["id"]] = tally
+
+    return choices, tallies, voters
+
+
+def choices_of(snapshot, username):
+    """Return the choice ids voted by the username."""
+    voters = snapshot.payload["voters"]
+    for i, voter in enumerate(voters):
+        if voter[0] == username:
+            return [choice["id"] for choice in snapshot.payload["choices"]
+                    if i in choice["voters"]]
+    return []
+
+
+def api_choices(snapshot):
+    """Return the choices in the format of serializers.ChoiceSerializer."""
+    voters = snapshot.payload["voters"]
+    return [{
+        "id": choice["id"],
+        "voted_users": [{"username": voters[i][0]} for i in choice["voters"]],
+        "tally": choice["tally"],
+        "text": choice["text"],
+    } for choice in snapshot.payload["choices"]]
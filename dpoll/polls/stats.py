@@ -0,0 +1,72 @@
+"""
+Site-wide statistics of the homepage.
+
+The stats are computed from full table counts and kept in the cache. They
+are refreshed with the refresh_stats management command, and when a
+request finds them older than STATS_REFRESH_INTERVAL. With
+STATS_STALE_WHILE_REVALIDATE, that request is served the stale stats and
+the recompute runs in a background thread.
+
+The stats are shared by the web workers and the refresh_stats command
+through the cache, which must be shared by the processes (see CACHES).
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from .leaderboards import top_pollers, top_voters
+from .models import Question, User
+from .tally import Vote
+
+STATS_KEY = "dpoll:stats"
+STATS_LOCK_KEY = "dpoll:stats:lock"
+STATS_LOCK_TIMEOUT = 60
+
+
+def compute_stats():
+    return {
+        "poll_count": Question.objects.all().count(),
+        "vote_count": Vote.objects.all().count(),
+        "user_count": User.objects.all().count(),
+        "top_dpollers": top_pollers(),
+        "top_voters": top_voters(),
+    }
+
+
+def refresh_stats():
+    """Recompute the stats and write them into the cache."""
+    stats = compute_stats()
+    cache.set(STATS_KEY, {"stats": stats, "computed_at": time.time()}, None)
+    return stats
+
+
+def _refresh_in_background():
+    # only one refresh at a time.
+    if not cache.add(STATS_LOCK_KEY, 1, STATS_LOCK_TIMEOUT):
+        return
+
+    def refresh():
+        try:
+            refresh_stats()
+        finally:
+            cache.delete(STATS_LOCK_KEY)
+            connection.close()
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def get_stats():
+    """Return the stats from the cache, refresh them if they are stale."""
+    cached = cache.get(STATS_KEY)
+    if cached is None:
+        return refresh_stats()
+
+    if time.time() - cached["computed_at"] > settings.STATS_REFRESH_INTERVAL:
+        if not settings.STATS_STALE_WHILE_REVALIDATE:
+            return refresh_stats()
+        _refresh_in_background()
+
+    return cached["stats"]
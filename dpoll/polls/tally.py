@@ -0,0 +1,232 @@
+"""
+SQL based vote tallying.
+
+Voter filters (reputation, account age, post count, SP and community
+membership) are translated into a WHERE clause on the Choice <-> User
+relation, so the per-choice totals of a poll are calculated in a single
+grouped query instead of loading every voter into Python. Only the stakes
+of the accounts above SA_STAKE_LIMIT are capped in Python.
+
+Unfiltered totals are served from the materialized ChoiceTally table.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+
+from .models import (
+    Choice, ChoiceTally, User, SA_STAKE_LIMIT, sa_stake_based_voting_point,
+)
+from .results import VOTER_FIELDS, VoterResult
+
+Vote = Choice.voted_users.through
+
+
+def capped_stakes(rows):
+    """
+    SA points of the accounts above SA_STAKE_LIMIT. The log cap is applied
+    in Python, there is no portable LOG in SQL and such accounts are few.
+    The stakes under the limit are summed in SQL as they are.
+
+    :param rows (iterable): (key, vests) pairs
+    :return (dict): Key -> total SA points
+    """
+    totals = defaultdict(float)
+    for key, vests in rows:
+        totals[key] += sa_stake_based_voting_point(vests)
+    return totals
+
+
+def voter_filter(rep=None, age=None, post_count=None, sp=None,
+                 community_members=None):
+    """
+    Build a Q object for the vote relation with the same semantics of the
+    filters on the detail page. A falsy filter value means "no filter".
+
+    :param community_members: An iterable of usernames, or a subquery of
+        them (see Community.member_usernames). None disables the community
+        filter.
+    :return (Q): Filter to apply on the Choice.voted_users relation.
+    """
+    q = Q()
+    if rep:
+        q &= Q(user__reputation__gte=rep)
+    if age:
+        q &= Q(user__account_age__gte=age)
+    if post_count and isinstance(post_count, int):
+        q &= Q(user__post_count__gte=post_count)
+    if sp:
+        q &= Q(user__sp__gte=sp)
+    if community_members is not None:
+        q &= Q(user__username__in=community_members)
+    return q
+
+
+class Tally:
+    """Per-choice totals of a poll."""
+
+    __slots__ = ("voter_count", "filtered_voter_count", "sp", "sa_vests")
+
+    def __init__(self, voter_count=0, filtered_voter_count=0, sp=0,
+                 sa_vests=0):
+        self.voter_count = voter_count
+        self.filtered_voter_count = filtered_voter_count
+        self.sp = sp or 0
+        self.sa_vests = sa_vests or 0
+
+    def value(self, stake_based=False, sa_stake_based=False):
+        """Return the vote weight for the selected result layout."""
+        if sa_stake_based:
+            return self.sa_vests
+        elif stake_based:
+            return self.sp
+        return self.filtered_voter_count
+
+
+def _aggregate_votes(votes, voter_q=None):
+    # aggregates can't take an empty filter
+    aggregate_filter = {"filter": voter_q} if voter_q else {}
+    uncapped_q = Q(user__vests__lte=SA_STAKE_LIMIT)
+    rows = votes.values("choice_id").annotate(
+        voter_count=Count("user_id"),
+        filtered_voter_count=Count("user_id", **aggregate_filter),
+        sp=Sum("user__sp", **aggregate_filter),
+        sa_vests=Sum("user__vests", filter=uncapped_q & (voter_q or Q())),
+    ).order_by()
+
+    capped = votes.filter(user__vests__gt=SA_STAKE_LIMIT)
+    if voter_q:
+        capped = capped.filter(voter_q)
+    capped = capped_stakes(capped.values_list("choice_id", "user__vests"))
+
+    return {
+        row["choice_id"]: Tally(
+            voter_count=row["voter_count"],
+            filtered_voter_count=row["filtered_voter_count"],
+            sp=row["sp"],
+            sa_vests=float(row["sa_vests"] or 0) + capped[row["choice_id"]],
+        ) for row in rows
+    }
+
+
+def tally_votes(question, voter_q=None, choice=None):
+    """
+    Calculate the per-choice totals of a poll.
+
+    Unfiltered totals of a poll are read from the ChoiceTally table,
+    filtered ones are calculated in one grouped query.
+
+    :param question (Question): The poll
+    :param voter_q (Q): Voter filters, see voter_filter.
+    :param choice (Choice): Optionally, limit the tally to a single choice.
+    :return (dict): Choice id -> Tally. Choices without any votes
+        are not included.
+    """
+    if not voter_q and choice is None:
+        tallies = ChoiceTally.objects.filter(
+            question=question, voter_count__gt=0)
+        return {
+            t.choice_id: Tally(
+                voter_count=t.voter_count,
+                filtered_voter_count=t.voter_count,
+                sp=t.sp,
+                sa_vests=t.sa_vests,
+            ) for t in tallies
+        }
+
+    votes = Vote.objects.filter(choice__question=question)
+    if choice is not None:
+        votes = votes.filter(choice=choice)
+    return _aggregate_votes(votes, voter_q)
+
+
+def voters_by_choice(question, voter_q=None, choice=None):
+    """
+    Fetch the (filtered) voters of a poll in one query.
+
+    :return (dict): Choice id -> list of VoterResults, ordered by SP.
+    """
+    votes = Vote.objects.filter(choice__question=question)
+    if choice is not None:
+        votes = votes.filter(choice=choice)
+    if voter_q:
+        votes = votes.filter(voter_q)
+
+    voters = defaultdict(list)
+    rows = votes.order_by("-user__sp").values_list(
+        "choice_id", *[f"user__{field}" for field in VOTER_FIELDS])
+    for choice_id, *voter in rows:
+        voters[choice_id].append(VoterResult(*voter))
+    return voters
+
+
+def refresh_tallies(choices=None, chunk_size=500):
+    """
+    (Re)build the materialized tallies of the choices from the votes.
+
+    :param choices (QuerySet): Choices to refresh. Defaults to all choices.
+    :return (int): Number of refreshed choices.
+    """
+    if choices is None:
+        choices = Choice.objects.all()
+    choices = list(choices.values_list("id", "question_id").order_by("id"))
+
+    for i in range(0, len(choices), chunk_size):
+        chunk = choices[i:i + chunk_size]
+        choice_ids = [choice_id for choice_id, _ in chunk]
+        with transaction.atomic():
+            totals = _aggregate_votes(
+                Vote.objects.filter(choice_id__in=choice_ids))
+            tallies = []
+            for choice_id, question_id in chunk:
+                total = totals.get(choice_id, Tally())
+                tallies.append(ChoiceTally(
+                    choice_id=choice_id,
+                    question_id=question_id,
+                    voter_count=total.voter_count,
+                    sp=total.sp,
+                    sa_vests=total.sa_vests,
+                ))
+            ChoiceTally.objects.filter(choice_id__in=choice_ids).delete()
+            ChoiceTally.objects.bulk_create(tallies)
+
+    return len(choices)
+
+
+def apply_votes(choice_ids, user_ids, removed=False):
+    """
+    Add the stakes of the users to the materialized tallies of the choices
+    with atomic increments.
+
+    Removed votes are not subtracted, the stakes of the users may have
+    changed since they voted. The tallies of the choices are recalculated
+    instead.
+
+    :param choice_ids (iterable): Choice ids
+    :param user_ids (iterable): Ids of the users voted for every choice.
+    :param removed (bool): The votes are removed.
+    """
+    choice_ids, user_ids = set(choice_ids), set(user_ids)
+    if removed:
+        refresh_tallies(Choice.objects.filter(pk__in=choice_ids))
+        return
+
+    users = User.objects.filter(pk__in=user_ids)
+    stakes = users.aggregate(
+        sp=Sum("sp"),
+        sa_vests=Sum("vests", filter=Q(vests__lte=SA_STAKE_LIMIT)),
+    )
+    sa_vests = float(stakes["sa_vests"] or 0) + sum(capped_stakes(
+        users.filter(vests__gt=SA_STAKE_LIMIT).values_list(
+            "pk", "vests")).values())
+    updated = ChoiceTally.objects.filter(choice_id__in=choice_ids).update(
+        voter_count=F("voter_count") + len(user_ids),
+        sp=F("sp") + (stakes["sp"] or 0),
+        sa_vests=F("sa_vests") + sa_vests,
+    )
+    if updated < len(choice_ids):
+        # choices without a tally row yet, build them from scratch.
+        existing = ChoiceTally.objects.filter(
+            choice_id__in=choice_ids).values_list("choice_id", flat=True)
+        refresh_tallies(
+            Choice.objects.filter(pk__in=choice_ids - set(existing)))
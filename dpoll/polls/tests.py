@@ -1,3 +1,1383 @@
-from django.test import TestCase
+import base64
+import csv
+import io
+import json
+import os
+import re
+import tempfile
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.cache.backends.dummy import DummyCache
+from django.db import DataError, IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import (
+    RequestFactory, TestCase, TransactionTestCase, override_settings,
+)
+from django.utils.timezone import now
+
+from communities.models import Community
+from . import (
+    analytics, audit, backfill, broadcasts, caching, ingest, leaderboards,
+    snapshots, tally, vectorized_tally, views,
+)
+from .blocks import BlockCache
+from .models import (
+    Broadcast, Choice, ChoiceTally, DailyActivity, Question, User,
+    VoteAudit, SA_STAKE_LIMIT, sa_stake_based_voting_point,
+)
+from .pagination import KeysetPaginator, encode_cursor, keyset_filter
+from .utils import AlreadyVoted, add_choices, register_vote
+from .views import POLL_ORDERINGS, open_polls
+from .voter_counts import PendingVoterCounts, _pending
+
+
+class ListingQueryPlanTests(TestCase):
+    """The hot poll listings must be served by indexes, not full table
+    scans. Runs on SQLite and PostgreSQL."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="emrebeyler")
+        for i in range(20):
+            Question.objects.create(
+                text=f"Poll {i}",
+                username=cls.user.username,
+                permlink=f"poll-{i}",
+                expire_at=now() + timedelta(days=i - 10),
+                voter_count=i,
+                trending_score=i / 2,
+                promotion_amount=i if i % 3 == 0 else None,
+            )
+
+    def assertIndexScan(self, queryset):
+        if connection.vendor == "postgresql":
+            # tiny test tables are always cheaper to scan sequentially.
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            plan = queryset.explain()
+            self.assertNotIn("Seq Scan on polls_question", plan)
+        elif connection.vendor == "sqlite":
+            plan = queryset.explain()
+            self.assertIsNone(
+                re.search(r"SCAN (TABLE )?polls_question\b(?! USING)", plan),
+                plan)
+        else:
+            self.skipTest(f"No plan checks for {connection.vendor}.")
+
+    def test_index_listings(self):
+        for order in POLL_ORDERINGS:
+            with self.subTest(order=order):
+                self.assertIndexScan(open_polls(order)[:11])
+
+    def test_index_listing_pages(self):
+        for order, ordering in POLL_ORDERINGS.items():
+            queryset = open_polls(order)
+            last = queryset[1]
+            values = [getattr(last, field.lstrip("-")) for field in ordering]
+            with self.subTest(order=order):
+                self.assertIndexScan(
+                    queryset.filter(keyset_filter(ordering, values))[:11])
+
+    def test_polls_by_vote_count(self):
+        self.assertIndexScan(Question.objects.filter(
+            created_at__gt=now() - timedelta(days=7),
+            created_at__lt=now()))
+
+    def test_profile(self):
+        self.assertIndexScan(self.user.polls_created)
+
+
+class KeysetPaginationTests(TestCase):
+    SCORES = [3, 3, 3, 2, 2, 1, 1]
+
+    @classmethod
+    def setUpTestData(cls):
+        for i, score in enumerate(cls.SCORES):
+            Question.objects.create(
+                text=f"Poll {i}", username="emrebeyler", permlink=f"poll-{i}",
+                expire_at=now() + timedelta(days=7), trending_score=score)
+        # ties on the score, broken by the id.
+        cls.ids = list(Question.objects.order_by(
+            "-trending_score", "-id").values_list("id", flat=True))
+
+    def test_pages(self):
+        paginator = KeysetPaginator(
+            Question.objects.order_by(*POLL_ORDERINGS["trending"]), 3)
+        pages = [paginator.get_page()]
+        self.assertIsNone(pages[0].previous_cursor)
+        while pages[-1].next_cursor:
+            pages.append(paginator.get_page(pages[-1].next_cursor))
+        self.assertEqual([[poll.id for poll in page] for page in pages], [
+            self.ids[:3], self.ids[3:6], self.ids[6:]])
+        self.assertFalse(pages[-1].has_next)
+
+        # and back, from the last page.
+        page = pages[-1]
+        for expected in reversed(pages[:-1]):
+            page = paginator.get_page(page.previous_cursor)
+            self.assertEqual(list(page), list(expected))
+            self.assertEqual(page.next_cursor, expected.next_cursor)
+        self.assertIsNone(page.previous_cursor)
+
+    def test_api(self):
+        url = "/api/v1/questions/?order=trending&page_size=2"
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [poll["id"] for poll in response.json()["results"]]
+            url = response.json()["next"]
+        self.assertEqual(ids, self.ids)
+
+    def test_invalid_cursor(self):
+        for cursor in [
+                "garbage", "e30", encode_cursor([1]),
+                encode_cursor(["a", 1]), encode_cursor([None, 1]),
+                encode_cursor([[1], 1]), encode_cursor(1),
+                base64.urlsafe_b64encode(b"[1, 2]").decode(),
+                base64.urlsafe_b64encode(b"\xff").decode()]:
+            with self.subTest(cursor=cursor):
+                response = self.client.get(
+                    "/api/v1/questions/",
+                    {"order": "trending", "cursor": cursor})
+                self.assertEqual(response.status_code, 404)
+                # the index page falls back to the first page.
+                response = self.client.get(
+                    "/", {"order": "trending", "cursor": cursor})
+                self.assertEqual(response.status_code, 200)
+
+
+class PendingVoterCountsTests(TransactionTestCase):
+    """Voter counts are applied once per transaction, on commit, and the
+    changes of a rolled back transaction or savepoint are discarded."""
+
+    def setUp(self):
+        self.question = Question.objects.create(
+            text="Poll", username="emrebeyler", permlink="poll",
+            expire_at=now() + timedelta(days=7))
+        self.choices = [
+            Choice.objects.create(question=self.question, text=text)
+            for text in ("a", "b")]
+        self.users = [
+            User.objects.create(username=f"voter{i}") for i in range(3)]
+
+    def assertVoterCount(self, voter_count):
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.voter_count, voter_count)
+
+    def test_once_per_transaction(self):
+        with transaction.atomic():
+            pending = _pending()
+            self.assertIs(_pending(), pending)
+            with transaction.atomic():
+                self.assertIsInstance(_pending(), PendingVoterCounts)
+                self.assertIsNot(_pending(), pending)
+            self.choices[0].voted_users.add(self.users[0])
+            self.choices[1].voted_users.add(*self.users)
+            self.assertVoterCount(0)
+        self.assertVoterCount(3)
+        with transaction.atomic():
+            self.assertIsNot(_pending(), pending)
+
+    def test_rollback(self):
+        try:
+            with transaction.atomic():
+                self.choices[0].voted_users.add(*self.users)
+                raise ValueError
+        except ValueError:
+            pass
+        with transaction.atomic():
+            self.choices[1].voted_users.add(self.users[0])
+        self.assertVoterCount(1)
+
+    def test_savepoint_rollback(self):
+        with transaction.atomic():
+            self.choices[0].voted_users.add(self.users[0])
+            try:
+                with transaction.atomic():
+                    self.choices[1].voted_users.add(*self.users[1:])
+                    raise ValueError
+            except ValueError:
+                pass
+            self.choices[1].voted_users.add(self.users[0])
+        self.assertVoterCount(1)
+
+
+# (reputation, account_age, post_count, sp, vests) of the voters
+VOTERS = [
+    (72, 900, 1500, 25000, 5e10),
+    (65, 400, 300, 8000, 2 * SA_STAKE_LIMIT),
+    (60, 120, 50, 1000, SA_STAKE_LIMIT),
+    (55, 30, 10, 50, 1e8),
+    (48, 2000, 800, 150000, 3e11),
+    (25, 10, 0, 0, 0),
+]
+# voters of each choice, by index
+BALLOTS = [[0, 1, 2, 3], [1, 4, 5], [], [0, 4]]
+
+FILTERS = [
+    {},
+    {"rep": 60},
+    {"age": 100},
+    {"post_count": 100},
+    {"sp": 1000},
+    {"community": "utopian"},
+    {"rep": 50, "age": 100, "post_count": 40, "sp": 1000,
+     "community": "utopian"},
+]
+
+
+class TallyFixture:
+    """A multiple choice poll voted by whales and minnows, some over the
+    SA_STAKE_LIMIT."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create(
+                username=f"voter{i}", reputation=rep, account_age=age,
+                post_count=post_count, sp=sp, vests=vests)
+            for i, (rep, age, post_count, sp, vests) in enumerate(VOTERS)]
+        cls.community = Community.objects.create(
+            name="utopian", members="voter0\nvoter2\nvoter4\nvoter5")
+        cls.question = Question.objects.create(
+            text="Poll", username="emrebeyler", permlink="poll",
+            expire_at=now() + timedelta(days=7),
+            allow_multiple_choices=True)
+        cls.choices = [
+            Choice.objects.create(question=cls.question, text=f"Choice {i}")
+            for i in range(len(BALLOTS))]
+        for choice, ballot in zip(cls.choices, BALLOTS):
+            choice.voted_users.add(*[cls.users[i] for i in ballot])
+
+    def reference_tallies(self, rep=None, age=None, post_count=None,
+                          sp=None, community=None):
+        """The per-choice loop of Choice.filtered_vote_count before the
+        grouped queries: choice id -> (voter count, SP, SA points,
+        usernames)."""
+        members = Community.objects.get(name=community).member_list \
+            if community else None
+        tallies = {}
+        for choice in self.question.choices.all():
+            voters = []
+            for user in choice.voted_users.all().order_by("-sp"):
+                if members is not None and user.username not in members:
+                    continue
+                if rep and user.reputation < int(rep):
+                    continue
+                if age and user.account_age < int(age):
+                    continue
+                if post_count and isinstance(post_count, int) and \
+                        user.post_count < post_count:
+                    continue
+                if sp and user.sp < int(sp):
+                    continue
+                voters.append(user)
+            if choice.voted_users.exists():
+                tallies[choice.id] = (
+                    len(voters),
+                    sum(user.sp for user in voters),
+                    sum(sa_stake_based_voting_point(user.vests)
+                        for user in voters),
+                    {user.username for user in voters},
+                )
+        return tallies
+
+    def assertTalliesEqual(self, tallies, voters, filters):
+        expected = self.reference_tallies(**filters)
+        self.assertEqual(set(tallies), set(expected))
+        for choice_id, (count, sp, sa_vests, usernames) in expected.items():
+            result = tallies[choice_id]
+            self.assertEqual(result.value(), count)
+            self.assertAlmostEqual(
+                float(result.value(stake_based=True)), float(sp), places=2)
+            self.assertAlmostEqual(
+                result.value(sa_stake_based=True), sa_vests,
+                delta=sa_vests * 1e-9)
+            self.assertEqual(
+                {voter.username for voter in voters.get(choice_id, [])},
+                usernames)
+
+    def filter_args(self, community=None, **filters):
+        if community:
+            filters["community_members"] = \
+                Community.objects.get(name=community).member_set
+        return filters
+
+
+class SQLTallyTests(TallyFixture, TestCase):
+
+    def test_tally_votes(self):
+        for filters in FILTERS:
+            with self.subTest(**filters):
+                voter_q = None
+                if filters:
+                    voter_q = tally.voter_filter(**self.filter_args(
+                        **filters))
+                self.assertTalliesEqual(
+                    tally.tally_votes(self.question, voter_q),
+                    tally.voters_by_choice(self.question, voter_q), filters)
+
+    def test_sa_stake_limit(self):
+        tallies = tally.tally_votes(
+            self.question, tally.voter_filter(rep=1))
+        capped = tallies[self.choices[1].id].value(sa_stake_based=True)
+        self.assertAlmostEqual(capped, sum(map(
+            sa_stake_based_voting_point, [2 * SA_STAKE_LIMIT, 3e11, 0])))
+
+    def test_votes_summary(self):
+        for filters in FILTERS:
+            expected = self.reference_tallies(**filters)
+            for layout in ({}, {"stake_based": True},
+                           {"sa_stake_based": True}):
+                with self.subTest(**filters, **layout):
+                    choice_list, ordered, choices_selected, filter_exists, \
+                        all_votes = self.question.votes_summary(
+                            **filters, **layout)
+                    self.assertEqual(filter_exists, bool(filters))
+                    self.assertEqual(choices_selected, len(expected))
+                    for result in ordered:
+                        count, sp, sa_vests, usernames = expected.get(
+                            result.id, (0, 0, 0, set()))
+                        value = sa_vests if layout.get("sa_stake_based") \
+                            else sp if layout.get("stake_based") else count
+                        if filters:
+                            value = int(value)
+                        self.assertAlmostEqual(
+                            float(result.vote_count), float(value),
+                            delta=1e-6 * float(value) or 0.01)
+                        self.assertEqual(
+                            {voter.username for voter in result.voters},
+                            usernames)
+
+
+@skipUnless(vectorized_tally.is_available(), "NumPy is not installed.")
+class VectorizedTallyTests(TallyFixture, TestCase):
+
+    def test_tally_votes(self):
+        for filters in FILTERS:
+            with self.subTest(**filters):
+                tallies, voters = vectorized_tally.tally_votes(
+                    self.question, **self.filter_args(**filters))
+                self.assertTalliesEqual(tallies, voters, filters)
+
+    @override_settings(VECTORIZED_TALLY_THRESHOLD=0)
+    def test_votes_summary(self):
+        self.assertTrue(vectorized_tally.should_vectorize(self.question))
+        for filters in FILTERS[1:]:
+            with self.subTest(**filters):
+                _, ordered, *_ = self.question.votes_summary(
+                    sa_stake_based=True, **filters)
+                expected = self.reference_tallies(**filters)
+                self.assertEqual(
+                    {result.id: result.vote_count for result in ordered
+                     if result.id in expected},
+                    {choice_id: int(tally[2])
+                     for choice_id, tally in expected.items()})
+
+
+class SnapshotTallyTests(TallyFixture, TestCase):
+
+    def setUp(self):
+        Question.objects.filter(pk=self.question.pk).update(
+            expire_at=now() - timedelta(days=1))
+        self.question.refresh_from_db()
+        self.snapshot = snapshots.finalize_poll(self.question)
+
+    def test_tally_votes(self):
+        for filters in FILTERS:
+            with self.subTest(**filters):
+                choices, tallies, voters = snapshots.tally_votes(
+                    self.snapshot, filter_exists=bool(filters),
+                    **self.filter_args(**filters))
+                self.assertEqual(
+                    choices, [(choice.id, choice.text)
+                              for choice in self.choices])
+                self.assertTalliesEqual(tallies, voters, filters)
+
+    def test_votes_summary(self):
+        self.assertIsNotNone(Question.objects.get(
+            pk=self.question.pk).get_snapshot())
+        for filters in FILTERS:
+            with self.subTest(**filters):
+                _, ordered, *_ = self.question.votes_summary(
+                    stake_based=True, **filters)
+                expected = self.reference_tallies(**filters)
+                for result in ordered:
+                    sp = expected[result.id][1] if result.id in expected \
+                        else 0
+                    self.assertAlmostEqual(
+                        float(result.vote_count),
+                        int(sp) if filters else float(sp), places=2)
+
+
+class ThresholdSweepTests(TallyFixture, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # ties with voter2 on every dimension, and unknown values.
+        tie = User.objects.create(
+            username="tie", reputation=60, account_age=120, post_count=50,
+            sp=1000, vests=SA_STAKE_LIMIT)
+        tie.choice_set.add(cls.choices[0], cls.choices[1])
+        cls.choices[1].voted_users.add(User.objects.create(username="ghost"))
+
+    def assertSweepEqualsTallies(self, dimension, thresholds, **filters):
+        for layout in ({}, {"stake_based": True}, {"sa_stake_based": True}):
+            results = analytics.threshold_sweep(
+                self.question, dimension, thresholds, **layout, **filters)
+            self.assertEqual(
+                [result["threshold"] for result in results], thresholds)
+            for threshold, result in zip(thresholds, results):
+                tallies = tally.tally_votes(self.question, tally.voter_filter(
+                    **{dimension: threshold}, community_members=filters.get(
+                        "community") and self.community.member_usernames()))
+                for choice in result["choices"]:
+                    with self.subTest(dimension=dimension,
+                                      threshold=threshold, **layout):
+                        expected = tallies.get(choice["id"], tally.Tally())
+                        self.assertEqual(choice["voter_count"],
+                                         expected.filtered_voter_count)
+                        self.assertAlmostEqual(
+                            choice["vote_count"],
+                            int(expected.value(**layout)), delta=1)
+
+    def test_thresholds(self):
+        for dimension, attr in analytics.FILTER_DIMENSIONS.items():
+            values = sorted({
+                int(getattr(user, attr)) for user in self.users})
+            # every value (ties included), and between and around them.
+            thresholds = [0] + sorted(
+                set(values) | {value + 1 for value in values})
+            self.assertSweepEqualsTallies(dimension, thresholds)
+            self.assertSweepEqualsTallies(
+                dimension, thresholds[::-1], community="utopian")
+
+
+class VoterDistributionTests(TallyFixture, TestCase):
+    EDGES = {"rep": [50, 60, 70], "age": [30, 365]}
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # unknown attributes
+        cls.choices[1].voted_users.add(User.objects.create(username="ghost"))
+
+    def histogram(self, **filters):
+        """Choice -> (voter count, rep buckets, age buckets, unknown)"""
+        return [(
+            choice["voter_count"],
+            [bucket["voter_count"]
+             for bucket in choice["distributions"]["rep"]["buckets"]],
+            [bucket["voter_count"]
+             for bucket in choice["distributions"]["age"]["buckets"]],
+            choice["distributions"]["rep"]["unknown"],
+        ) for choice in analytics.voter_distributions(
+            self.question, self.EDGES, **filters)]
+
+    def assertHistograms(self):
+        self.assertEqual(self.histogram(), [
+            (4, [0, 1, 2, 1], [0, 2, 2], 0),
+            (4, [2, 0, 1, 0], [1, 0, 2], 1),
+            (0, [0, 0, 0, 0], [0, 0, 0], 0),
+            (2, [1, 0, 0, 1], [0, 0, 2], 0),
+        ])
+        self.assertEqual(self.histogram(sp=1000), [
+            (3, [0, 0, 2, 1], [0, 1, 2], 0),
+            (2, [1, 0, 1, 0], [0, 0, 2], 0),
+            (0, [0, 0, 0, 0], [0, 0, 0], 0),
+            (2, [1, 0, 0, 1], [0, 0, 2], 0),
+        ])
+        self.assertEqual(self.histogram(community="utopian")[0],
+                         (2, [0, 0, 1, 1], [0, 1, 1], 0))
+
+    def test_histograms(self):
+        # the choices, and the buckets of all the choices.
+        with self.assertNumQueries(2):
+            analytics.voter_distributions(self.question, self.EDGES)
+        self.assertHistograms()
+
+    def test_snapshot(self):
+        Question.objects.filter(pk=self.question.pk).update(
+            expire_at=now() - timedelta(days=1))
+        self.question.refresh_from_db()
+        snapshots.finalize_poll(self.question)
+        self.assertHistograms()
+
+
+@mock.patch("polls.audit.AUDIT_CHUNK_SIZE", 2)
+class AuditExportTests(TallyFixture, TestCase):
+    """The exports read the votes of every choice in chunks of 2, the
+    first choice fills exactly 2 chunks and the second ends in a partial
+    one."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in (0, 1, 4):
+            audit = VoteAudit.objects.create(
+                question=cls.question, voter=cls.users[i],
+                block_id=100 + i, trx_id=f"trx{i}")
+            audit.choices.add(*cls.users[i].choice_set.all())
+
+    def expected_rows(self, voter_q=None):
+        votes = tally.Vote.objects.filter(choice__question=self.question)
+        if voter_q:
+            votes = votes.filter(voter_q)
+        return [
+            (text, username,
+             f"trx{username[-1]}" if username[-1] in "014" else "missing")
+            for text, username in votes.order_by(
+                "choice_id", "id").values_list(
+                "choice__text", "user__username")
+        ]
+
+    def export(self, export_format, voter_q=None):
+        response = self.question.audit_response(export_format, voter_q)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export("csv"))))
+        self.assertEqual(
+            [(row["choice"], row["voter"], row["trx_id"]) for row in rows],
+            self.expected_rows())
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(rows[0]["block_num"], "100")
+
+    def test_ndjson(self):
+        voter_q = tally.voter_filter(rep=50)
+        rows = [json.loads(line) for line in
+                self.export("ndjson", voter_q).splitlines()]
+        self.assertEqual(
+            [(row["choice"], row["voter"], row["trx_id"]) for row in rows],
+            self.expected_rows(voter_q))
+        self.assertEqual(list(rows[0]), list(audit.AUDIT_FIELDS))
+
+    def test_text(self):
+        lines = self.export(None).splitlines()
+        self.assertTrue(lines[0].startswith("<pre>Voter"))
+        self.assertEqual(lines[-1], "</pre>")
+        rows = [line.split(" | ") for line in lines[2:-1]]
+        self.assertEqual(
+            [(row[-1], row[0].strip(), row[1].strip()) for row in rows],
+            self.expected_rows())
+
+
+def poll_op(author, permlink, choices, question="Which one?"):
+    return ["comment", {
+        "parent_author": "", "parent_permlink": "dpoll", "author": author,
+        "permlink": permlink, "title": question, "body": "",
+        "json_metadata": json.dumps({
+            "app": "dpoll/0.0.1", "content_type": "poll",
+            "question": question, "choices": choices,
+            "expire_at": (now() + timedelta(days=7)).isoformat(),
+            "allow_multiple_choices": "False",
+        }),
+    }]
+
+
+def vote_op(author, poll_author, poll_permlink, votes):
+    return ["comment", {
+        "parent_author": poll_author, "parent_permlink": poll_permlink,
+        "author": author, "permlink": f"re-{poll_permlink}-{author}",
+        "title": "", "body": "",
+        "json_metadata": json.dumps({
+            "app": "dpoll/0.0.1", "content_type": "poll_vote",
+            "votes": votes,
+        }),
+    }]
+
+
+class FakeClient:
+    """
+    Serves the blocks like the batched get_block calls of lightsteem, the
+    blocks without a transaction are empty.
+
+    :param transactions (dict): Block number -> list of (trx id,
+        operation)
+    """
+
+    def __init__(self, transactions, head):
+        self.transactions = transactions
+        self.head = head
+        self.batch = []
+        self.fetched = []
+
+    def block(self, block_num):
+        if block_num > self.head:
+            return None
+        return {
+            "block_id": f"{block_num:08x}" + "0" * 32,
+            "transactions": [
+                {"transaction_id": trx_id, "operations": [operation]}
+                for trx_id, operation in self.transactions.get(block_num, [])
+            ],
+        }
+
+    def get_block(self, block_num, batch=False):
+        self.batch.append(block_num)
+
+    def process_batch(self):
+        batch, self.batch = self.batch, []
+        self.fetched += batch
+        return [self.block(block_num) for block_num in batch]
+
+    def get_dynamic_global_properties(self):
+        return {"last_irreversible_block_num": self.head}
+
+
+# a poll, and the valid and invalid votes on it.
+CHAIN = {
+    10: [("t1", poll_op("alice", "poll", ["a", "b"]))],
+    11: [("t2", vote_op("bob", "alice", "poll", ["a"])),
+         ("t3", vote_op("carol", "alice", "poll", ["c"]))],
+    12: [("t4", vote_op("bob", "alice", "poll", ["b"])),
+         ("t5", vote_op("carol", "alice", "other", ["a"]))],
+    13: [("t6", vote_op("dave", "alice", "poll", ["b", "c"])),
+         ("t7", poll_op("alice", "bad", ["a"]))],
+}
+
+
+@override_settings(BLOCK_CACHE_PATH=None)
+class IngestTests(TestCase):
+
+    def votes(self):
+        return sorted(VoteAudit.objects.values_list(
+            "voter__username", "choices__text", "block_id", "trx_id"))
+
+    def assertIngested(self):
+        question = Question.objects.get()
+        self.assertEqual((question.username, question.permlink),
+                         ("alice", "poll"))
+        self.assertEqual(
+            list(question.choices.order_by("id").values_list(
+                "text", flat=True)), ["a", "b"])
+        self.assertEqual(self.votes(), [
+            ("bob", "a", 11, "t2"), ("dave", "b", 13, "t6")])
+        self.assertEqual(
+            sorted(tally.Vote.objects.values_list(
+                "user__username", "choice__text")),
+            [("bob", "a"), ("dave", "b")])
+        self.assertEqual(ingest.get_checkpoint(), 13)
+
+    def test_ingest(self):
+        client = FakeClient(CHAIN, head=13)
+        self.assertEqual(list(ingest.ingest_blocks(
+            client, 10, 13, batch_size=2)), [
+            (11, {"polls": 1, "votes": 1, "skipped": 1}),
+            (13, {"polls": 0, "votes": 1, "skipped": 2}),
+        ])
+        self.assertEqual(client.fetched, [10, 11, 12, 13])
+        self.assertIngested()
+
+        # again, over the applied blocks.
+        self.assertEqual(list(ingest.ingest_blocks(client, 10, 13)), [
+            (13, {"polls": 0, "votes": 0, "skipped": 5})])
+        self.assertIngested()
+
+    def test_resume(self):
+        client = FakeClient(CHAIN, head=13)
+        with mock.patch.object(
+                client, "process_batch",
+                side_effect=[[client.block(10), client.block(11)],
+                             ConnectionError]):
+            with self.assertRaises(ConnectionError):
+                list(ingest.ingest_blocks(client, 10, 13, batch_size=2))
+        self.assertEqual(ingest.get_checkpoint(), 11)
+
+        start = ingest.get_checkpoint() + 1
+        list(ingest.ingest_blocks(client, start, 13, batch_size=2))
+        self.assertIngested()
+
+
+@override_settings(BLOCK_CACHE_PATH=None)
+@mock.patch("polls.backfill.LightsteemClient",
+            lambda nodes: FakeClient(CHAIN, head=13))
+class BackfillTests(TransactionTestCase):
+    """The backfill registers the same polls and votes as the ingester,
+    with their tallies and voter counts."""
+
+    def chain_state(self):
+        return {
+            "polls": sorted(Question.objects.values_list(
+                "username", "permlink", "voter_count")),
+            "tallies": sorted(ChoiceTally.objects.values_list(
+                "choice__text", "voter_count")),
+            "votes": sorted(tally.Vote.objects.values_list(
+                "user__username", "choice__text")),
+            "audits": sorted(VoteAudit.objects.values_list(
+                "voter__username", "choices__text", "block_id", "trx_id")),
+        }
+
+    def setUp(self):
+        # ingested, then cleared for the backfill.
+        list(ingest.ingest_blocks(FakeClient(CHAIN, head=13), 10, 13))
+        self.expected = self.chain_state()
+        self.assertEqual(len(self.expected["audits"]), 2)
+        VoteAudit.objects.all().delete()
+        Question.objects.all().delete()
+        User.objects.all().delete()
+
+    def test_parallel(self):
+        self.assertEqual(list(backfill.backfill(
+            [], 10, 13, partition_size=1, workers=3, batch_size=1)), [
+            ((10, 10), 1, 0), ((11, 11), 0, 1),
+            ((12, 12), 0, 0), ((13, 13), 0, 1),
+        ])
+        self.assertEqual(self.chain_state(), self.expected)
+        # the merged partitions are skipped.
+        self.assertEqual(list(backfill.backfill([], 10, 13, 1)), [])
+
+    def test_integrity_error(self):
+        polls, votes = backfill.fetch_partition([], 10, 13, batch_size=4)
+        # registered by the live ingester after the backfill read the
+        # existing polls.
+        ingest.register_poll_op(polls[0][2], polls[0][3])
+        calls = []
+
+        def stale_question_ids(keys):
+            calls.append(keys)
+            return {} if len(calls) == 1 else question_ids(keys)
+
+        question_ids = backfill._question_ids
+        with mock.patch("polls.backfill._question_ids", stale_question_ids):
+            self.assertEqual(
+                backfill.merge_partition(10, 13, polls, votes), (0, 2))
+        # the polls of the first try, then the polls and the votes.
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.chain_state(), self.expected)
+        self.assertEqual(backfill.merged_partitions([(10, 13)]), {(10, 13)})
+
+    def test_database_error(self):
+        polls, votes = backfill.fetch_partition([], 10, 13, batch_size=4)
+        with mock.patch("polls.backfill._merge_partition",
+                        side_effect=DataError):
+            self.assertEqual(
+                backfill.merge_partition(10, 13, polls, votes), (1, 2))
+        self.assertEqual(self.chain_state(), self.expected)
+        self.assertEqual(backfill.merged_partitions([(10, 13)]), {(10, 13)})
+
+
+@override_settings(BLOCK_CACHE_PATH=None)
+class SyncVotesTests(TestCase):
+    url = "/web-api/sync_batch/"
+
+    def setUp(self):
+        ingest.register_poll_op(CHAIN[10][0][1][1], json.loads(
+            CHAIN[10][0][1][1]["json_metadata"]))
+        self.clients = []
+        patcher = mock.patch("polls.views.LightsteemClient", self.client_for)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def client_for(self, nodes):
+        self.clients.append(FakeClient(CHAIN, head=13))
+        return self.clients[-1]
+
+    def sync(self, votes):
+        return self.client.post(self.url, json.dumps({"votes": votes}),
+                                content_type="application/json")
+
+    def results(self, votes):
+        response = self.sync(votes)
+        self.assertEqual(response.status_code, 200)
+        return [(result["trx_id"], result["status"])
+                for result in response.json()["results"]]
+
+    def test_votes(self):
+        self.assertEqual(self.results([
+            {"trx_id": "t2", "block_num": 11},
+            {"trx_id": "t3", "block_num": 11},
+            {"trx_id": "t4", "block_num": "12"},
+            {"trx_id": "t5", "block_num": 12},
+            {"trx_id": "t6", "block_num": 13},
+            {"trx_id": "t9", "block_num": 13},
+            {"trx_id": "t1", "block_num": 99},
+            {"trx_id": "t1", "block_num": "x"},
+            "t1",
+        ]), [
+            ("t2", 200), ("t3", 400), ("t4", 400), ("t5", 400), ("t6", 200),
+            ("t9", 400), ("t1", 400), ("t1", 400), (None, 400),
+        ])
+        # one batch, every block once.
+        [client] = self.clients
+        self.assertEqual(sorted(client.fetched), [11, 12, 13, 99])
+        self.assertEqual(
+            sorted(VoteAudit.objects.values_list("voter__username", "trx_id")),
+            [("bob", "t2"), ("dave", "t6")])
+
+    def test_limit(self):
+        votes = [{"trx_id": "t2", "block_num": 11}] * views.SYNC_BATCH_LIMIT
+        self.assertEqual(self.sync(votes).status_code, 200)
+        self.assertEqual(self.clients[0].fetched, [11])
+        self.assertEqual(self.sync(votes + votes[:1]).status_code, 400)
+        self.assertEqual(len(self.clients), 1)
+
+    def test_database_error(self):
+        register_vote_op = views.register_vote_op
+
+        def flaky(vote_op, block_num, trx_id, **kwargs):
+            if trx_id == "t2":
+                # half registered, then failed.
+                register_vote_op(vote_op, block_num, trx_id, **kwargs)
+                raise DataError
+            return register_vote_op(vote_op, block_num, trx_id, **kwargs)
+
+        with mock.patch("polls.views.register_vote_op", flaky), \
+                self.assertLogs("polls.views", "ERROR"):
+            self.assertEqual(self.results([
+                {"trx_id": "t2", "block_num": 11},
+                {"trx_id": "t6", "block_num": 13},
+            ]), [("t2", 500), ("t6", 200)])
+        self.assertEqual(
+            list(VoteAudit.objects.values_list("voter__username", "trx_id")),
+            [("dave", "t6")])
+        self.assertEqual(
+            list(tally.Vote.objects.values_list("user__username", flat=True)),
+            ["dave"])
+
+
+class BlockCacheTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = BlockCache(
+            os.path.join(directory.name, "blocks.sqlite3"), max_blocks=10)
+        self.addCleanup(lambda: self.cache.connection.close())
+
+    def blocks(self, block_nums):
+        return {block_num: {"block_id": f"{block_num:08x}"}
+                for block_num in block_nums}
+
+    def test_reads_dont_write(self):
+        self.cache.set_many(self.blocks(range(1, 6)))
+        changes = self.cache.connection.total_changes
+        self.assertEqual(
+            self.cache.get_many([1, 2, 7]), self.blocks([1, 2]))
+        self.assertEqual(self.cache.connection.total_changes, changes)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+        self.assertEqual(stats["blocks"], 5)
+
+    def test_eviction(self):
+        self.cache.set_many(self.blocks(range(1, 11)))
+        # touched blocks are kept, the touches are written with the next
+        # insert.
+        self.cache.get_many([1, 2])
+        self.cache.set_many(self.blocks([11]))
+        self.assertEqual(self.cache.block_count, 9)
+        cached = self.cache.get_many(list(range(1, 12)))
+        self.assertEqual(len(cached), 9)
+        self.assertTrue({1, 2, 11} <= set(cached))
+
+
+class FlakySigner(broadcasts.LocalSigner):
+    def broadcast(self, operations):
+        raise ConnectionError("Node is down.")
+
+
+class RejectingSigner(broadcasts.LocalSigner):
+    def broadcast(self, operations):
+        raise broadcasts.BroadcastRejected("missing required posting auth")
+
+
+@override_settings(BROADCAST_MAX_ATTEMPTS=3, BROADCAST_RETRY_DELAY=10,
+                   BROADCAST_LEASE=60, BROADCAST_TOKEN_TTL=1800)
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create(username="emrebeyler")
+        self.voter = User.objects.create(username="voter", sp=10, vests=1)
+        self.question = Question.objects.create(
+            text="Poll", username=self.author.username, permlink="poll",
+            expire_at=now() + timedelta(days=7))
+        add_choices(self.question, ["a", "b"])
+        self.poll_broadcast = broadcasts.enqueue(
+            Broadcast.POLL, self.question, self.author.username, "token",
+            [["comment", {}]])
+
+    def vote(self, text="a"):
+        vote_audit = register_vote(
+            self.question, self.voter,
+            [self.question.choices.get(text=text)])
+        return broadcasts.enqueue(
+            Broadcast.VOTE, self.question, self.voter.username, "token",
+            [["custom_json", {}]], vote_audit=vote_audit)
+
+    def edit(self, choices):
+        previous = broadcasts.poll_state(self.question)
+        self.question.text = "Edited poll"
+        self.question.save()
+        add_choices(self.question, choices, flush=True)
+        return broadcasts.enqueue(
+            Broadcast.EDIT, self.question, self.author.username, "token",
+            [["comment", {}]], previous=previous)
+
+    def claim(self, at=None):
+        with mock.patch.object(
+                broadcasts.timezone, "now", return_value=at or now()):
+            return [broadcast.pk for broadcast in
+                    broadcasts.claim_due_broadcasts(10)]
+
+    def test_send(self):
+        vote_broadcast = self.vote()
+        # the vote waits for the poll.
+        for _ in range(2):
+            counts = broadcasts.process_outbox(
+                signer_class=broadcasts.LocalSigner)
+            self.assertEqual(counts[Broadcast.SENT], 1)
+        vote_broadcast.refresh_from_db()
+        self.assertEqual(vote_broadcast.status, Broadcast.SENT)
+        self.assertIsNone(vote_broadcast.access_token)
+        self.assertEqual(
+            VoteAudit.objects.get(pk=vote_broadcast.vote_audit_id).trx_id,
+            vote_broadcast.trx_id)
+
+    def test_retry_backoff(self):
+        broadcast = self.poll_broadcast
+        for attempt, delay in [(1, 10), (2, 20)]:
+            started = now()
+            self.assertEqual(
+                broadcasts.send(broadcast, signer_class=FlakySigner),
+                Broadcast.PENDING)
+            broadcast.refresh_from_db()
+            self.assertEqual(broadcast.attempts, attempt)
+            self.assertIn("Node is down.", broadcast.last_error)
+            self.assertAlmostEqual(
+                (broadcast.next_attempt_at - started).total_seconds(),
+                delay, delta=1)
+            self.assertEqual(broadcast.access_token, "token")
+
+        # out of attempts
+        self.assertEqual(
+            broadcasts.send(broadcast, signer_class=FlakySigner),
+            Broadcast.FAILED)
+        broadcast.refresh_from_db()
+        self.assertIsNone(broadcast.access_token)
+
+    def test_lease(self):
+        self.assertEqual(self.claim(), [self.poll_broadcast.pk])
+        # leased to the first worker
+        self.assertEqual(self.claim(), [])
+        self.assertEqual(self.claim(now() + timedelta(seconds=30)), [])
+        # the worker died, the lease expired
+        self.assertEqual(
+            self.claim(now() + timedelta(seconds=61)),
+            [self.poll_broadcast.pk])
+
+    def test_ordering(self):
+        vote_broadcast = self.vote()
+        # the poll is waiting for a retry, so is the vote.
+        Broadcast.objects.filter(pk=self.poll_broadcast.pk).update(
+            next_attempt_at=now() + timedelta(minutes=5))
+        self.assertEqual(self.claim(), [])
+
+        Broadcast.objects.filter(pk=self.poll_broadcast.pk).update(
+            next_attempt_at=now())
+        self.assertEqual(self.claim(), [self.poll_broadcast.pk])
+        broadcasts.send(
+            Broadcast.objects.get(pk=self.poll_broadcast.pk),
+            signer_class=broadcasts.LocalSigner)
+
+        # an edit holds the votes queued after it, not the ones before.
+        edit_broadcast = self.edit(["a", "c"])
+        Broadcast.objects.filter(pk=edit_broadcast.pk).update(
+            next_attempt_at=now() + timedelta(minutes=5))
+        self.voter.choice_set.clear()
+        VoteAudit.objects.all().delete()
+        later_vote = self.vote("c")
+        self.assertEqual(self.claim(), [vote_broadcast.pk])
+        self.assertNotIn(later_vote.pk, self.claim(
+            now() + timedelta(minutes=2)))
+
+    def test_revert_vote(self):
+        broadcasts.send(
+            self.poll_broadcast, signer_class=broadcasts.LocalSigner)
+        vote_broadcast = self.vote()
+        self.assertEqual(
+            broadcasts.send(vote_broadcast, signer_class=RejectingSigner),
+            Broadcast.FAILED)
+        self.assertEqual(
+            vote_broadcast.last_error, "missing required posting auth")
+        self.assertFalse(self.voter.choice_set.exists())
+        self.assertFalse(VoteAudit.objects.exists())
+        self.assertEqual(
+            self.question.choices.get(text="a").tally.voter_count, 0)
+
+    def test_revert_poll(self):
+        vote_broadcast = self.vote()
+        broadcasts.send(self.poll_broadcast, signer_class=RejectingSigner)
+        self.assertFalse(Question.objects.filter(
+            pk=self.question.pk).exists())
+        self.assertFalse(VoteAudit.objects.exists())
+        vote_broadcast.refresh_from_db()
+        self.assertEqual(vote_broadcast.status, Broadcast.FAILED)
+        self.assertIsNone(vote_broadcast.access_token)
+        self.assertIsNone(vote_broadcast.question_id)
+
+    def test_revert_edit(self):
+        self.vote()
+        previous = broadcasts.poll_state(self.question)
+        edit_broadcast = self.edit(["c", "d"])
+        self.assertFalse(self.voter.choice_set.exists())
+
+        broadcasts.send(edit_broadcast, signer_class=RejectingSigner)
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.text, "Poll")
+        state = broadcasts.poll_state(self.question)
+        self.assertEqual(
+            [(choice["text"], choice["voters"]) for choice in
+             state["choices"]],
+            [(choice["text"], choice["voters"]) for choice in
+             previous["choices"]])
+        self.assertEqual(
+            [choice.text for choice in VoteAudit.objects.get().choices.all()],
+            ["a"])
+
+    def test_token_ttl(self):
+        Broadcast.objects.filter(pk=self.poll_broadcast.pk).update(
+            created_at=now() - timedelta(hours=1),
+            next_attempt_at=now() + timedelta(minutes=5))
+        broadcasts.process_outbox(signer_class=FlakySigner)
+        # the token is dropped right away, the broadcast fails once due.
+        self.poll_broadcast.refresh_from_db()
+        self.assertIsNone(self.poll_broadcast.access_token)
+        self.assertEqual(self.poll_broadcast.status, Broadcast.PENDING)
+
+        Broadcast.objects.filter(pk=self.poll_broadcast.pk).update(
+            next_attempt_at=now())
+        with mock.patch.object(
+                broadcasts.LocalSigner, "broadcast") as signer:
+            broadcasts.process_outbox(signer_class=broadcasts.LocalSigner)
+        signer.assert_not_called()
+        self.poll_broadcast.refresh_from_db()
+        self.assertEqual(self.poll_broadcast.status, Broadcast.FAILED)
+        self.assertEqual(
+            self.poll_broadcast.last_error, "The access token expired.")
+
+
+class SharedCacheMixin:
+    """Caches in a file based cache, it's shared by the processes like
+    memcached."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache_settings = self.settings(CACHES={"default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": directory.name,
+        }})
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+
+    def create_poll(self):
+        self.author = User.objects.create(username="emrebeyler")
+        self.voter = User.objects.create(username="voter", sp=10, vests=1)
+        self.poll = Question.objects.create(
+            text="Poll", username=self.author.username, permlink="poll",
+            expire_at=now() + timedelta(days=7))
+        add_choices(self.poll, ["a", "b"])
+
+
+class CacheVersionTests(SharedCacheMixin, TransactionTestCase):
+    """The versions are bumped on commit, TransactionTestCase commits."""
+
+    def setUp(self):
+        super().setUp()
+        self.create_poll()
+
+    def summary(self):
+        _, ordered, _, _, all_votes = caching.cached_votes_summary(self.poll)
+        return [(result.text, result.vote_count) for result in ordered], \
+            all_votes
+
+    def assertCached(self):
+        with mock.patch.object(Question, "votes_summary") as votes_summary:
+            caching.cached_votes_summary(self.poll)
+        votes_summary.assert_not_called()
+
+    def poll_version(self):
+        return caching.get_version(caching.poll_version_name(self.poll.id))
+
+    def test_vote(self):
+        self.assertEqual(self.summary(), ([("a", 0), ("b", 0)], 0))
+        self.assertCached()
+        version = self.poll_version()
+
+        register_vote(self.poll, self.voter, [self.poll.choices.get(text="a")])
+        self.assertGreater(self.poll_version(), version)
+        self.assertEqual(self.summary(), ([("a", 1), ("b", 0)], 1))
+        self.assertCached()
+
+    def test_edit(self):
+        self.assertEqual(self.summary(), ([("a", 0), ("b", 0)], 0))
+        version = self.poll_version()
+
+        add_choices(self.poll, ["c", "d", "e"], flush=True)
+        self.assertGreater(self.poll_version(), version)
+        self.assertEqual(
+            self.summary(), ([("c", 0), ("d", 0), ("e", 0)], 0))
+
+    def test_cache_unavailable(self):
+        with mock.patch.object(caching, "cache", DummyCache("", {})), \
+                self.assertLogs("polls.caching", "WARNING"):
+            self.assertIsNone(caching.votes_summary_key(self.poll, {}))
+            self.assertEqual(self.summary(), ([("a", 0), ("b", 0)], 0))
+
+    def test_process_local_cache(self):
+        with self.settings(CACHES={"default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}):
+            self.summary()
+            with mock.patch.object(
+                    Question, "votes_summary",
+                    return_value=(None, [], 0, False, 0)) as votes_summary:
+                self.summary()
+            votes_summary.assert_called_once()
+
+
+class PageCacheTests(SharedCacheMixin, TransactionTestCase):
+    """The pages of the anonymous users are cached until a vote or an
+    edit bumps their versions."""
+
+    def setUp(self):
+        super().setUp()
+        self.create_poll()
+        self.urls = ["/", f"/detail/@{self.author.username}/poll/"]
+
+    def assertRendered(self, rendered=True):
+        for url in self.urls:
+            with self.subTest(url=url), mock.patch(
+                    "polls.views.render", wraps=views.render) as render:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(render.called, rendered)
+
+    def cache_keys(self):
+        request = RequestFactory().get("/")
+        return (caching.index_cache_key(request),
+                caching.detail_cache_key(request, self.poll.id))
+
+    def test_anonymous(self):
+        self.assertRendered()
+        self.assertRendered(False)
+
+    def test_authenticated(self):
+        self.client.force_login(self.voter)
+        self.assertRendered()
+        self.assertRendered()
+
+    def test_vote(self):
+        self.assertRendered()
+        keys = self.cache_keys()
+        register_vote(self.poll, self.voter, [self.poll.choices.get(text="a")])
+        index_key, detail_key = self.cache_keys()
+        self.assertNotEqual(index_key, keys[0])
+        self.assertNotEqual(detail_key, keys[1])
+        self.assertRendered()
+        self.assertRendered(False)
+
+    def test_edit(self):
+        self.assertRendered()
+        keys = self.cache_keys()
+        add_choices(self.poll, ["c", "d"], flush=True)
+        index_key, detail_key = self.cache_keys()
+        self.assertNotEqual(index_key, keys[0])
+        self.assertNotEqual(detail_key, keys[1])
+        self.assertRendered()
+
+
+class RegisterVoteTests(TestCase):
+
+    def setUp(self):
+        self.voter = User.objects.create(username="voter", sp=10, vests=1)
+        self.poll = Question.objects.create(
+            text="Poll", username="emrebeyler", permlink="poll",
+            expire_at=now() + timedelta(days=7), allow_multiple_choices=True)
+        add_choices(self.poll, ["a", "b", "c"])
+        self.a, self.b, self.c = self.poll.choices.order_by("id")
+
+    def test_duplicate(self):
+        audit = register_vote(self.poll, self.voter, [self.a], trx_id="1")
+        with self.assertRaises(AlreadyVoted):
+            register_vote(self.poll, self.voter, [self.b, self.c],
+                          trx_id="2")
+        self.assertEqual(list(self.voter.choice_set.all()), [self.a])
+        self.assertEqual(list(VoteAudit.objects.all()), [audit])
+        self.assertEqual(list(audit.choices.all()), [self.a])
+        self.assertEqual(
+            dict(ChoiceTally.objects.values_list("choice__text",
+                                                 "voter_count")),
+            {"a": 1, "b": 0, "c": 0})
+
+
+class UniqueVoteMigrationTests(TransactionTestCase):
+    """0024_voteaudit_unique_vote refuses to run on duplicate audits."""
+    before = [("polls", "0023_listing_indexes")]
+    after = [("polls", "0024_voteaudit_unique_vote")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        super().tearDown()
+
+    def test_duplicates(self):
+        apps = self.migrate(self.before)
+        User = apps.get_model("polls", "User")
+        Question = apps.get_model("polls", "Question")
+        VoteAudit = apps.get_model("polls", "VoteAudit")
+        voter = User.objects.create(username="voter")
+        poll = Question.objects.create(
+            text="Poll", username="emrebeyler", permlink="poll",
+            expire_at=now() + timedelta(days=7))
+        first, second = [
+            VoteAudit.objects.create(question=poll, voter=voter, trx_id=trx)
+            for trx in ("1", "2")]
+
+        with self.assertRaisesRegex(
+                RuntimeError, rf"question {poll.id}, voter {voter.id}: "
+                              rf"audits \[{first.id}, {second.id}\]"):
+            self.migrate(self.after)
+        self.assertEqual(VoteAudit.objects.count(), 2)
+
+        second.delete()
+        apps = self.migrate(self.after)
+        VoteAudit = apps.get_model("polls", "VoteAudit")
+        with self.assertRaises(IntegrityError):
+            VoteAudit.objects.create(question_id=poll.id, voter_id=voter.id)
+
+
+class ChoiceTallyTests(TallyFixture, TestCase):
+    """The materialized tallies follow the vote changes."""
+
+    def assertTalliesFresh(self, choices=None):
+        tallies = {
+            tally.choice_id: tally for tally in
+            ChoiceTally.objects.filter(question=self.question)}
+        if choices is None:
+            choices = list(self.question.choices.all())
+            self.assertEqual(
+                set(tallies), {choice.id for choice in choices})
+        for choice in choices:
+            voters = list(choice.voted_users.all())
+            tally = tallies[choice.id]
+            self.assertEqual(tally.voter_count, len(voters))
+            self.assertAlmostEqual(
+                float(tally.sp), float(sum(user.sp for user in voters)),
+                places=2)
+            sa_vests = sum(sa_stake_based_voting_point(user.vests)
+                           for user in voters)
+            self.assertAlmostEqual(
+                tally.sa_vests, sa_vests, delta=sa_vests * 1e-9)
+
+    def test_votes(self):
+        self.assertTalliesFresh()
+        whale, minnow = self.users[4], self.users[5]
+        self.choices[2].voted_users.add(whale, minnow)
+        self.assertTalliesFresh()
+
+        # the stakes change after the votes, the removed votes are not
+        # subtracted with the new stakes.
+        User.objects.filter(pk=whale.pk).update(sp=10, vests=10)
+        User.objects.filter(pk=self.users[1].pk).update(
+            sp=10 ** 6, vests=10 * SA_STAKE_LIMIT)
+        self.choices[2].voted_users.remove(whale)
+        self.users[1].choice_set.remove(self.choices[0])
+        self.assertTalliesFresh([self.choices[0], self.choices[2]])
+        # the others are refreshed by update_acc_info.
+        tally.refresh_tallies()
+        self.assertTalliesFresh()
+
+        self.choices[3].voted_users.clear()
+        self.assertTalliesFresh()
+        minnow.choice_set.clear()
+        self.assertTalliesFresh()
+        self.users[0].choice_set.add(self.choices[2], self.choices[3])
+        self.assertTalliesFresh()
+
+    def test_edit(self):
+        add_choices(self.question, ["c", "d"], flush=True)
+        self.assertTalliesFresh()
+        choice = self.question.choices.get(text="c")
+        choice.voted_users.add(*self.users[:3])
+        self.assertTalliesFresh()
+
+
+class DailyActivityTests(TallyFixture, TestCase):
+    """The leaderboard rollup kept by the signals equals a rebuild."""
+
+    def rollup(self):
+        return list(DailyActivity.objects.order_by(
+            "user_id", "day").values_list(
+            "user_id", "day", "poll_count", "vote_count"))
+
+    def assertRollupRebuilds(self):
+        live = self.rollup()
+        leaderboards.rebuild_activity()
+        self.assertEqual(live, self.rollup())
+
+    def create_poll(self, username, days_ago=0):
+        question = Question.objects.create(
+            text="Poll", username=username, permlink=f"poll-{days_ago}",
+            expire_at=now() + timedelta(days=7), allow_multiple_choices=True)
+        Question.objects.filter(pk=question.pk).update(
+            created_at=now() - timedelta(days=days_ago))
+        add_choices(question, ["x", "y"])
+        return question, list(question.choices.order_by("id"))
+
+    def test_votes(self):
+        question, (x, y) = self.create_poll("emrebeyler", days_ago=3)
+        # without an audit, dated by the poll.
+        x.voted_users.add(self.users[1])
+        register_vote(question, self.users[2], [y])
+        # an older vote, dated by its audit.
+        audit = VoteAudit.objects.create(question=question,
+                                         voter=self.users[3])
+        VoteAudit.objects.filter(pk=audit.pk).update(
+            created_at=now() - timedelta(days=5))
+        self.users[3].choice_set.add(x, y)
+        self.assertEqual(len({day for _, day, _, _ in self.rollup()}), 3)
+        self.assertRollupRebuilds()
+
+        self.users[3].choice_set.remove(x)
+        self.assertRollupRebuilds()
+        x.voted_users.clear()
+        self.assertRollupRebuilds()
+        self.users[2].choice_set.clear()
+        self.assertRollupRebuilds()
+        self.choices[0].voted_users.remove(self.users[0])
+        self.assertRollupRebuilds()
+
+    def test_deletes(self):
+        author = User.objects.create(username="author")
+        question, (x, y) = self.create_poll(author.username)
+        register_vote(question, self.users[0], [x])
+        y.voted_users.add(self.users[1], author)
+        self.assertRollupRebuilds()
+
+        add_choices(question, ["z"], flush=True)
+        self.assertRollupRebuilds()
+        register_vote(question, self.users[1], list(question.choices.all()))
+        Question.objects.create(
+            text="Poll", username=author.username, permlink="new",
+            expire_at=now() + timedelta(days=7))
+        self.assertIn(author.pk, [row[0] for row in self.rollup()])
+        self.assertRollupRebuilds()
+
+        question_id = question.pk
+        question.delete()
+        VoteAudit.objects.filter(question_id=question_id).delete()
+        self.assertRollupRebuilds()
+        self.assertEqual(
+            leaderboards.top_pollers(), [{
+                "username": "author", "reputation": author.reputation,
+                "sp": author.sp, "count": 1}])
@@ -0,0 +1,37 @@
+"""
+Time-decayed trending scores of the polls.
+
+Every new voter of a poll adds 1 to its Question.trending_score (see
+voter_counts.py), and the decay_trending_scores command periodically
+multiplies the scores with a factor derived from
+TRENDING_HALF_LIFE_HOURS. The score is the number of voters weighted by
+the recency of their votes, so old polls fall down the trending list once
+their votes slow down.
+"""
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Question
+
+
+def decay_factor(hours):
+    """Decay factor of the scores for the elapsed hours."""
+    return 0.5 ** (hours / settings.TRENDING_HALF_LIFE_HOURS)
+
+
+def decay_scores(hours):
+    """
+    Decay the scores of the open polls, and reset the scores of the
+    expired and deleted ones.
+
+    :param hours (float): Hours elapsed since the last decay
+    :return (tuple): (number of decayed polls, number of reset polls)
+    """
+    scored = Question.objects.filter(trending_score__gt=0)
+    closed = scored.filter(expire_at__lte=timezone.now()) | \
+        scored.filter(is_deleted=True)
+    reset = closed.update(trending_score=0)
+    decayed = scored.update(
+        trending_score=F("trending_score") * decay_factor(hours))
+    return decayed, reset
@@ -8,7 +8,10 @@ from rest_framework import routers
 from .api_views import (
     QuestionViewSet,
     TeamView,
+    LeaderboardView,
     AuditView,
+    BroadcastViewSet,
+    BlockCacheView,
     SponsorViewSet,
     UserViewSet
 )
@@ -21,6 +24,12 @@ api_router.register(r'users', UserViewSet,
                 base_name='user_view_set')
 api_router.register(r'team', TeamView, base_name='team')
 api_router.register(r'sponsors', SponsorViewSet, base_name='sponsors')
+api_router.register(r'leaderboards', LeaderboardView,
+                base_name='leaderboards')
+api_router.register(r'broadcasts', BroadcastViewSet,
+                base_name='broadcasts')
+api_router.register(r'block_cache', BlockCacheView,
+                base_name='block_cache')
 
 urlpatterns = [
     path('', views.index, name='index'),
@@ -36,5 +45,6 @@ urlpatterns = [
     path('api/v1/audit/', AuditView.as_view(), name="api-audit"),
     path('web-api/vote_tx/', views.vote_transaction_details, name="vote-tx"),
     path('web-api/sync/', views.sync_vote, name="sync-vote"),
+    path('web-api/sync_batch/', views.sync_votes, name="sync-votes"),
     path('web-api/vote_check/', views.vote_check, name="check-vote"),
 ]
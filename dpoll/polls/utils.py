@@ -5,8 +5,7 @@ from datetime import timedelta
 
 from django.conf import settings
 from django.contrib import messages
-from django.contrib.auth import get_user_model
-from django.db import connection
+from django.db import IntegrityError, transaction
 from django.utils.text import slugify
 from hivesigner.client import Client
 from hivesigner.operations import CommentOptions, Comment
@@ -15,7 +14,7 @@ from .post_templates import get_body
 from lightsteem.client import Client as LightSteemClient
 
 
-from .models import Question, Choice
+from .models import Question, Choice, User, VoteAudit
 
 _sc_client = None
 
@@ -107,26 +106,27 @@ def get_comment_options(parent_comment, reward_option=None, return_dict=False):
     return CommentOptions(**params)
 
 
-def get_top_dpollers():
-    with connection.cursor() as cursor:
-        cursor.execute("select count(1), username from polls_question"
-                       " group by username order by count(1) desc limit 5;")
-        row = cursor.fetchall()
-
-    return row
-
-
-def get_top_voters():
-    with connection.cursor() as cursor:
-        cursor.execute("select count(1), user_id from polls_choice_voted_users "
-                       "group by user_id order by count(1) desc limit 5;")
-        row = cursor.fetchall()
-    voter_list = []
-    for vote_count, voter_user_id in row:
-        voter_list.append(
-            (vote_count, get_user_model().objects.get(pk=voter_user_id)))
+def poll_errors(question, choices):
+    """
+    Validate the question text and the choices of a poll. Shared by the
+    poll form and the polls read from the blockchain.
 
-    return voter_list
+    :param question (str): Question text
+    :param choices (list): Choice texts, without duplicates and blanks.
+    :return (list): Error messages
+    """
+    errors = []
+    if question:
+        if not (4 < len(question) < 256):
+            errors.append("Question text should be between 6-256 chars.")
+    if len(choices) < 2:
+        errors.append("At least 2 answers are required.")
+    elif len(choices) > 128:
+        errors.append("Maximum number of answers is 128.")
+    max_length = Choice._meta.get_field("text").max_length
+    if any(len(choice) > max_length for choice in choices):
+        errors.append(f"Answers should be at most {max_length} chars.")
+    return errors
 
 
 def validate_input(request):
@@ -162,29 +162,10 @@ def validate_input(request):
     if tags:
         tags = tags.split(',')
 
-    if question:
-        if not (4 < len(question) < 256):
-            messages.add_message(
-                request,
-                messages.ERROR,
-                "Question text should be between 6-256 chars."
-            )
-            error = True
     choices = remove_duplicates(choices)
     choices = [c for c in choices if c]
-    if len(choices) < 2:
-        messages.add_message(
-            request,
-            messages.ERROR,
-            f"At least 2 answers are required."
-        )
-        error = True
-    elif len(choices) > 128:
-        messages.add_message(
-            request,
-            messages.ERROR,
-            f"Maximum number of answers is 128."
-        )
+    for message in poll_errors(question, choices):
+        messages.add_message(request, messages.ERROR, message)
         error = True
 
     if 'expire-at' in request.POST:
@@ -241,6 +222,152 @@ def add_choices(question, choices, flush=False):
         choice_instance.save()
 
 
+class AlreadyVoted(Exception):
+    pass
+
+
+def register_vote(question, user, choices, block_id=None, trx_id=None):
+    """
+    Register the vote of a user to the database with its blockchain
+    reference, in one transaction. Duplicate votes (including the
+    concurrent ones) are rejected by the unique (question, voter)
+    constraint of VoteAudit.
+
+    :param question (Question): The poll
+    :param user (User): The voter
+    :param choices (list): Choice instances of the poll
+    :raises AlreadyVoted: The user has already voted on the poll.
+    :return (VoteAudit)
+    """
+    try:
+        with transaction.atomic():
+            vote_audit = VoteAudit.objects.create(
+                question=question,
+                voter=user,
+                block_id=block_id,
+                trx_id=trx_id,
+            )
+            user.choice_set.add(*choices)
+            vote_audit.choices.add(*choices)
+    except IntegrityError:
+        raise AlreadyVoted
+    return vote_audit
+
+
+class InvalidVote(Exception):
+    pass
+
+
+def find_vote_op(block_data, trx_id):
+    """
+    Find the vote operation of a transaction in a block.
+
+    :param block_data (dict): The block
+    :raises InvalidVote: The transaction or the operation is not found.
+    :return (dict): Value of the (last) comment operation
+    """
+    vote_tx = None
+    for block_tx in block_data.get("transactions", []):
+        if block_tx.get("transaction_id") == trx_id:
+            vote_tx = block_tx
+            break
+
+    if not vote_tx:
+        raise InvalidVote("Invalid transaction ID")
+
+    vote_op = None
+    for op_type, op_value in vote_tx.get("operations", []):
+        if op_type != "comment":
+            continue
+        vote_op = op_value
+
+    if not vote_op:
+        raise InvalidVote("Couldn't find valid vote operation.")
+    return vote_op
+
+
+def _poll_choices(author, permlink, polls):
+    """Return (Question, choice text -> Choice) of a poll, or None."""
+    if (author, permlink) not in polls:
+        try:
+            question = Question.objects.get(
+                username=author,
+                permlink=permlink,
+            )
+        except Question.DoesNotExist:
+            polls[(author, permlink)] = None
+        else:
+            polls[(author, permlink)] = (
+                question, {c.text: c for c in question.choices.all()})
+    return polls[(author, permlink)]
+
+
+def register_vote_op(vote_op, block_num, trx_id, polls=None):
+    """
+    Validate a vote (a comment operation with the poll_vote content type)
+    casted on the blockchain and register it to the database.
+
+    :param vote_op (dict): Value of the comment operation
+    :param block_num (int): Block number of the transaction
+    :param trx_id (str): Transaction id of the vote
+    :param polls (dict): Cache of the polls and their choices, to share
+        between the calls.
+    :raises InvalidVote: The operation is not a valid vote, with the
+        reason.
+    :raises AlreadyVoted: The user has already voted on the poll.
+    :return (VoteAudit)
+    """
+    # validate json metadata
+    if not vote_op.get("json_metadata"):
+        raise InvalidVote("json_metadata is missing.")
+
+    try:
+        json_metadata = json.loads(vote_op.get("json_metadata", ""))
+    except ValueError:
+        raise InvalidVote("json_metadata is not valid.")
+
+    # json_metadata should indicate content type
+    if not isinstance(json_metadata, dict) or \
+            json_metadata.get("content_type") != "poll_vote":
+        raise InvalidVote("content_type field is missing.")
+
+    # check votes
+    votes = json_metadata.get("votes", [])
+    if not isinstance(votes, list) or not len(votes):
+        raise InvalidVote("votes field is missing.")
+
+    # check the poll exists
+    poll = _poll_choices(
+        vote_op.get("parent_author"), vote_op.get("parent_permlink"),
+        {} if polls is None else polls)
+    if poll is None:
+        raise InvalidVote("parent_author/parent_permlink is not a poll.")
+    question, choices = poll
+
+    # Validate the choice
+    selected_choices = [
+        choices[vote] for vote in remove_duplicates(votes)
+        if isinstance(vote, str) and vote in choices
+    ]
+    if not selected_choices:
+        raise InvalidVote("Invalid choices in votes field.")
+
+    # check if the user exists in our database
+    # if it doesn't, create it.
+    try:
+        user = User.objects.get(username=vote_op.get("author"))
+    except User.DoesNotExist:
+        user = User.objects.create_user(
+            username=vote_op.get("author"))
+
+    # votes registered before the audit log don't have a VoteAudit.
+    if Choice.objects.filter(voted_users=user, question=question).exists():
+        raise AlreadyVoted
+
+    return register_vote(question, user, selected_choices,
+                         block_id=block_num, trx_id=trx_id)
+
+
 def fetch_poll_data(author, permlink):
     """
     Fetch a poll from the blockchain and return the poll metadata.
@@ -0,0 +1,116 @@
+"""
+NumPy based vote tallying for polls with lots of voters.
+
+The voters of a poll are loaded once as columnar arrays, the filters are
+applied as boolean masks and the per-choice totals are calculated with
+bincount. NumPy is an optional dependency, see is_available.
+"""
+import math
+from collections import defaultdict
+
+from django.conf import settings
+
+from .models import SA_STAKE_LIMIT
+from .results import VOTER_FIELDS, VoterResult
+from .tally import Tally, Vote
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def is_available():
+    return np is not None
+
+
+def should_vectorize(question):
+    """Decide the tally engine of a poll with the stored voter count."""
+    threshold = settings.VECTORIZED_TALLY_THRESHOLD
+    return is_available() and threshold is not None and \
+        question.voter_count >= threshold
+
+
+def sa_stake_based_voting_points(vests):
+    """Vectorized counterpart of models.sa_stake_based_voting_point."""
+    capped = np.maximum(vests, SA_STAKE_LIMIT)
+    return np.where(
+        vests > SA_STAKE_LIMIT,
+        SA_STAKE_LIMIT * (np.log10(capped) - math.log10(SA_STAKE_LIMIT) + 1),
+        vests,
+    )
+
+
+def _column(values):
+    # NULL values become NaN, they never pass a filter.
+    return np.array(values, dtype=np.float64)
+
+
+def tally_votes(question, rep=None, age=None, post_count=None, sp=None,
+                community_members=None):
+    """
+    Calculate the filtered per-choice totals and voters of a poll.
+
+    Filter semantics are the same with tally.voter_filter. The columns are
+    built from the raw rows, VoterResults are only built for the voters
+    passing the filters.
+
+    :return (tuple): (Choice id -> Tally, Choice id -> list of
+        VoterResults) Choices without any votes are not included.
+    """
+    rows = list(Vote.objects.filter(choice__question=question).order_by(
+        "-user__sp").values_list(
+        "choice_id", *[f"user__{field}" for field in VOTER_FIELDS]))
+    if not rows:
+        return {}, defaultdict(list)
+
+    columns = dict(zip(("choice_id",) + VOTER_FIELDS, zip(*rows)))
+    choice_ids, choice_index = np.unique(
+        np.array(columns["choice_id"]), return_inverse=True)
+    sp_column = _column(columns["sp"])
+    vests = _column(columns["vests"])
+
+    mask = np.ones(len(rows), dtype=bool)
+    with np.errstate(invalid="ignore"):
+        if rep:
+            mask &= _column(columns["reputation"]) >= rep
+        if age:
+            mask &= _column(columns["account_age"]) >= age
+        if post_count and isinstance(post_count, int):
+            mask &= _column(columns["post_count"]) >= post_count
+        if sp:
+            mask &= sp_column >= sp
+    if community_members is not None:
+        community_members = frozenset(community_members)
+        mask &= np.fromiter(
+            map(community_members.__contains__, columns["username"]),
+            dtype=bool, count=len(rows))
+
+    minlength = len(choice_ids)
+    voter_counts = np.bincount(choice_index, minlength=minlength)
+    filtered_voter_counts = np.bincount(
+        choice_index[mask], minlength=minlength)
+    sp_totals = np.bincount(
+        choice_index[mask], weights=np.nan_to_num(sp_column[mask]),
+        minlength=minlength)
+    with np.errstate(invalid="ignore"):
+        sa_vests_totals = np.bincount(
+            choice_index[mask],
+            weights=np.nan_to_num(sa_stake_based_voting_points(vests[mask])),
+            minlength=minlength)
+
+    tallies = {}
+    for i, choice_id in enumerate(choice_ids.tolist()):
+        tallies[choice_id] = Tally(
+            voter_count=int(voter_counts[i]),
+            filtered_voter_count=int(filtered_voter_counts[i]),
+            sp=float(sp_totals[i]),
+            sa_vests=float(sa_vests_totals[i]),
+        )
+
+    voters = defaultdict(list)
+    for i in np.flatnonzero(mask).tolist():
+        choice_id, *voter = rows[i]
+        voters[choice_id].append(VoterResult(*voter))
+
+    return tallies, voters
@@ -1,6 +1,8 @@
 import copy
+import csv
 import uuid
 import json
+import logging
 from datetime import timedelta
 
 from dateutil.parser import parse
@@ -8,27 +10,41 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.views import auth_logout
-from django.core.paginator import Paginator
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
 from django.db.models import Count
 from django.http import Http404
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
+from django.utils.functional import SimpleLazyObject
 from django.utils.timezone import now
-from hivesigner.client import Client
 from hivesigner.operations import Comment
 
 from base.utils import add_tz_info
-from .models import Question, Choice, User, VoteAudit
+from . import snapshots
+from .blocks import get_block, get_blocks
+from .broadcasts import enqueue as enqueue_broadcast, poll_state
+from .caching import (
+    cache_anonymous_page, cached_votes_summary, detail_cache_key,
+    fragment_timeout, index_cache_key,
+)
+from .models import Broadcast, Question, Choice, User
+from .pagination import InvalidCursor, KeysetPaginator
+from .stats import get_stats
+from .tally import voter_filter
 from communities.models import Community
 
 from .utils import (
-    get_sc_client, get_comment_options, get_top_dpollers,
-    get_top_voters, validate_input, add_or_get_question, add_choices,
-    get_comment, fetch_poll_data, sanitize_filter_value)
+    get_sc_client, get_comment_options, validate_input,
+    add_or_get_question, add_choices, get_comment, fetch_poll_data,
+    sanitize_filter_value, register_vote, register_vote_op, find_vote_op,
+    AlreadyVoted, InvalidVote)
 
 from lightsteem.client import Client as LightsteemClient
 
+logger = logging.getLogger(__name__)
 
 TEAM_MEMBERS = [
         {
@@ -50,50 +66,55 @@ TEAM_MEMBERS = [
     ]
 
 
-def index(request):
+# keyset orderings of the poll listings, the last field is the tie-breaker.
+POLL_ORDERINGS = {
+    "new": ("-id",),
+    "trending": ("-trending_score", "-id"),
+    "promoted": ("-promotion_amount", "-id"),
+}
+
 
+def open_polls(order):
+    """Open polls of the index page, see POLL_ORDERINGS."""
     query_params = {
         "expire_at__gt": now(),
         "is_deleted": False,
     }
-    # ordering by new, trending, or promoted.
-    order_by = "-id"
-    if request.GET.get("order"):
-        if request.GET.get("order") == "trending":
-            order_by = "-voter_count"
-        elif request.GET.get("order") == "promoted":
-            order_by = "-promotion_amount"
-            query_params.update({
-                "promotion_amount__gt": float(0.000),
-            })
+    if order == "promoted":
+        query_params.update({
+            "promotion_amount__gt": float(0.000),
+        })
 
-    questions = Question.objects.filter(**query_params).order_by(order_by)
-    paginator = Paginator(questions, 10)
+    return Question.objects.filter(**query_params).order_by(
+        *POLL_ORDERINGS[order])
 
-    promoted_polls = Question.objects.filter(
-        expire_at__gt=now(),
-        promotion_amount__gt=float(0.000),
-    ).order_by("-promotion_amount")
 
-    if len(promoted_polls):
-        promoted_poll = promoted_polls[0]
-    else:
-        promoted_poll = None
-
-    page = request.GET.get('page')
-    polls = paginator.get_page(page)
-
-    stats = {
-        'poll_count': Question.objects.all().count(),
-        'vote_count': Choice.objects.aggregate(
-            total_votes=Count('voted_users'))["total_votes"],
-        'user_count': User.objects.all().count(),
-        'top_dpollers': get_top_dpollers(),
-        'top_voters': get_top_voters(),
-    }
+@cache_anonymous_page(index_cache_key)
+def index(request):
 
+    # ordering by new, trending, or promoted.
+    order = request.GET.get("order")
+    if order not in POLL_ORDERINGS:
+        order = "new"
+
+    paginator = KeysetPaginator(open_polls(order), 10)
+
+    def get_page():
+        try:
+            return paginator.get_page(request.GET.get('cursor'))
+        except InvalidCursor:
+            return paginator.get_page()
+
+    # lazy, the queries are skipped if the page fragment is cached.
+    cache_key = index_cache_key(request)
     return render(request, "index.html", {
-        "polls": polls, "stats": stats, "promoted_poll": promoted_poll})
+        "polls": SimpleLazyObject(get_page),
+        "stats": SimpleLazyObject(get_stats),
+        "promoted_poll": SimpleLazyObject(
+            lambda: open_polls("promoted").first()),
+        "cache_key": cache_key,
+        "fragment_timeout": fragment_timeout(cache_key),
+    })
 
 
 def sc_login(request):
@@ -161,47 +182,32 @@ def create_poll(request):
             )
             return redirect('create-poll')
 
-        # add question
-        question = add_or_get_question(
-            request,
-            question,
-            permlink,
-            days,
-            allow_multiple_choices
-        )
-        question.save()
-
-        # add answers attached to it
-        add_choices(question, choices)
-
-        # send it to the steem blockchain
-        sc_client = Client(access_token=request.session.get("sc_token"), oauth_base_url="https://hivesigner.com/oauth2/", sc2_api_base_url="https://hivesigner.com/api/")
-        comment = get_comment(request, question, choices, permlink, tags)
-        comment_options = get_comment_options(
-            comment,
-            reward_option=request.POST.get("reward-option")
-        )
-        if not settings.BROADCAST_TO_BLOCKCHAIN:
-            resp = {}
-        else:
-            resp = sc_client.broadcast([
-                comment.to_operation_structure(),
-                comment_options.to_operation_structure(),
-            ])
+        with transaction.atomic():
+            # add question
+            question = add_or_get_question(
+                request,
+                question,
+                permlink,
+                days,
+                allow_multiple_choices
+            )
+            question.save()
 
-        if 'error' in resp:
-            if 'The token has invalid role' in resp.get("error_description"):
-                # expired token
-                auth_logout(request)
-                return redirect('login')
+            # add answers attached to it
+            add_choices(question, choices)
 
-            messages.add_message(
-                request,
-                messages.ERROR,
-                resp.get("error_description", "error")
+            # queue it to be sent to the blockchain
+            comment = get_comment(request, question, choices, permlink, tags)
+            comment_options = get_comment_options(
+                comment,
+                reward_option=request.POST.get("reward-option")
             )
-            question.delete()
-            return redirect('create-poll')
+            enqueue_broadcast(
+                Broadcast.POLL, question, request.user.username,
+                request.session.get("sc_token"), [
+                    comment.to_operation_structure(),
+                    comment_options.to_operation_structure(),
+                ])
 
         return redirect('detail', question.username, question.permlink)
 
@@ -260,42 +266,31 @@ def edit_poll(request, author, permlink):
             })
             return render(request, "edit.html", {"form_data": form_data})
 
-        # add question
-        question = add_or_get_question(
-            request,
-            question,
-            permlink,
-            days,
-            allow_multiple_choices
-        )
-        question.save()
-
-        # add answers attached to it
-        add_choices(question, choices, flush=True)
-
-        # send it to the steem blockchain
-        sc_client = Client(access_token=request.session.get("sc_token"), oauth_base_url="https://hivesigner.com/oauth2/", sc2_api_base_url="https://hivesigner.com/api/")
-        comment = get_comment(request, question, choices, permlink, tags=tags)
-        if not settings.BROADCAST_TO_BLOCKCHAIN:
-            resp = {}
-        else:
-            resp = sc_client.broadcast([
-                comment.to_operation_structure(),
-            ])
+        with transaction.atomic():
+            # restored if the edit fails to broadcast.
+            previous = poll_state(poll)
 
-        if 'error' in resp:
-            if 'The token has invalid role' in resp.get("error_description"):
-                # expired token
-                auth_logout(request)
-                return redirect('login')
-
-            messages.add_message(
+            # add question
+            question = add_or_get_question(
                 request,
-                messages.ERROR,
-                resp.get("error_description", "error")
+                question,
+                permlink,
+                days,
+                allow_multiple_choices
             )
-            question.delete()
-            return redirect('edit', args=(author, permlink))
+            question.save()
+
+            # add answers attached to it
+            add_choices(question, choices, flush=True)
+
+            # queue it to be sent to the blockchain
+            comment = get_comment(
+                request, question, choices, permlink, tags=tags)
+            enqueue_broadcast(
+                Broadcast.EDIT, question, request.user.username,
+                request.session.get("sc_token"), [
+                    comment.to_operation_structure(),
+                ], previous=previous)
 
         return redirect('detail', question.username, question.permlink)
 
@@ -304,6 +299,16 @@ def edit_poll(request, author, permlink):
     })
 
 
+def detail_page_key(request, user, permlink):
+    if 'audit' in request.GET or 'after_promotion' in request.GET:
+        return None
+    poll_id = Question.objects.filter(
+        username=user, permlink=permlink, is_deleted=False).values_list(
+        'id', flat=True).first()
+    return poll_id and detail_cache_key(request, poll_id)
+
+
+@cache_anonymous_page(detail_page_key)
 def detail(request, user, permlink):
 
     if 'after_promotion' in request.GET:
@@ -328,9 +333,18 @@ def detail(request, user, permlink):
 
     # check the existance of the community
     try:
-        Community.objects.get(name=community)
+        community_obj = Community.objects.get(name=community)
     except Community.DoesNotExist:
-        community = None
+        community, community_obj = None, None
+
+    if 'audit' in request.GET:
+        # ?audit streams a text table, ?audit=csv and ?audit=ndjson are
+        # the downloadable exports.
+        voter_q = voter_filter(
+            rep, age, post_count, sp,
+            community_members=community_obj and
+            community_obj.member_usernames())
+        return poll.audit_response(request.GET.get("audit"), voter_q=voter_q)
 
     if community:
         messages.add_message(
@@ -340,7 +354,8 @@ def detail(request, user, permlink):
         )
 
     choice_list, choice_list_ordered, choices_selected, filter_exists, \
-            all_votes = poll.votes_summary(
+            all_votes = cached_votes_summary(
+                poll,
                 age=age,
                 rep=rep,
                 sp=sp,
@@ -350,14 +365,16 @@ def detail(request, user, permlink):
                 community=community,
             )
 
-    user_votes = Choice.objects.filter(
-        voted_users__username=request.user.username,
-        question=poll,
-    ).values_list('id', flat=True)
-
-    if 'audit' in request.GET:
-        return poll.audit_response(choice_list)
+    snapshot = poll.get_snapshot()
+    if snapshot:
+        user_votes = snapshots.choices_of(snapshot, request.user.username)
+    else:
+        user_votes = Choice.objects.filter(
+            voted_users__username=request.user.username,
+            question=poll,
+        ).values_list('id', flat=True)
 
+    cache_key = detail_cache_key(request, poll.id)
     return render(request, "poll_detail.html", {
         "poll": poll,
         "choices": choice_list,
@@ -367,6 +384,8 @@ def detail(request, user, permlink):
         "show_bars": choices_selected > 1,
         "filters_applied": filter_exists,
         "communities": Community.objects.all().order_by("-id"),
+        "cache_key": cache_key,
+        "fragment_timeout": fragment_timeout(cache_key),
     })
 
 
@@ -423,19 +442,14 @@ def vote(request, user, permlink):
         )
         return redirect("detail", poll.username, poll.permlink)
 
-    for choice_id in choice_ids:
-        try:
-            choice = Choice.objects.get(pk=int(choice_id))
-        except Choice.DoesNotExist:
-            raise Http404
-
-    choice_instances = []
-    for choice_id in choice_ids:
-        choice = Choice.objects.get(pk=int(choice_id))
-        choice_instances.append(choice)
-
-    # send it to the steem blockchain
-    sc_client = Client(access_token=request.session.get("sc_token"), oauth_base_url="https://hivesigner.com/oauth2/", sc2_api_base_url="https://hivesigner.com/api/")
+    try:
+        choice_ids = list(dict.fromkeys(int(x) for x in choice_ids))
+    except ValueError:
+        raise Http404
+    choices = poll.choices.in_bulk(choice_ids)
+    if len(choices) != len(choice_ids):
+        raise Http404
+    choice_instances = [choices[choice_id] for choice_id in choice_ids]
 
     choice_text = ""
     for c in choice_instances:
@@ -459,52 +473,27 @@ def vote(request, user, permlink):
     )
 
     comment_options = get_comment_options(comment)
-    if not settings.BROADCAST_TO_BLOCKCHAIN:
-        resp = {}
-    else:
-        resp = sc_client.broadcast([
-            comment.to_operation_structure(),
-            comment_options.to_operation_structure(),
-        ])
-
-    # Steemconnect sometimes returns 503.
-    # https://github.com/steemscript/steemconnect/issues/356
-    if not isinstance(resp, dict):
-        messages.add_message(
-            request,
-            messages.ERROR,
-            "We got an unexpected error from Steemconnect. Please, try again."
-        )
-        return redirect("detail", poll.username, poll.permlink)
 
-    # Expected way to receive errors on broadcasting
-    if 'error' in resp:
+    # register the vote to the database, and queue it to be sent to the
+    # blockchain. The trx id and block id are added to the audit log once
+    # it's broadcasted.
+    try:
+        with transaction.atomic():
+            vote_audit = register_vote(poll, request.user, choice_instances)
+            enqueue_broadcast(
+                Broadcast.VOTE, poll, request.user.username,
+                request.session.get("sc_token"), [
+                    comment.to_operation_structure(),
+                    comment_options.to_operation_structure(),
+                ], vote_audit=vote_audit)
+    except AlreadyVoted:
         messages.add_message(
             request,
             messages.ERROR,
-            resp.get("error_description", "error")
+            "You have already voted for this poll!"
         )
-
         return redirect("detail", poll.username, poll.permlink)
 
-    # register the vote to the database
-    for choice_instance in choice_instances:
-        choice_instance.voted_users.add(request.user)
-
-    block_id = resp.get("result", {}).get("block_num")
-    trx_id = resp.get("result", {}).get("id")
-
-    # add trx id and block id to the audit log
-    vote_audit = VoteAudit(
-        question=poll,
-        voter=request.user,
-        block_id=block_id,
-        trx_id=trx_id
-    )
-    vote_audit.save()
-    for choice_instance in choice_instances:
-        vote_audit.choices.add(choice_instance)
-
     messages.add_message(
         request,
         messages.SUCCESS,
@@ -538,9 +527,35 @@ def team(request):
     return render(request, "team.html", {"team_members": TEAM_MEMBERS})
 
 
+def polls_by_voter_count(start_time, end_time, exclude_team_members=False):
+    """
+    Polls created in the date range, ordered by their number of unique
+    voters. Counted with one grouped query and cached per arguments.
+
+    :return (list): dicts of id, username, permlink, text and vote_count.
+    """
+    key = "dpoll:polls_by_vote_count:{}:{}:{}".format(
+        start_time.isoformat(), end_time.isoformat(),
+        int(bool(exclude_team_members)))
+    polls = cache.get(key)
+    if polls is None:
+        questions = Question.objects.filter(
+            created_at__gt=start_time, created_at__lt=end_time)
+        if exclude_team_members:
+            questions = questions.exclude(username__in=settings.TEAM_MEMBERS)
+        # a user voted for multiple choices counts once.
+        polls = list(questions.annotate(
+            vote_count=Count("choices__voted_users", distinct=True),
+        ).order_by("-vote_count", "-id").values(
+            "id", "username", "permlink", "text", "vote_count"))
+        cache.set(key, polls, settings.POLLS_BY_VOTE_COUNT_CACHE_TIMEOUT)
+    return polls
+
+
 def polls_by_vote_count(request):
-    end_time = now()
-    start_time = now() - timedelta(days=7)
+    # the default range is rounded to the minute, to reuse the cache.
+    end_time = now().replace(second=0, microsecond=0)
+    start_time = end_time - timedelta(days=7)
     if request.GET.get("start_time"):
         try:
             start_time = add_tz_info(parse(request.GET.get("start_time")))
@@ -552,32 +567,28 @@ def polls_by_vote_count(request):
         except Exception as e:
             pass
 
-    polls = []
-    questions = Question.objects.filter(
-            created_at__gt=start_time,
-            created_at__lt=end_time)
-    if request.GET.get("exclude_team_members"):
-        questions = questions.exclude(username__in=settings.TEAM_MEMBERS)
-
-    for question in questions:
-        vote_count = 0
-        already_counted_users = []
-        for choice in question.choices.all():
-            voted_users = choice.voted_users.all()
-            for voted_user in voted_users:
-                if voted_user.pk in already_counted_users:
-                    continue
-                vote_count += 1
-                # now, with the multiple choices implemented
-                # only one choice of a user should be counted, here.
-                already_counted_users.append(voted_user.pk)
-        polls.append({"vote_count": vote_count, "poll": question})
-
-    polls = sorted(polls, key=lambda x: x["vote_count"], reverse=True)
+    polls = polls_by_voter_count(
+        start_time, end_time,
+        exclude_team_members=request.GET.get("exclude_team_members"))
+
+    if request.GET.get("export") == "csv":
+        response = HttpResponse(content_type="text/csv")
+        response["Content-Disposition"] = \
+            'attachment; filename="polls-by-vote-count.csv"'
+        writer = csv.writer(response)
+        writer.writerow(["rank", "vote_count", "username", "text", "url"])
+        for rank, poll in enumerate(polls, start=1):
+            writer.writerow([
+                rank, poll["vote_count"], poll["username"], poll["text"],
+                request.build_absolute_uri(reverse(
+                    "detail", args=[poll["username"], poll["permlink"]])),
+            ])
+        return response
 
     return render(request, "polls_by_vote.html", {
         "polls": polls, "start_time": start_time, "end_time": end_time})
 
+
 @csrf_exempt
 def vote_transaction_details(request):
     poll_id = request.POST.get("poll_id")
@@ -636,96 +647,102 @@ def sync_vote(request):
     except (TypeError, ValueError):
         return HttpResponse('Invalid block ID', status=400)
 
-    c = LightsteemClient(nodes=["https://api.hivekings.com"])
-    block_data = c.get_block(block_num)
+    c = LightsteemClient(nodes=settings.BLOCKCHAIN_NODES)
+    block_data = get_block(c, block_num)
     if not block_data:
         # block data may return null if it's invalid
         return HttpResponse('Invalid block ID', status=400)
 
-    vote_tx = None
-    for transaction in block_data.get("transactions", []):
-        if transaction.get("transaction_id") == trx_id:
-            vote_tx = transaction
-            break
-
-    if not vote_tx:
-        return HttpResponse('Invalid transaction ID', status=400)
-
-    vote_op = None
-    for op_type, op_value in transaction.get("operations", []):
-        if op_type != "comment":
-            continue
-        vote_op = op_value
-
-    if not vote_op:
-        return HttpResponse("Couldn't find valid vote operation.", status=400)
-
-    # validate json metadata
-    if not vote_op.get("json_metadata"):
-        return HttpResponse("json_metadata is missing.", status=400)
-
-    json_metadata = json.loads(vote_op.get("json_metadata", ""))
-
-    # json_metadata should indicate content type
-    if json_metadata.get("content_type") != "poll_vote":
-        return HttpResponse("content_type field is missing.", status=400)
-
-    # check votes
-    votes = json_metadata.get("votes", [])
-    if not len(votes):
-        return HttpResponse("votes field is missing.", status=400)
-
-    # check the poll exists
     try:
-        question = Question.objects.get(
-            username=vote_op.get("parent_author"),
-            permlink=vote_op.get("parent_permlink"),
-        )
-    except Question.DoesNotExist:
-        return HttpResponse("parent_author/parent_permlink is not a poll.", status=400)
+        register_vote_op(find_vote_op(block_data, trx_id), block_num, trx_id)
+    except InvalidVote as e:
+        return HttpResponse(str(e), status=400)
+    except AlreadyVoted:
+        return HttpResponse("You have already voted on that poll.", status=400)
 
-    # Validate the choice
-    choices = Choice.objects.filter(
-        question=question,
-    )
-    selected_choices = []
-    for choice in choices:
-        for user_vote in votes:
-            if choice.text == user_vote:
-                selected_choices.append(choice)
+    return HttpResponse("Vote is registered to the database.", status=200)
 
-    if not selected_choices:
-        return HttpResponse("Invalid choices in votes field.", status=400)
 
-    # check if the user exists in our database
-    # if it doesn't, create it.
-    try:
-        user = User.objects.get(username=vote_op.get("author"))
-    except User.DoesNotExist:
-        user = User.objects.create_user(
-            username=vote_op.get("author"))
-        user.save()
+# maximum number of votes synced with a request.
+SYNC_BATCH_LIMIT = 100
 
-    # check if we already registered a vote from that user
-    if Choice.objects.filter(
-            voted_users__username=vote_op.get("author"),
-            question=question).count() != 0:
-        return HttpResponse("You have already voted on that poll.", status=400)
-
-    # register the vote
-    for selected_choice in selected_choices:
-        selected_choice.voted_users.add(user)
 
-    # add vote audit entry
-    vote_audit = VoteAudit(
-        question=question,
-        voter=user,
-        block_id=block_num,
-        trx_id=trx_id
-    )
-    vote_audit.save()
+@csrf_exempt
+def sync_votes(request):
+    """
+    Batch variant of sync_vote. Expects a JSON body like
+    {"votes": [{"trx_id": "...", "block_num": 1}, ...]}, fetches every block
+    once and registers the valid votes in one transaction.
+    """
+    if request.method != "POST":
+        return HttpResponse(status=405)
 
-    return HttpResponse("Vote is registered to the database.", status=200)
+    try:
+        items = json.loads(request.body)["votes"]
+    except (ValueError, KeyError, TypeError):
+        return HttpResponse("votes field is missing.", status=400)
+    if not isinstance(items, list):
+        return HttpResponse("votes field is missing.", status=400)
+    if len(items) > SYNC_BATCH_LIMIT:
+        return HttpResponse(
+            f"At most {SYNC_BATCH_LIMIT} votes can be synced at once.",
+            status=400)
+
+    results = []
+    for item in items:
+        if not isinstance(item, dict):
+            item = {}
+        result = {"trx_id": item.get("trx_id"), "block_num": None}
+        try:
+            # block numbers must be integer
+            result["block_num"] = int(item.get("block_num"))
+        except (TypeError, ValueError):
+            result.update({"status": 400, "message": "Invalid block ID"})
+        results.append(result)
+
+    block_nums = {r["block_num"] for r in results if "status" not in r}
+    blocks = {}
+    if block_nums:
+        c = LightsteemClient(nodes=settings.BLOCKCHAIN_NODES)
+        blocks = get_blocks(c, block_nums, missing_ok=True)
+
+    # polls and their choices, shared between the votes.
+    polls = {}
+    with transaction.atomic():
+        for result in results:
+            if "status" in result:
+                continue
+            block_data = blocks.get(result["block_num"])
+            if not block_data:
+                # block data may return null if it's invalid
+                result.update({"status": 400, "message": "Invalid block ID"})
+                continue
+            try:
+                # a savepoint per vote, a failed one doesn't roll back the
+                # others.
+                with transaction.atomic():
+                    register_vote_op(
+                        find_vote_op(block_data, result["trx_id"]),
+                        result["block_num"], result["trx_id"], polls=polls)
+            except InvalidVote as e:
+                result.update({"status": 400, "message": str(e)})
+            except AlreadyVoted:
+                result.update({
+                    "status": 400,
+                    "message": "You have already voted on that poll."})
+            except DatabaseError:
+                logger.exception(
+                    "Couldn't sync the vote %s in block %s.",
+                    result["trx_id"], result["block_num"])
+                result.update({
+                    "status": 500,
+                    "message": "Couldn't register the vote, try again."})
+            else:
+                result.update({
+                    "status": 200,
+                    "message": "Vote is registered to the database."})
+
+    return JsonResponse({"results": results})
 
 
 def vote_check(request):
@@ -0,0 +1,196 @@
+"""
+Incremental maintenance of Question.voter_count.
+
+A user counts once per poll, even with votes on multiple choices. Vote
+changes only check whether the affected users are new to (or gone from)
+the poll, so the cost of a vote doesn't depend on the poll size. The
+deltas of a transaction are collected and applied with a single atomic
+increment per poll when the transaction commits. Cleared relations fall
+back to a COUNT(DISTINCT user_id) recompute of their polls, and
+refresh_voter_counts repairs any drift in bulk.
+
+The trending scores (see trending.py) grow with the same new voters, and
+are incremented in the same UPDATE.
+"""
+from collections import defaultdict
+from weakref import WeakValueDictionary
+
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Value, When
+
+from .models import Choice, Question
+from .tally import Vote
+
+
+def count_voters(question_ids):
+    """
+    Count the distinct voters of the polls in one grouped query.
+
+    :param question_ids (iterable): Question ids
+    :return (dict): Question id -> voter count. Polls without any votes
+        are not included.
+    """
+    return dict(Vote.objects.filter(
+        choice__question_id__in=question_ids).values(
+        "choice__question_id").annotate(
+        voters=Count("user_id", distinct=True)).order_by().values_list(
+        "choice__question_id", "voters"))
+
+
+def _voters_elsewhere(questions, choice_ids, user_ids):
+    """Question id -> users with votes on other choices of the poll."""
+    voters = defaultdict(set)
+    rows = Vote.objects.filter(
+        choice__question_id__in=set(questions.values()),
+        user_id__in=user_ids).exclude(
+        choice_id__in=choice_ids).values_list(
+        "choice__question_id", "user_id").distinct()
+    for question_id, user_id in rows:
+        voters[question_id].add(user_id)
+    return voters
+
+
+class PendingVoterCounts:
+    """
+    Voter count changes of a transaction, applied on commit. Registered
+    once per transaction with transaction.on_commit.
+
+    :param registry (dict): Where the instance is registered, see _pending.
+    :param key: Key of the instance in the registry.
+    """
+
+    def __init__(self, registry=None, key=None):
+        self.registry = registry
+        self.key = key
+        self.deltas = defaultdict(int)
+        self.new_voters = defaultdict(int)
+        self.recount = set()
+
+    def __call__(self):
+        if self.registry is not None and \
+                self.registry.get(self.key) is self:
+            # the next transaction starts with a new instance.
+            del self.registry[self.key]
+
+        recount = self.recount
+        if recount:
+            counts = count_voters(recount)
+            for question_id in recount:
+                Question.objects.filter(pk=question_id).update(
+                    voter_count=counts.get(question_id, 0))
+
+        for question_id, delta in self.deltas.items():
+            if question_id in recount:
+                fields = {}
+            else:
+                fields = {"voter_count": F("voter_count") + delta}
+            if self.new_voters[question_id]:
+                fields["trending_score"] = F("trending_score") + \
+                    self.new_voters[question_id]
+            if fields:
+                Question.objects.filter(pk=question_id).update(**fields)
+
+
+def _pending():
+    """
+    Return the PendingVoterCounts of the current transaction, registered
+    with transaction.on_commit on the first call. Changes inside a
+    savepoint are kept apart, so they are discarded with it on a rollback.
+
+    The instances are kept in a registry on the connection, by savepoint,
+    until they run on commit. The registry only holds weak references:
+    Django drops the on commit callbacks of a rolled back transaction (or
+    savepoint), and their instances disappear from the registry with them.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return PendingVoterCounts()
+    if not hasattr(connection, "pending_voter_counts"):
+        connection.pending_voter_counts = WeakValueDictionary()
+    registry = connection.pending_voter_counts
+    key = tuple(connection.savepoint_ids)
+    pending = registry.get(key)
+    if pending is None:
+        pending = PendingVoterCounts(registry, key)
+        registry[key] = pending
+        transaction.on_commit(pending)
+    return pending
+
+
+def record_votes(choice_ids, user_ids, removed=False):
+    """
+    Record the added (or removed) votes of the users on the choices.
+
+    :param choice_ids (iterable): Choice ids
+    :param user_ids (iterable): Ids of the users voted for every choice.
+    :param removed (bool): The votes are removed.
+    """
+    choice_ids, user_ids = set(choice_ids), set(user_ids)
+    questions = dict(Choice.objects.filter(pk__in=choice_ids).values_list(
+        "pk", "question_id"))
+    elsewhere = _voters_elsewhere(questions, choice_ids, user_ids)
+
+    pending = _pending()
+    for question_id in set(questions.values()):
+        # users without any other votes on the poll joined (or left) it.
+        changed = len(user_ids - elsewhere[question_id])
+        if not changed:
+            continue
+        if removed:
+            pending.deltas[question_id] -= changed
+        else:
+            pending.deltas[question_id] += changed
+            pending.new_voters[question_id] += changed
+    _flush_autocommit(pending)
+
+
+def recount_voters(question_ids):
+    """Recalculate the voter counts of the polls, e.g. after a clear."""
+    pending = _pending()
+    pending.recount.update(question_ids)
+    _flush_autocommit(pending)
+
+
+def _flush_autocommit(pending):
+    if not transaction.get_connection().in_atomic_block:
+        pending()
+
+
+def refresh_voter_counts(questions=None, chunk_size=1000, dry_run=False):
+    """
+    Recalculate the stored voter counts of the polls. Every chunk of polls
+    is counted with one grouped query, and the drifted counts are fixed
+    with a single UPDATE.
+
+    :param questions (QuerySet): Polls to refresh. Defaults to all polls.
+    :param chunk_size (int): Number of polls per query.
+    :param dry_run (bool): Only report the drift, don't update.
+    :return (list): (question id, stored count, actual count) of the
+        drifted polls.
+    """
+    if questions is None:
+        questions = Question.objects.all()
+
+    drifted, last_id = [], 0
+    while True:
+        stored = list(questions.filter(pk__gt=last_id).order_by(
+            "pk").values_list("pk", "voter_count")[:chunk_size])
+        if not stored:
+            break
+        last_id = stored[-1][0]
+
+        counts = count_voters([question_id for question_id, _ in stored])
+        chunk = [
+            (question_id, voter_count, counts.get(question_id, 0))
+            for question_id, voter_count in stored
+            if voter_count != counts.get(question_id, 0)
+        ]
+        drifted += chunk
+        if chunk and not dry_run:
+            Question.objects.filter(
+                pk__in=[question_id for question_id, _, _ in chunk]).update(
+                voter_count=Case(*[
+                    When(pk=question_id, then=Value(actual))
+                    for question_id, _, actual in chunk
+                ], output_field=IntegerField()))
+    return drifted